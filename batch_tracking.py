@@ -0,0 +1,200 @@
+"""Batch tracking of many videos across all CPU cores.
+
+Videos are listed in a manifest csv, one row per video, with the columns:
+    Video, bboxX, bboxY, bboxWidth, bboxHeight[, Tracker][, StartFrame][, Output]
+Tracker is a tracker type or profile name (see tracking.TRACKER_PROFILES and --profiles) and defaults to the balanced
+profile (MIL), StartFrame to 1 and Output to <video>_trace.csv (or <output dir>/<video>_trace.csv). Outputs ending in
+.npz or .parquet are saved in that format, with the tracking settings as metadata, and are written in chunks as the
+video is tracked.
+
+Each video is tracked in its own worker process with its own capture and tracker. Finished videos are logged to
+<manifest>_progress.csv as they complete, so re-running the same manifest skips anything already done. A summary with
+per-video timing is written to <manifest>_summary.csv at the end. Videos in progress are checkpointed
+(<output>.checkpoint.npz) as they're tracked, so an interrupted video carries on from its last checkpoint too.
+
+Rows are told apart by their Output, so the same video can be listed more than once (e.g. with different boxes or
+trackers) as long as each row has its own Output.
+
+Usage:
+> python batch_tracking.py sessions.csv --workers 8 --output-dir traces
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import pandas as pd
+
+from tracking import (checkpoint_path, load_checkpoint, load_tracker_profiles, open_trace_writer, remove_checkpoint,
+                      resolve_profile, track_video, save_trace, trace_metadata, video_properties, Checkpointer,
+                      DEFAULT_PROFILE, STREAM_FORMATS)
+
+PROGRESS_COLUMNS = ['Video', 'Output', 'Status', 'Frames', 'Failed', 'Seconds', 'FPS', 'Error']
+
+
+def read_manifest(manifest_path, output_dir=None, profiles=None):
+    """Read the manifest csv into a list of job dicts, filling in the optional columns. Tracker names are looked up
+    in profiles (see tracking.resolve_profile), so a typo fails here rather than after the other videos are done"""
+    manifestdf = pd.read_csv(manifest_path)
+    missing = {'Video', 'bboxX', 'bboxY', 'bboxWidth', 'bboxHeight'} - set(manifestdf.columns)
+    if missing:
+        raise ValueError(f"Manifest is missing column(s): {', '.join(sorted(missing))}")
+
+    jobs = []
+    for _, row in manifestdf.iterrows():
+        videoPath = str(row['Video'])
+        outputPath = row['Output'] if 'Output' in manifestdf.columns and pd.notna(row['Output']) else None
+        if outputPath is None:
+            outputName = os.path.splitext(os.path.split(videoPath)[1])[0] + "_trace.csv"
+            outputPath = os.path.join(output_dir if output_dir else os.path.dirname(videoPath), outputName)
+        tracker = row['Tracker'] if 'Tracker' in manifestdf.columns and pd.notna(row['Tracker']) else DEFAULT_PROFILE
+        startFrame = row['StartFrame'] if 'StartFrame' in manifestdf.columns and pd.notna(row['StartFrame']) else 1
+        jobs.append({
+            'video': videoPath,
+            'bbox': tuple(int(row[col]) for col in ['bboxX', 'bboxY', 'bboxWidth', 'bboxHeight']),
+            'tracker': str(tracker),
+            'profile': resolve_profile(str(tracker), profiles),
+            'start_frame': int(startFrame),
+            'output': str(outputPath),
+        })
+    outputs = pd.Series([job['output'] for job in jobs])
+    duplicates = outputs[outputs.duplicated()].unique()
+    if len(duplicates):
+        raise ValueError(f"Manifest rows share an output file (give each its own Output): {', '.join(duplicates)}")
+    return jobs
+
+
+def read_progress(progress_path):
+    """Return the set of outputs already tracked successfully according to the progress file"""
+    if not os.path.exists(progress_path):
+        return set()
+    progressdf = pd.read_csv(progress_path)
+    done = progressdf[progressdf['Status'] == 'done']
+    return {output for output in done['Output'] if os.path.exists(output)}
+
+
+def append_progress(progress_path, record):
+    """Append one finished video to the progress file (written as we go so an interrupted batch can resume)"""
+    recorddf = pd.DataFrame([record], columns=PROGRESS_COLUMNS)
+    recorddf.to_csv(progress_path, mode='a', index=False, header=not os.path.exists(progress_path))
+
+
+def run_job(job):
+    """Track one video and save its trace. Runs in a worker process, so errors are returned rather than raised"""
+    # each worker gets one core; letting OpenCV spawn its own threads in every worker just oversubscribes the cpu
+    cv2.setNumThreads(1)
+    timeStart = time.perf_counter()
+    record = dict.fromkeys(PROGRESS_COLUMNS, '')
+    record.update({'Video': job['video'], 'Output': job['output']})
+    try:
+        # (raises for a video that can't be read, before any output is opened for it)
+        fps, frameCount, vidHeight = video_properties(job['video'])
+        metadata = trace_metadata(job['video'], fps=fps, tracker_type=job['tracker'], bbox=job['bbox'],
+                                  start_frame=job['start_frame'], vid_height=vidHeight, frame_count=frameCount,
+                                  profile=job['profile'])
+        checkpointPath = checkpoint_path(job['output'])
+        resume = None
+        if job.get('resume') and os.path.exists(checkpointPath):
+            resume = load_checkpoint(checkpointPath)
+        traceWriter = None
+        if os.path.splitext(job['output'])[1].lower() in STREAM_FORMATS:
+            # stream it as it's tracked, so a worker that dies mid-video leaves the chunks it had finished
+            traceWriter = open_trace_writer(job['output'], metadata)
+        trace, stats = track_video(job['video'], job['bbox'], tracker_type=job['profile'],
+                                   start_frame=job['start_frame'], trace_writer=traceWriter,
+                                   checkpointer=Checkpointer(checkpointPath, metadata=metadata), resume=resume)
+        if traceWriter is not None:
+            traceWriter.close()
+        else:
+            save_trace(trace, job['output'], metadata)
+        remove_checkpoint(checkpointPath)
+        record.update({'Status': 'done', 'Frames': stats['frames'], 'Failed': stats['failed'],
+                       'FPS': round(stats['fps'], 2)})
+    except Exception as e:
+        record.update({'Status': 'error', 'Error': str(e)})
+    record['Seconds'] = round(time.perf_counter() - timeStart, 2)
+    return record
+
+
+def run_batch(manifest_path, workers=None, output_dir=None, resume=True, profiles=None):
+    """Track every video in the manifest using a pool of worker processes. Returns the summary DataFrame"""
+    jobs = read_manifest(manifest_path, output_dir, profiles)
+    manifestBase = os.path.splitext(manifest_path)[0]
+    progressPath = manifestBase + "_progress.csv"
+    summaryPath = manifestBase + "_summary.csv"
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if resume:
+        done = read_progress(progressPath)
+        skipped = [job for job in jobs if job['output'] in done]
+        jobs = [job for job in jobs if job['output'] not in done]
+        if skipped:
+            print(f"Skipping {len(skipped)} video(s) already tracked (see {progressPath})")
+    elif os.path.exists(progressPath):
+        os.remove(progressPath)
+
+    for job in jobs:
+        job['resume'] = resume
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+
+    records = []
+    timeStart = time.perf_counter()
+    if jobs:
+        print(f"Tracking {len(jobs)} video(s) with {workers} worker(s)")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_job, job) for job in jobs]
+            for i, future in enumerate(as_completed(futures)):
+                record = future.result()
+                records.append(record)
+                append_progress(progressPath, record)
+                print(f"[{i + 1}/{len(jobs)}] {record['Status']}: {record['Video']} -> {record['Output']} "
+                      f"({record['Seconds']} s)" + (f" - {record['Error']}" if record['Error'] else ''))
+    wallTime = time.perf_counter() - timeStart
+
+    # summary covers the whole manifest, including videos finished by earlier runs
+    summarydf = pd.read_csv(progressPath) if os.path.exists(progressPath) else pd.DataFrame(columns=PROGRESS_COLUMNS)
+    summarydf = summarydf.drop_duplicates(subset='Output', keep='last')
+    summarydf.to_csv(summaryPath, index=False)
+
+    nDone = int((summarydf['Status'] == 'done').sum())
+    nError = int((summarydf['Status'] == 'error').sum())
+    videoTime = sum(record['Seconds'] for record in records)
+    print(f"{nDone} video(s) tracked, {nError} failed. This run: {len(records)} video(s), {wallTime:.1f} s wall time, "
+          f"{videoTime:.1f} s of tracking ({videoTime / wallTime if wallTime > 0 else 0:.1f}x parallel speedup). "
+          f"Summary saved to {summaryPath}")
+    return summarydf
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Track every video listed in a manifest csv, in parallel")
+    parser.add_argument('manifest', help="csv with columns Video, bboxX, bboxY, bboxWidth, bboxHeight "
+                                         "and optionally Tracker, StartFrame, Output")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of worker processes "
+                                                                        "(default: number of cores)")
+    parser.add_argument('-o', '--output-dir', default=None, help="folder for traces without an Output column "
+                                                                 "(default: next to each video)")
+    parser.add_argument('--restart', action='store_true', help="ignore previous progress and track everything again")
+    parser.add_argument('--profiles', default=None, help="json file of extra tracker profiles (default: "
+                                                         "tracker_profiles.json next to this program, if there is one)")
+    args = parser.parse_args(argv)
+
+    try:
+        profiles = load_tracker_profiles(args.profiles)
+    except (OSError, ValueError) as e:
+        parser.error(f"Could not read the tracker profiles: {e}")
+    summarydf = run_batch(args.manifest, workers=args.workers, output_dir=args.output_dir, resume=not args.restart,
+                          profiles=profiles)
+    return 0 if (summarydf['Status'] == 'done').all() else 1
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # needed for the worker processes when built with pyinstaller
+    sys.exit(main())
@@ -0,0 +1,427 @@
+"""Benchmark of the OpenCV trackers, to choose which one to track with.
+
+Every available tracker is run over a set of clips with known ground truth: synthetic clips of a textured patch moving
+over a textured background (generated locally, the same every time for a given seed), plus any reference clips given
+on the command line. For each tracker and clip it reports the tracking speed (frames/s and per-frame latency
+percentiles, timing only the tracker), the peak memory of the process, and the accuracy against the ground truth
+(mean IoU, success rate at IoU >= 0.5, centre error in pixels and the number of frames the tracker reported lost).
+
+Reference clips need a ground truth csv next to them, <clip>_gt.csv, with the columns Frame, x, y, width, height (frame
+numbers as shown by the GUI, i.e. starting at 1). Tracking starts from its first row, and accuracy is measured on the
+frames it lists.
+
+Each run happens in its own process, so memory use doesn't carry over from one tracker to the next, and a tracker that
+crashes (e.g. GOTURN without its model files) only loses its own result.
+
+Trackers can also be given as profile names (see tracking.TRACKER_PROFILES), to compare tuned settings.
+
+Usage:
+> python benchmark_trackers.py --trackers MIL KCF CSRT MOSSE --min-iou 0.6
+> python benchmark_trackers.py --trackers fastest fast balanced accurate-fast accurate
+> python benchmark_trackers.py session1_clip.mp4 session2_clip.mp4 -o benchmark.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2  # via opencv-python AND opencv-contrib-python (for other trackers)
+import numpy as np
+import pandas as pd
+
+from tracking import create_profile_tracker, load_tracker_profiles, resolve_profile, TRACKER_TYPES
+
+try:
+    import psutil  # optional, for sampling memory use while tracking
+except ImportError:
+    psutil = None
+try:
+    import resource  # not on Windows
+except ImportError:
+    resource = None
+
+SYNTHETIC_MOTIONS = ['smooth', 'bobbing', 'bursts']
+SYNTHETIC_FRAMES = 300
+SYNTHETIC_SIZE = (640, 480)  # width, height
+SYNTHETIC_PATCH = (48, 48)  # width, height of the moving patch
+SYNTHETIC_FPS = 30
+SUCCESS_IOU = 0.5  # a frame counts as tracked correctly at or above this IoU with the ground truth
+MEMORY_SAMPLE_INTERVAL = 0.005  # seconds between memory samples with psutil
+
+
+def synthetic_path(motion, n_frames, size, patch_size):
+    """Centre of the patch on each frame (array of (x, y), one row per frame) for the given kind of motion:
+    smooth: a slow Lissajous figure across the frame
+    bobbing: slow drift sideways, with a fast vertical bob (about 1.5 bobs per second)
+    bursts: the Lissajous figure, but with occasional short bursts of fast movement"""
+    width, height = size
+    marginX = patch_size[0] / 2 + 10
+    marginY = patch_size[1] / 2 + 10
+    t = np.arange(n_frames, dtype=float)
+    if motion == 'smooth':
+        phase = t
+    elif motion == 'bursts':
+        speed = np.ones(n_frames)
+        for burstStart in range(40, n_frames, 70):
+            speed[burstStart:burstStart + 6] = 8  # a few frames at 8x speed
+        phase = np.cumsum(speed) - speed[0]
+    elif motion == 'bobbing':
+        cx = width / 2 + (width / 2 - marginX) * 0.6 * np.sin(2 * np.pi * t / n_frames)
+        cy = height / 2 + (height / 2 - marginY) * 0.5 * np.sin(2 * np.pi * t / 20)
+        return np.column_stack([cx, cy])
+    else:
+        raise ValueError(f"Unknown synthetic motion: {motion}")
+    cx = width / 2 + (width / 2 - marginX) * 0.8 * np.sin(2 * np.pi * phase / 200)
+    cy = height / 2 + (height / 2 - marginY) * 0.8 * np.sin(2 * np.pi * phase / 130)
+    return np.column_stack([cx, cy])
+
+
+def make_synthetic_clip(clip_path, motion, n_frames=SYNTHETIC_FRAMES, size=SYNTHETIC_SIZE,
+                        patch_size=SYNTHETIC_PATCH, seed=0):
+    """Write a synthetic clip of a textured patch moving over a textured background (with a little noise on every
+    frame), and its ground truth csv. Everything is drawn from seed, so the same arguments always give the same clip"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    patchWidth, patchHeight = patch_size
+    background = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+    patch = cv2.GaussianBlur(rng.integers(0, 256, (patchHeight, patchWidth, 3), dtype=np.uint8), (0, 0), 1)
+    centres = synthetic_path(motion, n_frames, size, patch_size)
+
+    writer = cv2.VideoWriter(clip_path, cv2.VideoWriter_fourcc(*'MJPG'), SYNTHETIC_FPS, (width, height))
+    if not writer.isOpened():
+        raise IOError(f"Could not write {clip_path}")
+    truth = []
+    try:
+        for i, (cx, cy) in enumerate(centres):
+            x = int(round(cx - patchWidth / 2))
+            y = int(round(cy - patchHeight / 2))
+            frame = background.copy()
+            frame[y:y + patchHeight, x:x + patchWidth] = patch
+            noise = rng.normal(0, 4, frame.shape)
+            writer.write(np.clip(frame + noise, 0, 255).astype(np.uint8))
+            truth.append((i + 1, x, y, patchWidth, patchHeight))
+    finally:
+        writer.release()
+    pd.DataFrame(truth, columns=['Frame', 'x', 'y', 'width', 'height']).to_csv(ground_truth_path(clip_path),
+                                                                              index=False)
+
+
+def synthetic_clips(clip_dir, n_frames=SYNTHETIC_FRAMES, seed=0):
+    """Paths of the synthetic clips in clip_dir, making any that aren't there yet"""
+    os.makedirs(clip_dir, exist_ok=True)
+    clips = []
+    for i, motion in enumerate(SYNTHETIC_MOTIONS):
+        clipPath = os.path.join(clip_dir, f"synthetic_{motion}_{n_frames}f_seed{seed}.avi")
+        if not (os.path.exists(clipPath) and os.path.exists(ground_truth_path(clipPath))):
+            print(f"Making {clipPath}")
+            make_synthetic_clip(clipPath, motion, n_frames=n_frames, seed=seed + i)
+        clips.append(clipPath)
+    return clips
+
+
+def ground_truth_path(clip_path):
+    return os.path.splitext(clip_path)[0] + "_gt.csv"
+
+
+def read_ground_truth(clip_path):
+    """Ground truth boxes for a clip, as an array of (x, y, width, height) indexed by frame number (NaN on frames
+    without ground truth), and the first frame that has one"""
+    gtPath = ground_truth_path(clip_path)
+    if not os.path.exists(gtPath):
+        raise IOError(f"No ground truth for {clip_path} (expected {gtPath})")
+    gtdf = pd.read_csv(gtPath).sort_values('Frame')
+    truth = np.full((int(gtdf['Frame'].max()) + 1, 4), np.nan)
+    truth[gtdf['Frame'].to_numpy(dtype=int)] = gtdf[['x', 'y', 'width', 'height']].to_numpy(dtype=float)
+    return truth, int(gtdf['Frame'].iloc[0])
+
+
+def box_iou(boxes_a, boxes_b):
+    """Intersection over union of matching rows of two (n, 4) arrays of (x, y, width, height) boxes"""
+    ax, ay, aw, ah = boxes_a.T
+    bx, by, bw, bh = boxes_b.T
+    overlapX = np.minimum(ax + aw, bx + bw) - np.maximum(ax, bx)
+    overlapY = np.minimum(ay + ah, by + bh) - np.maximum(ay, by)
+    intersection = np.clip(overlapX, 0, None) * np.clip(overlapY, 0, None)
+    union = aw * ah + bw * bh - intersection
+    return np.where(union > 0, intersection / np.where(union > 0, union, 1), 0.0)
+
+
+def accuracy(boxes, truth):
+    """Accuracy of tracked boxes against the ground truth, on the frames that have both a ground truth and a tracked
+    frame. Frames the tracker reported lost (NaN boxes) count as IoU 0, and are left out of the centre error"""
+    nFrames = min(len(boxes), len(truth))
+    frames = ~np.isnan(truth[:nFrames, 0]) & ~np.isnan(boxes[:nFrames, 2])  # boxes[:, 2] is only NaN if never tracked
+    boxes = boxes[:nFrames][frames]
+    truth = truth[:nFrames][frames]
+    lost = np.isnan(boxes[:, 0])
+    iou = np.where(lost, 0.0, box_iou(np.nan_to_num(boxes), truth))
+    centreError = np.hypot(boxes[:, 0] + boxes[:, 2] / 2 - truth[:, 0] - truth[:, 2] / 2,
+                           boxes[:, 1] + boxes[:, 3] / 2 - truth[:, 1] - truth[:, 3] / 2)[~lost]
+    return {
+        'mean_iou': float(iou.mean()) if len(iou) else None,
+        'success_rate': float((iou >= SUCCESS_IOU).mean()) if len(iou) else None,
+        'centre_error_mean': float(centreError.mean()) if len(centreError) else None,
+        'centre_error_median': float(np.median(centreError)) if len(centreError) else None,
+        'lost_frames': int(lost.sum()),
+        'scored_frames': int(len(iou)),
+    }
+
+
+class PeakMemory(object):
+    """Peak memory of the process while a benchmark runs. With psutil, the resident set size is sampled by a
+    background thread; without it, the peak resident set size from resource (not on Windows); failing that, the peak
+    of Python's own allocations from tracemalloc, which doesn't see OpenCV's memory and so is only a lower bound"""
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.method = 'psutil' if psutil is not None else 'resource' if resource is not None else 'tracemalloc'
+        self.peak = 0
+        self.stopFlag = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.method == 'psutil':
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        elif self.method == 'tracemalloc':
+            import tracemalloc
+            tracemalloc.start()
+
+    def sample(self):
+        process = psutil.Process()
+        while not self.stopFlag.is_set():
+            self.peak = max(self.peak, process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def stop(self):
+        """Stop measuring and return the peak in bytes"""
+        if self.method == 'psutil':
+            self.stopFlag.set()
+            self.thread.join()
+            self.peak = max(self.peak, psutil.Process().memory_info().rss)
+        elif self.method == 'resource':
+            maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = maxRss if sys.platform == 'darwin' else maxRss * 1024  # bytes on macOS, KB elsewhere
+        else:
+            import tracemalloc
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return self.peak
+
+
+def tracker_available(profile):
+    """None if this OpenCV build can create the profile's tracker (both of them, for a hybrid), otherwise the reason it
+    can't"""
+    try:
+        create_profile_tracker(profile)
+    except (AttributeError, ValueError, cv2.error) as e:
+        return str(e).strip().splitlines()[-1] if str(e).strip() else type(e).__name__
+    return None
+
+
+def run_benchmark(job):
+    """Track one clip with one tracker, timing every update. Runs in its own process"""
+    if job['threads'] is not None:
+        cv2.setNumThreads(job['threads'])
+    truth, startFrame = read_ground_truth(job['clip'])
+    memory = PeakMemory()
+    memory.start()
+
+    cap = cv2.VideoCapture(job['clip'])
+    try:
+        frameCount = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if startFrame > 1:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, startFrame - 1)
+        ok, frame = cap.read()
+        if not ok:
+            raise IOError(f"Could not read frame {startFrame} of {job['clip']}")
+
+        # column 0 is NaN on lost frames, everything is NaN on frames that weren't tracked
+        boxes = np.full((max(frameCount, len(truth) - 1) + 1, 4), np.nan)
+        initBbox = tuple(int(round(v)) for v in truth[startFrame])
+        timeStart = time.perf_counter()
+        tracker = create_profile_tracker(job['profile'], **job['options'])
+        tracker.init(frame, initBbox)
+        initTime = time.perf_counter() - timeStart
+        boxes[startFrame] = initBbox
+
+        latencies = []
+        frameNumber = startFrame
+        while frameNumber < len(boxes) - 1:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            frameNumber += 1
+            timeStart = time.perf_counter()
+            ok, bbox = tracker.update(frame)
+            latencies.append(time.perf_counter() - timeStart)
+            boxes[frameNumber] = bbox if ok else (np.nan, 0, 0, 0)
+    finally:
+        cap.release()
+    peakMemory = memory.stop()
+
+    latencies = np.array(latencies) * 1000
+    result = {
+        'frames': len(latencies),
+        'fps': len(latencies) / (latencies.sum() / 1000) if latencies.sum() > 0 else None,
+        'init_ms': initTime * 1000,
+        'latency_ms_p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'latency_ms_p90': float(np.percentile(latencies, 90)) if len(latencies) else None,
+        'latency_ms_p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'latency_ms_max': float(latencies.max()) if len(latencies) else None,
+        'peak_memory_mb': peakMemory / 1024 ** 2,
+        'memory_method': memory.method,
+        'tracker_stats': getattr(tracker, 'stats', None),  # e.g. HybridTracker's verifications and drifts
+    }
+    result.update(accuracy(boxes, truth))
+    return result
+
+
+def run_job(job):
+    """Run one benchmark in a fresh process, returning its result row (with the error, if it failed)"""
+    row = {'clip': os.path.basename(job['clip']), 'tracker': job['tracker'], 'status': 'ok', 'error': ''}
+    try:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            row.update(pool.submit(run_benchmark, job).result())
+    except BrokenProcessPool:
+        row.update({'status': 'error', 'error': "tracker crashed the process"})
+    except Exception as e:
+        row.update({'status': 'error', 'error': str(e).strip().splitlines()[-1] if str(e).strip() else repr(e)})
+    return row
+
+
+def run_benchmarks(clips, trackers=TRACKER_TYPES, tracker_options=None, threads=None, profiles=None):
+    """Benchmark every tracker (type or profile name, looked up in profiles) on every clip. Returns a DataFrame with a
+    row per (clip, tracker); trackers this OpenCV build doesn't have get one row with status 'unavailable'"""
+    rows = []
+    for tracker in trackers:
+        try:
+            profile = resolve_profile(tracker, profiles)
+            reason = tracker_available(profile)
+        except ValueError as e:
+            profile, reason = None, str(e)
+        if reason is not None:
+            print(f"{tracker}: unavailable ({reason})")
+            rows.append({'clip': '', 'tracker': tracker, 'status': 'unavailable', 'error': reason})
+            continue
+        for clip in clips:
+            print(f"{tracker}: {os.path.basename(clip)}", end='', flush=True)
+            row = run_job({'clip': clip, 'tracker': tracker, 'profile': profile, 'options': tracker_options or {},
+                           'threads': threads})
+            print(f" - {row['fps'] or 0:.1f} fps, IoU {row['mean_iou'] or 0:.2f}" if row['status'] == 'ok'
+                  else f" - {row['error']}")
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def summarise(resultsdf, min_iou=None):
+    """One row per tracker: slowest speed, worst latency and memory, and worst accuracy over all the clips (a tracker
+    is only as good as it is on its hardest clip), fastest first. With min_iou, trackers whose mean IoU falls below it
+    on any clip are marked as not meeting the bar"""
+    okdf = resultsdf[resultsdf['status'] == 'ok']
+    if okdf.empty:
+        return pd.DataFrame()
+    summarydf = okdf.groupby('tracker').agg(
+        fps=('fps', 'min'), latency_ms_p50=('latency_ms_p50', 'max'), latency_ms_p99=('latency_ms_p99', 'max'),
+        peak_memory_mb=('peak_memory_mb', 'max'), mean_iou=('mean_iou', 'min'), success_rate=('success_rate', 'min'),
+        centre_error_mean=('centre_error_mean', 'max'), lost_frames=('lost_frames', 'sum'),
+        clips=('clip', 'count'))
+    nClips = okdf['clip'].nunique()
+    summarydf['all_clips'] = summarydf['clips'] == nClips
+    if min_iou is not None:
+        summarydf['meets_bar'] = summarydf['all_clips'] & (summarydf['mean_iou'] >= min_iou)
+    return summarydf.sort_values('fps', ascending=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the OpenCV trackers on clips with known ground truth")
+    parser.add_argument('clips', nargs='*', help="reference clips, each with a <clip>_gt.csv ground truth "
+                                                 "(columns Frame, x, y, width, height)")
+    parser.add_argument('--trackers', nargs='+', default=TRACKER_TYPES, metavar='TRACKER',
+                        help=f"tracker types or profile names to benchmark (default: all of "
+                             f"{', '.join(TRACKER_TYPES)})")
+    parser.add_argument('--profiles', default=None, help="json file of extra tracker profiles (default: "
+                                                         "tracker_profiles.json next to this program, if there is one)")
+    parser.add_argument('--no-synthetic', action='store_true', help="only use the reference clips")
+    parser.add_argument('--synthetic-frames', type=int, default=SYNTHETIC_FRAMES, help="frames per synthetic clip "
+                                                                                       f"(default: {SYNTHETIC_FRAMES})")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the synthetic clips (default: 0)")
+    parser.add_argument('--clip-dir', default='benchmark_clips', help="folder for the synthetic clips "
+                                                                      "(default: benchmark_clips)")
+    parser.add_argument('--search-pad', type=float, default=None, help="tracker search window padding, as in "
+                                                                       "tracking.py")
+    parser.add_argument('--scale', type=float, default=None, help="downscale the tracker input by this factor")
+    parser.add_argument('--gray', action='store_true', help="track on grayscale frames (not for GOTURN/VIT/RPN)")
+    parser.add_argument('--threads', type=int, default=None, help="OpenCV threads per run (default: OpenCV's own)")
+    parser.add_argument('--min-iou', type=float, default=None, help="accuracy bar: report the fastest tracker with at "
+                                                                    "least this mean IoU on every clip")
+    parser.add_argument('-o', '--output', default='tracker_benchmark.json', help="JSON file for the results "
+                                                                                 "(default: tracker_benchmark.json)")
+    args = parser.parse_args(argv)
+    # only the options given on the command line, so the rest come from each profile
+    trackerOptions = {name: value for name, value in (('search_pad', args.search_pad), ('scale', args.scale),
+                                                      ('grayscale', args.gray or None)) if value is not None}
+    try:
+        profiles = load_tracker_profiles(args.profiles)
+    except (OSError, ValueError) as e:
+        parser.error(f"Could not read the tracker profiles: {e}")
+
+    clips = list(args.clips)
+    if not args.no_synthetic:
+        clips += synthetic_clips(args.clip_dir, n_frames=args.synthetic_frames, seed=args.seed)
+    if not clips:
+        parser.error("no clips to benchmark (give reference clips, or leave out --no-synthetic)")
+    for clip in args.clips:
+        if not os.path.exists(ground_truth_path(clip)):
+            parser.error(f"no ground truth for {clip} (expected {ground_truth_path(clip)})")
+
+    resultsdf = run_benchmarks(clips, trackers=args.trackers, tracker_options=trackerOptions, threads=args.threads,
+                               profiles=profiles)
+    summarydf = summarise(resultsdf, min_iou=args.min_iou)
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.2f}'.format):
+        print()
+        print(resultsdf.drop(columns=['error', 'tracker_stats'], errors='ignore').to_string(index=False))
+        if not summarydf.empty:
+            print()
+            print("Per tracker (worst clip):")
+            print(summarydf.to_string())
+    if args.min_iou is not None and not summarydf.empty:
+        passed = summarydf[summarydf['meets_bar']]
+        if passed.empty:
+            print(f"\nNo tracker reached a mean IoU of {args.min_iou} on every clip")
+        else:
+            print(f"\nFastest tracker with a mean IoU of at least {args.min_iou} on every clip: {passed.index[0]} "
+                  f"({passed['fps'].iloc[0]:.1f} fps)")
+
+    report = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'opencv': cv2.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'seed': args.seed,
+        'synthetic_frames': None if args.no_synthetic else args.synthetic_frames,
+        'tracker_options': trackerOptions,
+        'profiles': {name: profiles[name] for name in args.trackers if name in profiles},
+        'threads': args.threads,
+        'min_iou': args.min_iou,
+        'results': json.loads(resultsdf.to_json(orient='records')),
+        'summary': json.loads(summarydf.reset_index().to_json(orient='records')) if not summarydf.empty else [],
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {args.output}")
+    return 0 if (resultsdf['status'] != 'error').all() else 1
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # needed for the worker processes when built with pyinstaller
+    sys.exit(main())
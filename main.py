@@ -1,14 +1,36 @@
+import os
+import queue
 import sys
+import time
 from PySide6 import QtWidgets, QtGui
 from PySide6.QtCore import QThread, Signal, Slot, Qt, QEvent, QCoreApplication, QMetaObject, QSize
 from PySide6.QtGui import QFont
-from PySide6.QtWidgets import QGridLayout, QLabel, QHBoxLayout, QPushButton, QSizePolicy, QSlider, QWidget
+from PySide6.QtWidgets import QComboBox, QGridLayout, QLabel, QHBoxLayout, QPushButton, QSizePolicy, QSlider, QWidget
 # from videoAnalysis_ui import UiMainWindow
 import cv2  # via opencv-python AND opencv-contrib-python (for other trackers)
 import numpy as np
-import pandas as pd
 import pyqtgraph as pg
 
+from tracking import (backup_trace, checkpoint_path, create_profile_tracker, format_report, load_checkpoint,
+                      load_tracker_profiles, match_template, open_trace_writer, remove_checkpoint, resolve_profile,
+                      save_trace as save_trace_file, trace_metadata, Checkpointer, HybridTracker, TraceStore,
+                      TrackingPipeline, DEFAULT_PROFILE, MIN_MATCH_SCORE, PARQUET_AVAILABLE, TRACKER_PROFILES,
+                      TRACKER_TYPES)
+
+PREVIEW_MAX_FPS = 30  # most frames per second drawn to the screen while tracking
+PREVIEW_EVERY = 1  # only draw every Nth frame while tracking (1 to allow every frame, up to PREVIEW_MAX_FPS)
+PIPELINE_QUEUE_SIZE = 8  # frames buffered between the decode, track and write stages
+TRACKER_OPTIONS = {  # defaults for the input options, for profiles that don't set them
+    'search_pad': None,  # track in a window this many box sizes around the last box (None for the whole frame)
+    'scale': 1.0,  # downscale frames by this factor before tracking
+    'grayscale': False,  # track on grayscale frames
+}
+PLOT_REFRESH_INTERVAL = 0.1  # seconds between trace graph updates while tracking (i.e. 10 Hz)
+PLOT_SEGMENT_LENGTH = 10000  # frames per trace line before it's frozen and a new line is started
+TRACE_AUTOSAVE_FORMAT = '.npz'  # trace streamed to <video>_trace.npz while tracking, so a crash doesn't lose it
+# ('.parquet' needs pyarrow; None to not autosave)
+CHECKPOINT_INTERVAL = 30.0  # seconds between checkpoints (<video>_trace.checkpoint.npz) while tracking, for resuming
+
 
 # Note: to build the exe, pyinstaller is required. Once installed, go to Windows terminal, navigate to folder with
 # target script, and enter:
@@ -20,24 +42,87 @@ import pyqtgraph as pg
 # https://learnopencv.com/object-tracking-using-opencv-cpp-python/
 class VideoThread(QThread):
     # How to display opencv video in pyqt apps: https://gist.github.com/docPhil99/ca4da12c9d6f29b9cea137b617c7b8b1
-    change_pixmap_signal = Signal(np.ndarray, int)
-
-    def __init__(self, cap, tracker):
+    # Runs the decode -> track -> write pipeline off the GUI thread. Per-frame results are small, so every one of them
+    # is queued for the GUI; frames themselves are only handed over for display, through a one-frame buffer that
+    # always holds the newest frame. Each signal is only emitted once the GUI has taken what was there before, so
+    # nothing piles up in the Qt signal queue
+    results_ready = Signal()
+    preview_ready = Signal()
+
+    def __init__(self, cap, tracker, trace, vid_height, frame_count, preview_max_fps=PREVIEW_MAX_FPS,
+                 preview_every=PREVIEW_EVERY, trace_writer=None, checkpointer=None):
         super().__init__()
-        self.run_flag = False
         self.cap = cap
         self.tracker = tracker
+        self.preview_max_fps = preview_max_fps
+        self.preview_every = preview_every
+        self.pipeline = TrackingPipeline(cap, tracker, trace, vid_height, frame_count, queue_size=PIPELINE_QUEUE_SIZE,
+                                         on_result=self.offer_result, on_frame=self.offer_frame,
+                                         trace_writer=trace_writer, checkpointer=checkpointer)
+
+        self.resultQueue = queue.Queue()  # (frame number, bbox, ok, confidence) for every tracked frame
+        self.previewBuffer = queue.Queue(maxsize=1)  # (frame, result) for the newest frame to display
+        self.resultsPending = False
+        self.previewPending = False
+        self.lastPreview = 0
+
+    @property
+    def lastFrame(self):
+        """Last frame tracked, for restarting the tracker after a pause"""
+        return self.pipeline.lastFrame
 
     def run(self):
-        self.run_flag = True
-        while self.run_flag:
-            ret, cv_img = self.cap.read()
-            if ret:
-                self.change_pixmap_signal.emit(cv_img, int(self.cap.get(cv2.CAP_PROP_POS_FRAMES)))
+        try:
+            self.pipeline.run()
+        except Exception as e:
+            print(f"Tracking stopped: {e}")
+
+    def offer_result(self, result):
+        """Queue a tracked result for the GUI (called from the pipeline's write stage)"""
+        self.resultQueue.put(result)
+        if not self.resultsPending:
+            self.resultsPending = True
+            self.results_ready.emit()
+
+    def offer_frame(self, cv_img, result):
+        """Pass a tracked frame on for display, if the preview rate allows (called from the pipeline's track stage)"""
+        now = time.perf_counter()
+        if result[0] % self.preview_every == 0 and now - self.lastPreview >= 1 / self.preview_max_fps:
+            self.offer_preview(cv_img, result)
+            self.lastPreview = now
+
+    def offer_preview(self, cv_img, result):
+        """Replace whatever is in the preview buffer with this frame, and tell the GUI if it isn't already waiting"""
+        try:
+            self.previewBuffer.get_nowait()
+        except queue.Empty:
+            pass
+        self.previewBuffer.put_nowait((cv_img, result))
+        if not self.previewPending:
+            self.previewPending = True
+            self.preview_ready.emit()
+
+    def take_results(self):
+        """Empty the result queue, returning the results in frame order. Called from the GUI thread"""
+        self.resultsPending = False
+        results = []
+        while True:
+            try:
+                results.append(self.resultQueue.get_nowait())
+            except queue.Empty:
+                return results
+
+    def take_preview(self):
+        """Newest (frame, result) from the preview buffer, or None if it has already been taken. Called from the GUI"""
+        self.previewPending = False
+        try:
+            return self.previewBuffer.get_nowait()
+        except queue.Empty:
+            return None
 
     def stop(self):
-        """Sets run flag to False and waits for thread to finish"""
-        self.run_flag = False
+        """Stops decoding and waits for the frames already decoded to be tracked"""
+        self.pipeline.stop()
         self.wait()
 
     def close(self):
@@ -53,6 +138,7 @@ class UiMainWindow(object):
         self.videoFrame = None
 
         self.loadVideoButton = None
+        self.profileComboBox = None
         self.playVideoButton = None
         self.boundingBoxButton = None
         self.saveTraceButton = None
@@ -181,6 +267,12 @@ class UiMainWindow(object):
         self.loadVideoButton.setMaximumHeight(30)
         self.gridLayout.addWidget(self.loadVideoButton, 2, 0, 1, 1)
 
+        self.profileComboBox = QComboBox(self.centralwidget)
+        self.profileComboBox.setObjectName(u"profileComboBox")
+        self.profileComboBox.setSizePolicy(sizePolicy_minEx_max)
+        self.profileComboBox.setMaximumHeight(30)
+        self.gridLayout.addWidget(self.profileComboBox, 2, 1, 1, 1)
+
         self.playVideoButton = QPushButton(self.centralwidget)
         self.playVideoButton.setObjectName(u"playVideoButton")
         self.playVideoButton.setSizePolicy(sizePolicy_minEx_max)
@@ -233,6 +325,7 @@ class UiMainWindow(object):
         self.saveTraceButton.setText(QCoreApplication.translate("mainwindow", u"Save Trace", None))
         self.boundingBoxButton.setText(QCoreApplication.translate("mainwindow", u"Set Bounding Box", None))
         self.loadVideoButton.setText(QCoreApplication.translate("mainwindow", u"Load Video", None))
+        self.profileComboBox.setToolTip(QCoreApplication.translate("mainwindow", u"Tracker profile", None))
         self.frameForwardButton.setText(QCoreApplication.translate("mainwindow", u">", None))
         self.timeStartLabel.setText(QCoreApplication.translate("mainwindow", u"0:00:00.0000", None))
         self.timeEndLabel.setText(QCoreApplication.translate("mainwindow", u"0:00:00.0000", None))
@@ -255,6 +348,22 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
         self.boundingBoxButton.clicked.connect(lambda: self.set_box())
         self.saveTraceButton.clicked.connect(lambda: self.save_trace())
 
+        # tracker profiles: the built-in ones plus any in tracker_profiles.json, then the plain tracker types
+        try:
+            self.trackerProfiles = load_tracker_profiles()
+        except (OSError, ValueError) as e:
+            print(f"Could not read the tracker profiles: {e}")
+            self.trackerProfiles = dict(TRACKER_PROFILES)
+        for name, profile in self.trackerProfiles.items():
+            self.profileComboBox.addItem(name)
+            self.profileComboBox.setItemData(self.profileComboBox.count() - 1,
+                                             f"{profile['tracker']}: {profile.get('description', '')}",
+                                             Qt.ItemDataRole.ToolTipRole)
+        self.profileComboBox.insertSeparator(self.profileComboBox.count())
+        self.profileComboBox.addItems(TRACKER_TYPES)
+        self.profileComboBox.setCurrentText(DEFAULT_PROFILE)
+        self.profileComboBox.currentTextChanged.connect(self.select_profile)
+
         # disable buttons until video is loaded
         self.trackingSlider.setEnabled(False)
         self.frameBackButton.setEnabled(False)
@@ -274,6 +383,7 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
         self.vidHeight = None
         self.frameCurrent = None
         self.frameCurrentNumber = None
+        self.frameCount = None
 
         self.bbox = None  # current position of tracker
         self.bboxOriginal = None  # original position of tracker
@@ -281,18 +391,17 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
 
         self.tracker = None  # selection of tracker type
 
-        # tracker trace variables
-        # tl is trackerLog
-        self.tlFrame = None
-        self.tlx1 = None
-        self.tlx2 = None
-        self.tly1 = None
-        self.tly2 = None
-        self.tlxMid = None
-        self.tlyMid = None
-
-        self.tlxLine = None
+        # tracker trace (TraceStore, one row per frame number)
+        self.trace = None
+        self.traceWriter = None  # streams the trace to disk while tracking (see TRACE_AUTOSAVE_FORMAT)
+        self.checkpointer = None  # saves checkpoints to resume from while tracking (see CHECKPOINT_INTERVAL)
+        self.videoPath = None
+        self.trackerProfile = DEFAULT_PROFILE  # profile name (or tracker type) from profileComboBox
+
+        self.tlxLine = None  # lines for the segment of the trace currently being tracked
         self.tlyLine = None
+        self.tlSegmentStart = None  # first frame of the current segment
+        self.tlLastPlot = 0  # time of the last trace graph update
         # self.tlChart = None
         # self.tlChartXAxis = None
         # self.tlChartYAxis = None
@@ -320,12 +429,16 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
             self.thread.stop()
         if hasattr(self.thread, 'close'):
             self.thread.close()
+        self.close_trace_writer()
 
     def load_video(self):
         fileName = QtWidgets.QFileDialog.getOpenFileName(self, 'Open Video')
         if fileName[0]:
             fileName = fileName[0]
 
+            self.close_trace_writer()
+            self.checkpointer = None
+            self.videoPath = fileName
             self.cap = cv2.VideoCapture(fileName)
             if not self.cap.isOpened():
                 QtWidgets.QMessageBox.critical(self, "Error", "Could not read video file",
@@ -340,18 +453,13 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
                     # get stats - framerate, length
                     self.videoFrameRate = self.cap.get(cv2.CAP_PROP_FPS)
                     frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                    self.frameCount = frame_count
                     endStamp = self.get_time_from_frame(frame_count)
                     self.timeEndLabel.setText(endStamp)
                     self.trackingSlider.setMaximum(frame_count)
 
-                    # create blank trace vars
-                    self.tlFrame = list(range(frame_count))
-                    self.tlx1 = frame_count * [0]
-                    self.tlx2 = frame_count * [0]
-                    self.tly1 = frame_count * [0]
-                    self.tly2 = frame_count * [0]
-                    self.tlxMid = frame_count * [0]
-                    self.tlyMid = frame_count * [0]
+                    # create blank trace
+                    self.trace = TraceStore(frame_count)
 
                     # enable buttons
                     self.trackingSlider.setEnabled(True)
@@ -374,11 +482,11 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
 
                     self.videoFrame.installEventFilter(self)
 
+                    self.traceGraph.clear()
                     self.traceGraph.setXRange(0, frame_count)
-                    xPen = pg.mkPen(color=(60, 100, 160))
-                    yPen = pg.mkPen(color=(160, 60, 60))
-                    self.tlxLine = self.traceGraph.plot(self.tlFrame, self.tlxMid, pen=xPen)
-                    self.tlyLine = self.traceGraph.plot(self.tlFrame, self.tlyMid, pen=yPen)
+                    self.new_trace_segment(self.frameCurrentNumber)
+
+                    self.offer_resume()
                     # self.tlChart = QtCharts.QChart()
                     # self.tlxLine = QtCharts.QLineSeries()
                     # self.tlyLine = QtCharts.QLineSeries()
@@ -408,32 +516,18 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
                     # # self.tlChart.addSeries(test)
                     # # self.traceGraph.setChart(self.tlChart)
 
-    def select_tracker(self, tracker_type):
-
-        if tracker_type == 'BOOSTING':
-            self.tracker = cv2.legacy.TrackerBoosting.create()
-        if tracker_type == 'MIL':
-            self.tracker = cv2.TrackerMIL.create()
-        if tracker_type == 'KCF':
-            self.tracker = cv2.TrackerKCF.create()
-        if tracker_type == 'TLD':
-            self.tracker = cv2.legacy.TrackerTLD.create()
-        if tracker_type == 'MEDIANFLOW':
-            self.tracker = cv2.legacy.TrackerMedianFlow.create()
-        if tracker_type == 'GOTURN':
-            self.tracker = cv2.TrackerGOTURN.create()
-        if tracker_type == 'MOSSE':
-            self.tracker = cv2.legacy.TrackerMOSSE.create()
-        if tracker_type == "CSRT":
-            self.tracker = cv2.TrackerCSRT.create()
-        if tracker_type == "VIT":
-            self.tracker = cv2.TrackerVit.create()
-        if tracker_type == "RPN":
-            self.tracker = cv2.TrackerDaSiamRPN.create()
+    def select_tracker(self, profile):
+        self.tracker = create_profile_tracker(profile, self.trackerProfiles, defaults=TRACKER_OPTIONS)
+        if isinstance(self.tracker, HybridTracker) and self.bboxImage is not None:
+            self.tracker.template = self.bboxImage  # verify against the original selection, even after a pause
+
+    def select_profile(self, profile):
+        self.trackerProfile = profile
 
     def set_box(self):
         # self.bbox = (1261, 586, 60, 72)
-        frameCopy = self.frameCurrent  # make a copy of the frame and add the rectangle to it rather than the original
+        frameClean = self.frameCurrent
+        frameCopy = frameClean.copy()  # make a copy of the frame and add the rectangle to it rather than the original
 
         # set up instruction text
         boxInstr = "Select object to track with left mouse button, press Enter when finished"
@@ -455,19 +549,71 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
             p2 = (int(self.bbox[0] + self.bbox[2]), int(self.bbox[1] + self.bbox[3]))
             cv2.rectangle(frameCopy, p1, p2, (255, 0, 0), 2, 1)
             self.update_image(frameCopy, self.frameCurrentNumber)
-            self.tlx1[self.frameCurrentNumber] = int(self.bbox[0])
-            self.tlx2[self.frameCurrentNumber] = int(self.bbox[0] + self.bbox[2])
-            self.tly1[self.frameCurrentNumber] = self.vidHeight - int(self.bbox[1])
-            self.tly2[self.frameCurrentNumber] = self.vidHeight - int(self.bbox[1] + self.bbox[3])
-            self.tlxMid[self.frameCurrentNumber] = int(self.bbox[1] + self.bbox[3] / 2)
-            self.tlyMid[self.frameCurrentNumber] = int(self.bbox[0] + self.bbox[2] / 2)
+            self.frameCurrent = frameClean  # the tracker and template need the frame without the drawing on it
+            self.trace.record(self.frameCurrentNumber, self.bbox, self.vidHeight)
 
             self.bboxOriginal = self.bbox  # capture ROI location
             self.bboxImage = self.frameCurrent[self.bbox[1]:self.bbox[1]+self.bbox[3],
-                                               self.bbox[0]:self.bbox[0]+self.bbox[2]]
+                                               self.bbox[0]:self.bbox[0]+self.bbox[2]].copy()
         else:
             print("No ROI selected")
 
+    def offer_resume(self):
+        """If an earlier analysis of this video left a checkpoint behind (it crashed or the window was closed before the
+        trace was saved), offer to carry on from it"""
+        checkpointPath = self.checkpoint_path()
+        if not os.path.exists(checkpointPath):
+            return
+        try:
+            checkpoint = load_checkpoint(checkpointPath)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not read the checkpoint {checkpointPath}: {e}")
+            return
+        answer = QtWidgets.QMessageBox.question(self, "Resume analysis",
+                                                f"The analysis of this video was interrupted at frame "
+                                                f"{checkpoint['frame']} of {self.frameCount} (checkpoint saved "
+                                                f"{checkpoint['saved']}).\n\nResume from there?")
+        if answer == QtWidgets.QMessageBox.StandardButton.Yes:
+            self.resume_checkpoint(checkpoint)
+
+    def resume_checkpoint(self, checkpoint):
+        """Restore the trace from a checkpoint and go to its frame, ready to carry on with Analyze"""
+        frameNumber = checkpoint['frame']
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frameNumber - 1)
+        ok, frame = self.cap.read()
+        if not ok:
+            QtWidgets.QMessageBox.critical(self, "Error", f"Could not read frame {frameNumber} to resume from",
+                                           QtWidgets.QMessageBox.StandardButton.Ok)
+            return
+        rows = checkpoint['trace'][:len(self.trace)]
+        self.trace.data[:len(rows)] = rows
+
+        self.bbox = checkpoint['bbox']
+        self.bboxImage = checkpoint['template']
+        found = True
+        if not checkpoint['ok'] and self.bboxImage is not None:
+            # the tracker had lost the object, so find it again from the original selection
+            bbox, score = match_template(frame, self.bboxImage)
+            found = score >= MIN_MATCH_SCORE
+            if found:
+                self.bbox = bbox
+                self.trace.record(frameNumber, self.bbox, self.vidHeight)
+        self.bboxOriginal = tuple(checkpoint['metadata'].get('bbox') or self.bbox)
+        if self.profileComboBox.findText(checkpoint['metadata'].get('tracker') or '') >= 0:
+            self.profileComboBox.setCurrentText(checkpoint['metadata']['tracker'])
+
+        self.update_image(frame, frameNumber)
+        self.new_trace_segment(1)
+        self.update_trace_plot(frameNumber, force=True)
+        if not found:
+            QtWidgets.QMessageBox.information(self, "Resume",
+                                              f"The object was lost at frame {frameNumber} and can't be found "
+                                              f"there again (best match {score:.2f}). Set the bounding box on it "
+                                              "to carry on.",
+                                              QtWidgets.QMessageBox.StandardButton.Ok)
+            return
+        self.playVideoButton.setEnabled(True)
+
     def frame_jump(self, num_frames):
         # button clicked to set frame number forward or back a certain number
         targetFrame = self.trackingSlider.value() + self.trackingSlider.singleStep() * num_frames
@@ -500,25 +646,69 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
         self.frameCurrentNumber = targetFrame
 
     def save_trace(self):
-        fileName = QtWidgets.QFileDialog.getSaveFileName(self, 'Save Trace', '',
-                                                         "CSV Files (*.csv);;Excel Files (*.xlsx *.xls);;All files ("
-                                                         "*.*)")
+        fileTypes = "CSV Files (*.csv);;NumPy Trace (*.npz)"
+        if PARQUET_AVAILABLE:
+            fileTypes += ";;Parquet Trace (*.parquet)"
+        fileName = QtWidgets.QFileDialog.getSaveFileName(self, 'Save Trace', '', fileTypes)
         if fileName[0]:
-            data = {
-                "x1": self.tlx1,
-                "x2": self.tlx2,
-                "y1": self.tly1,
-                "y2": self.tly2,
-                "xMid": self.tlxMid,
-                "yMid": self.tlyMid
-            }
-            outputData = pd.DataFrame(data, index=self.tlFrame)
+            filePath = fileName[0]
+            if not os.path.splitext(filePath)[1]:
+                filePath += fileName[1].split("(*")[-1].rstrip(")")  # extension of the selected file type
+            autosaving = (self.traceWriter is not None and
+                          os.path.abspath(filePath) == os.path.abspath(self.traceWriter.file_path))
+            if autosaving:
+                QtWidgets.QMessageBox.warning(self, "Save Trace",
+                                              f"{filePath} is where the trace is being autosaved (it's complete there "
+                                              "once the video is closed). Save it under another name.",
+                                              QtWidgets.QMessageBox.StandardButton.Ok)
+                return
             # outputData["y2"] = self.vidHeight - outputData["y2"]
             # outputData["y1"] = self.vidHeight - outputData["y1"]
             # outputData["xMid"] = (outputData["x1"] + outputData["x2"]) / 2
             # outputData["yMid"] = (outputData["y1"] + outputData["y2"]) / 2
 
-            outputData.to_csv(fileName[0])
+            save_trace_file(self.trace, filePath, self.trace_metadata())
+            # the trace is safe now, so there's nothing to resume next time
+            remove_checkpoint(self.checkpoint_path())
+
+    def trace_metadata(self):
+        profile = resolve_profile(self.trackerProfile, self.trackerProfiles)
+        return trace_metadata(self.videoPath, fps=self.videoFrameRate, tracker_type=self.trackerProfile,
+                              bbox=self.bboxOriginal, vid_height=self.vidHeight, frame_count=self.frameCount,
+                              profile=profile, tracker_options=dict(TRACKER_OPTIONS, **profile.get('options', {})))
+
+    def checkpoint_path(self):
+        return checkpoint_path(os.path.splitext(self.videoPath)[0] + "_trace.npz")
+
+    def open_checkpointer(self):
+        """Start saving checkpoints for this video, unless it's already being checkpointed"""
+        if self.checkpointer is None and CHECKPOINT_INTERVAL:
+            self.checkpointer = Checkpointer(self.checkpoint_path(), template=self.bboxImage,
+                                             metadata=self.trace_metadata(), bbox=self.bbox,
+                                             interval=CHECKPOINT_INTERVAL)
+        return self.checkpointer
+
+    def open_trace_writer(self):
+        """Start streaming the trace to <video>_trace.npz (TRACE_AUTOSAVE_FORMAT), unless it's already open. A trace
+        left there by an earlier session is kept, as <video>_trace.1.npz etc. (see backup_trace)"""
+        if self.traceWriter is None and TRACE_AUTOSAVE_FORMAT and self.videoPath:
+            autosavePath = os.path.splitext(self.videoPath)[0] + "_trace" + TRACE_AUTOSAVE_FORMAT
+            try:
+                backupPath = backup_trace(autosavePath)
+                if backupPath:
+                    print(f"Moved the previous autosaved trace to {backupPath}")
+                self.traceWriter = open_trace_writer(autosavePath, self.trace_metadata())
+                # include anything already in the trace (i.e. after resuming from a checkpoint)
+                self.traceWriter.start_segment(1)
+                self.traceWriter.write_until(self.trace, self.frameCurrentNumber - 1, force=True)
+            except (OSError, ImportError) as e:
+                print(f"Could not autosave the trace to {autosavePath}: {e}")
+        return self.traceWriter
+
+    def close_trace_writer(self):
+        if self.traceWriter is not None:
+            self.traceWriter.close()
+            self.traceWriter = None
 
     def analyze_start(self):
         # update the play button
@@ -529,15 +719,21 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
         self.frameBackButton.setEnabled(False)
         self.frameForwardButton.setEnabled(False)
         self.trackingSlider.setEnabled(False)
+        self.profileComboBox.setEnabled(False)
 
         # create the tracker
-        self.select_tracker("MIL")
+        self.select_tracker(self.trackerProfile)
         _ = self.tracker.init(self.frameCurrent, self.bbox)
-
-        # create the video capture thread
-        self.thread = VideoThread(self.cap, self.tracker)
-        # connect its signal to the update_image slot
-        self.thread.change_pixmap_signal.connect(self.update_tracker)
+        self.new_trace_segment(self.frameCurrentNumber)
+
+        # create the video capture and tracking thread
+        self.thread = VideoThread(self.cap, self.tracker, self.trace, self.vidHeight, self.frameCount,
+                                  trace_writer=self.open_trace_writer(), checkpointer=self.open_checkpointer())
+        if self.checkpointer is not None:
+            self.checkpointer.metadata = self.trace_metadata()  # the profile may have changed since the last run
+        # connect its signals to the trace and display slots
+        self.thread.results_ready.connect(self.update_tracker)
+        self.thread.preview_ready.connect(self.update_preview)
         # start the thread
         self.thread.start()
 
@@ -546,11 +742,23 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
         self.playVideoButton.clicked.connect(self.analyze_start)
         self.playVideoButton.setText("Analyze")
         self.thread.stop()
+        self.thread.results_ready.disconnect(self.update_tracker)
+        self.thread.preview_ready.disconnect(self.update_preview)
+        # record whatever was tracked since the last update, and restart from the last tracked frame next time
+        self.update_tracker()
+        if self.thread.lastFrame is not None:
+            # show the last tracked frame under its own frame number (a pending preview may be older)
+            self.thread.take_preview()
+            self.update_image(self.thread.lastFrame, self.thread.pipeline.lastFrameNumber)
+        print(format_report(self.thread.pipeline.report()))
+        if hasattr(self.tracker, 'stats'):
+            print(f"Tracker: {self.tracker.stats}")
 
         self.frameBackButton.setEnabled(True)
         self.frameForwardButton.setEnabled(True)
         self.trackingSlider.setEnabled(True)
-        self.thread.change_pixmap_signal.disconnect(self.update_tracker)
+        self.profileComboBox.setEnabled(True)
+        self.update_trace_plot(self.frameCurrentNumber, force=True)
 
     @Slot(np.ndarray)
     def update_image(self, cv_img, frame_number):
@@ -571,57 +779,77 @@ class MainWindow(QtWidgets.QMainWindow, UiMainWindow):
                                         Qt.AspectRatioMode.KeepAspectRatio)
         return QtGui.QPixmap.fromImage(p)
 
-    def update_tracker(self, frame, frame_number):
-        # now update the tracker
+    def update_tracker(self):
+        """Catch up with the results the video thread has tracked (and already recorded in the trace) since the last
+        update"""
         # frameGray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         # # blur = cv2.GaussianBlur(videoGray, (5, 5), 0)
         # ret, thresh = cv2.threshold(frameGray, 0, 255, cv2.THRESH_BINARY)
-        if frame_number <= int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)):
-
-            # # Start timer
-            # timer = cv2.getTickCount()
-
-            # Update tracker
-            ok, self.bbox = self.tracker.update(frame)
-
-            # # Calculate Frames per second (FPS)
-            # fps = cv2.getTickFrequency() / (cv2.getTickCount() - timer)
-
-            # Draw bounding box
+        results = self.thread.take_results()
+        for frame_number, bbox, ok, confidence in results:
             if ok:
                 # Tracking success
-                p1 = (int(self.bbox[0]), int(self.bbox[1]))
-                p2 = (int(self.bbox[0] + self.bbox[2]), int(self.bbox[1] + self.bbox[3]))
-                self.tlx1[frame_number] = int(self.bbox[0])
-                self.tlx2[frame_number] = int(self.bbox[0] + self.bbox[2])
-                self.tly1[frame_number] = self.vidHeight - int(self.bbox[1])
-                self.tly2[frame_number] = self.vidHeight - int(self.bbox[1] + self.bbox[3])
-                self.tlxMid[frame_number] = int(self.bbox[1] + self.bbox[3] / 2)
-                self.tlyMid[frame_number] = int(self.bbox[0] + self.bbox[2] / 2)
-                # row = [frameCount, bbox[0], bbox[1], bbox[2], bbox[3]]
-                # boxLog.append(row)
-                # xMid = int(self.bbox[0] + self.bbox[2] / 2)
-                # yMid = int(self.bbox[1] + self.bbox[3] / 2)
-                cv2.rectangle(frame, p1, p2, (255, 0, 0), 2, 1)
-
-                self.tlxLine.setData(self.tlFrame, self.tlxMid)
-                self.tlyLine.setData(self.tlFrame, self.tlyMid)
-
-                # self.traceGraph.update()
-
-            else:
-                # Tracking failure
-                cv2.putText(frame, "Tracking failure detected", (100, 80), cv2.FONT_HERSHEY_SIMPLEX, 0.75,
-                            (0, 0, 255), 2)
-
-            # Display tracker type on frame
-            cv2.putText(frame, "Frame: " + str(int(frame_number)), (100, 20), cv2.FONT_HERSHEY_SIMPLEX, 1,
-                        (50, 170, 50), 2)
-
-            # Display result
-            self.update_image(frame, frame_number)
+                self.bbox = bbox
 
+        if results:
+            self.frameCurrentNumber = results[-1][0]
             # Update chart
+            self.update_trace_plot(self.frameCurrentNumber)
+
+    def update_preview(self):
+        """Display the newest tracked frame from the video thread, with the tracked box drawn on it"""
+        preview = self.thread.take_preview()
+        if preview is None:
+            return
+        frame, (frame_number, bbox, ok, _) = preview
+
+        # draw on a copy, the thread keeps the clean frame for restarting the tracker
+        frame = frame.copy()
+        if ok:
+            # Draw bounding box
+            p1 = (int(bbox[0]), int(bbox[1]))
+            p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
+            cv2.rectangle(frame, p1, p2, (255, 0, 0), 2, 1)
+        else:
+            cv2.putText(frame, "Tracking failure detected", (100, 80), cv2.FONT_HERSHEY_SIMPLEX, 0.75,
+                        (0, 0, 255), 2)
+
+        # Display tracker type on frame
+        cv2.putText(frame, "Frame: " + str(int(frame_number)), (100, 20), cv2.FONT_HERSHEY_SIMPLEX, 1,
+                    (50, 170, 50), 2)
+
+        # Display result, but keep frameCurrent as the clean frame
+        frameCurrent = self.frameCurrent
+        self.update_image(frame, frame_number)
+        self.frameCurrent = frameCurrent
+
+    def new_trace_segment(self, start_frame):
+        """Start a new pair of trace lines at start_frame. Earlier segments stay on the graph but are never passed to
+        setData again, so each graph update only costs as much as the current segment"""
+        xPen = pg.mkPen(color=(60, 100, 160))
+        yPen = pg.mkPen(color=(160, 60, 60))
+        self.tlxLine = self.traceGraph.plot(pen=xPen)
+        self.tlyLine = self.traceGraph.plot(pen=yPen)
+        for line in (self.tlxLine, self.tlyLine):
+            line.setClipToView(True)
+            line.setDownsampling(auto=True, method='peak')
+        self.tlSegmentStart = start_frame
+        self.tlLastPlot = 0
+
+    def update_trace_plot(self, frame_number, force=False):
+        """Redraw the current trace segment up to frame_number, at most every PLOT_REFRESH_INTERVAL seconds"""
+        now = time.perf_counter()
+        if not force and now - self.tlLastPlot < PLOT_REFRESH_INTERVAL:
+            return
+        self.tlLastPlot = now
+
+        segment = slice(self.tlSegmentStart, frame_number + 1)
+        self.tlxLine.setData(self.trace.frames[segment], self.trace['xMid'][segment])
+        self.tlyLine.setData(self.trace.frames[segment], self.trace['yMid'][segment])
+
+        if frame_number - self.tlSegmentStart >= PLOT_SEGMENT_LENGTH:
+            # freeze this segment; the next one starts on its last frame so the line stays continuous
+            self.new_trace_segment(frame_number)
 
     def get_time_from_frame(self, framenumber):
         # return time as string (with commented lines for returning as datetime)
@@ -1,19 +1,27 @@
 import json  # for retrieving video original audio fs
 import os
+import queue
+import shutil
 import subprocess  # for retrieving video original audio fs
 import sys
+import threading
+import time
+from collections import OrderedDict
 
 import cv2  # via opencv-python
 import numpy as np
 import pandas as pd  # for exporting the trial times
 import pyqtgraph as pg  # for graphing the audio
-from PySide6.QtCore import QThread, Signal, Slot, Qt, QEvent, QCoreApplication, QMetaObject, QSize, QProcess
+from PySide6.QtCore import (QThread, Signal, Slot, Qt, QEvent, QCoreApplication, QMetaObject, QSize, QProcess,
+                            QObject)
 from PySide6.QtGui import QColor, QBrush, QPixmap, QImage, QPainter
 from PySide6.QtWidgets import (QApplication, QMainWindow, QGridLayout, QLabel, QHBoxLayout, QPushButton, QSizePolicy,
                                QSlider, QWidget, QLineEdit, QTableWidget, QHeaderView, QTableWidgetItem,
                                QAbstractItemView, QStatusBar, QSpinBox, QAbstractSpinBox, QFrame, QMessageBox,
                                QProgressBar, QFileDialog, QDialog, QVBoxLayout)
 
+from media_cache import MediaCache
+
 # import re  # parsing ffmpeg output for progress
 
 __version__ = '2.5'
@@ -23,6 +31,34 @@ __version__ = '2.5'
 # > python -m PyInstaller main_trim.py -n TrialTrim
 # where -n specifies the resulting exe name
 
+PREVIEW_MAX_FPS = 30  # most frames per second drawn to the screen during playback
+FRAME_CACHE_BYTES = 512 * 1024 ** 2  # memory for decoded frames kept around the scrub position
+FRAME_CACHE_MAX_WIDTH = 1280  # cached frames are downscaled to at most this width (they're only for display)
+READ_AHEAD_FRAMES = 30  # frames decoded in the background after the scrub position
+READ_BEHIND_FRAMES = 30  # and before it
+THUMBNAIL_INTERVAL = 1.0  # seconds between thumbnails shown while dragging the slider
+THUMBNAIL_WIDTH = 320  # pixels
+AUDIO_BIN_SAMPLES = 256  # audio samples per min/max bin of the waveform envelope
+AUDIO_CHUNK_SAMPLES = 1 << 20  # audio samples read from ffmpeg at a time while building the envelope
+WAVEFORM_PYRAMID_FACTOR = 4  # bins merged into one at each coarser level of the waveform pyramid
+CLIP_WORKERS = None  # ffmpeg processes to run at once when clipping (None to choose from the number of cores)
+CLIP_RETRIES = 1  # times to retry a clip that fails
+CLIP_LOG_NAME = "clip_log.jsonl"  # progress and timing of every clip export, one json record per line, in the output
+# folder (None to not log)
+CLIP_EXPORT_MODE = 'seek'  # 'seek': one ffmpeg run per trial, each seeking straight to its start
+# 'single': one ffmpeg run that decodes the video once and writes every trial (best with many trials close together)
+CLIP_COPY_MODE = 'keyframe'  # when there's no crop, so nothing has to be re-encoded:
+# 'keyframe': stream copy (-c copy) from the keyframe at or before each trial start. Fastest, but the clip can start up
+#   to one keyframe interval early
+# 'smart': re-encode only the partial GOPs at each end of the trial and stream copy the rest. Frame-accurate, but only
+#   for h264/hevc sources whose profile the encoder can reproduce (see smart_cut_encoder_args); others use 'keyframe'
+# None: always re-encode
+SMART_CUT_ENCODERS = {  # source codec: (encoder, {profile reported by ffprobe: encoder profile})
+    'h264': ('libx264', {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high',
+                         'High 10': 'high10', 'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444'}),
+    'hevc': ('libx265', {'Main': 'main', 'Main 10': 'main10', 'Main Still Picture': 'mainstillpicture'}),
+}
+
 
 def get_seconds_from_time(time_str):
     time = time_str.split(":")
@@ -90,7 +126,8 @@ def check_ffmpeg_installed():
 
 
 def extract_audio(video_path):
-    """Extract the audio from the video file without moviepy, thereby reducing the package requirement for the script"""
+    """Extract the audio from the video file without moviepy, thereby reducing the package requirement for the script.
+    This holds the whole full-resolution track in memory; for display, use audio_envelope instead"""
 
     # Get stream info
     mapping = {
@@ -134,21 +171,805 @@ def extract_audio(video_path):
     return audio, fs
 
 
+def audio_stream_info(video_path):
+    """Channels, sample rate and sample format of the first audio stream, or None if the video has no audio"""
+    result = subprocess.run([
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "stream=channels,sample_rate,sample_fmt",
+        "-of", "json", video_path
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    streams = json.loads(result.stdout or "{}").get('streams', [])
+    if not streams:
+        return None
+    return streams[0]['channels'], int(streams[0]['sample_rate']), streams[0]['sample_fmt']
+
+
+def iter_audio_chunks(video_path, chunk_samples=AUDIO_CHUNK_SAMPLES):
+    """Decode the audio track a chunk at a time, yielding mono float32 arrays of up to chunk_samples samples.
+    ffmpeg does the downmix (-ac 1) and conversion to float, so only one chunk is ever held in memory"""
+    cmd = [
+        "ffmpeg", "-i", video_path,
+        "-vn", "-ac", "1",
+        "-f", "f32le", "-acodec", "pcm_f32le",
+        "-hide_banner", "-loglevel", "error",
+        "-"
+    ]
+    chunkBytes = chunk_samples * 4
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        while True:
+            raw = proc.stdout.read(chunkBytes)
+            if not raw:
+                break
+            yield np.frombuffer(raw[:len(raw) - len(raw) % 4], dtype=np.float32)
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+
+def audio_envelope(video_path, bin_samples=AUDIO_BIN_SAMPLES, chunk_samples=AUDIO_CHUNK_SAMPLES, cancelled=None):
+    """Min/max envelope of the (mono) audio track: the minimum and maximum sample in each bin of bin_samples samples,
+    computed while streaming, so memory use depends on the number of bins rather than the length of the audio and
+    peaks are kept (unlike plain decimation). The last bin may hold fewer samples.
+    cancelled is an optional function, checked between chunks, that returns True to stop early.
+    Returns (mins, maxs, fs), or None if the video has no audio (or it was cancelled)"""
+    info = audio_stream_info(video_path)
+    if info is None:
+        return None
+    _, fs, _ = info
+
+    mins = []
+    maxs = []
+    carry = np.empty(0, dtype=np.float32)  # samples left over from the last chunk that don't fill a bin
+    for chunk in iter_audio_chunks(video_path, chunk_samples):
+        if cancelled is not None and cancelled():
+            return None
+        samples = np.concatenate((carry, chunk)) if len(carry) else chunk
+        nFull = len(samples) // bin_samples * bin_samples
+        bins = samples[:nFull].reshape(-1, bin_samples)
+        mins.append(bins.min(axis=1))
+        maxs.append(bins.max(axis=1))
+        carry = samples[nFull:].copy()
+    if len(carry):
+        mins.append(carry.min(keepdims=True))
+        maxs.append(carry.max(keepdims=True))
+
+    if not mins:
+        return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.float32), fs
+    return np.concatenate(mins), np.concatenate(maxs), fs
+
+
+def envelope_plot_data(mins, maxs, bin_duration, offset=0):
+    """x, y to draw a min/max envelope as one line that runs from each bin's min to its max"""
+    nBins = len(mins)
+    x = np.repeat((offset + np.arange(nBins)) * bin_duration, 2)
+    y = np.empty(2 * nBins, dtype=np.float32)
+    y[0::2] = mins
+    y[1::2] = maxs
+    return x, y
+
+
+class WaveformPyramid(object):
+    """Min/max mip-map of an audio envelope: level 0 is the envelope itself, and each level above merges
+    WAVEFORM_PYRAMID_FACTOR bins of the one below (min of the mins, max of the maxes), so peaks survive at every level.
+    query returns only the bins in view, from the finest level that fits in the requested number of points, so drawing
+    costs the same however long the audio or however far the plot is zoomed"""
+
+    def __init__(self, mins, maxs, bin_duration, factor=WAVEFORM_PYRAMID_FACTOR):
+        self.bin_duration = bin_duration
+        self.factor = factor
+        self.levels = [(mins, maxs)]
+        while len(mins) > 1:
+            pad = -len(mins) % factor  # repeat the last bin so the level divides evenly
+            mins = np.concatenate((mins, np.repeat(mins[-1:], pad))).reshape(-1, factor).min(axis=1)
+            maxs = np.concatenate((maxs, np.repeat(maxs[-1:], pad))).reshape(-1, factor).max(axis=1)
+            self.levels.append((mins, maxs))
+
+    def duration(self):
+        return len(self.levels[0][0]) * self.bin_duration
+
+    def amplitude_range(self):
+        mins, maxs = self.levels[-1]
+        return (float(mins.min()), float(maxs.max())) if len(mins) else (-1.0, 1.0)
+
+    def level_for(self, t_start, t_end, max_bins):
+        """Finest level with no more than max_bins bins between t_start and t_end (seconds)"""
+        for level in range(len(self.levels)):
+            if (t_end - t_start) / (self.bin_duration * self.factor ** level) <= max_bins:
+                return level
+        return len(self.levels) - 1
+
+    def query(self, t_start, t_end, max_bins):
+        """x, y of the envelope between t_start and t_end, from the level matching the view (see envelope_plot_data)"""
+        level = self.level_for(t_start, t_end, max_bins)
+        mins, maxs = self.levels[level]
+        binDuration = self.bin_duration * self.factor ** level
+        # one bin of margin either side so the line reaches the edges of the view
+        first = min(max(int(t_start / binDuration) - 1, 0), len(mins))
+        last = min(max(int(np.ceil(t_end / binDuration)) + 1, first), len(mins))
+        return envelope_plot_data(mins[first:last], maxs[first:last], binDuration, offset=first)
+
+
+def build_seek_index(video_path):
+    """Read the presentation timestamp and keyframe flag of every video packet with ffprobe (no decoding, so this is
+    much quicker than reading the video). Returns (pts, keyframes): the frame timestamps in presentation order, and the
+    0-based indices of the keyframes. Packets without a timestamp (N/A) are kept, as NaN, so every frame still has its
+    place in the index; they're put in presentation order by the timestamps of the packets decoded around them"""
+    result = subprocess.run([
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=print_section=0", video_path
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+
+    pts = []
+    isKey = []
+    for line in result.stdout.splitlines():
+        fields = line.strip().split(",")
+        if len(fields) < 2:
+            continue
+        pts.append(np.nan if fields[0] in ("", "N/A") else float(fields[0]))
+        isKey.append("K" in fields[1])
+
+    # packets come out in decode order, frames are numbered in presentation order
+    pts = np.array(pts)
+    if np.isnan(pts).all():
+        raise ValueError(f"No packet timestamps in {video_path}")
+    order = np.argsort(fill_missing_times(pts), kind='stable')
+    keyframes = np.flatnonzero(np.array(isKey, dtype=bool)[order])
+    return pts[order], keyframes
+
+
+def fill_missing_times(pts):
+    """pts with the missing (NaN) timestamps interpolated from the ones either side"""
+    known = ~np.isnan(pts)
+    if known.all() or not known.any():
+        return pts
+    return np.interp(np.arange(len(pts)), np.flatnonzero(known), pts[known])
+
+
+class SeekIndex(object):
+    """Keyframe index of a video, for frame-accurate seeking: jump to the keyframe at or before the target frame by its
+    timestamp and decode forward until the frame with the target's timestamp, rather than trusting the capture to land
+    on the right frame or counting frames from wherever it did land.
+    Saved in the media cache (or next to the video, as <video>.seekindex.npz) so it's only built once per file"""
+    VERSION = 2  # saved indexes from before this are rebuilt (version 1 dropped the frames without a timestamp)
+
+    def __init__(self, pts, keyframes):
+        self.pts = pts
+        self.keyframes = keyframes
+        # seconds from the first frame (the capture's CAP_PROP_POS_MSEC, in seconds), estimated for frames without pts
+        self.first_pts = float(np.nanmin(pts)) if len(pts) else 0.0
+        self.times = fill_missing_times(np.asarray(pts, dtype=float))
+        if len(self.times):
+            self.times = self.times - self.times[0]
+        self.frame_duration = float(np.median(np.diff(self.times))) if len(self.times) > 1 else 0.0
+
+    @staticmethod
+    def index_path(video_path):
+        return video_path + ".seekindex.npz"
+
+    @classmethod
+    def load(cls, video_path, cache=None):
+        """Load the saved index for this video, or build (and save) it. Returns None if ffprobe can't read it.
+        Saved to the media cache if one is given, otherwise next to the video"""
+        if cache is not None:
+            pts = cache.get_array(video_path, 'pts')
+            keyframes = cache.get_array(video_path, 'keyframes')
+            cached = cache.get(video_path) or {}
+            if pts is not None and keyframes is not None and cached.get('seek_index_version') == cls.VERSION:
+                return cls(pts, keyframes)
+        else:
+            indexPath = cls.index_path(video_path)
+            stat = os.stat(video_path)
+            if os.path.exists(indexPath):
+                try:
+                    saved = np.load(indexPath)
+                    if (saved['size'] == stat.st_size and saved['mtime'] == stat.st_mtime and
+                            'version' in saved and saved['version'] == cls.VERSION):
+                        return cls(saved['pts'], saved['keyframes'])
+                except Exception as e:
+                    print(f"Could not read seek index {indexPath}: {e}")
+
+        try:
+            pts, keyframes = build_seek_index(video_path)
+        except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
+            print(f"Could not build seek index: {e}")
+            return None
+        if len(keyframes) == 0:
+            return None
+
+        index = cls(pts, keyframes)
+        if cache is not None:
+            cache.put(video_path, meta={'keyframe_times': [round(float(t), 6) for t in index.keyframe_times()],
+                                        'seek_index_version': cls.VERSION},
+                      arrays={'pts': pts, 'keyframes': keyframes})
+        else:
+            try:
+                np.savez(indexPath, pts=pts, keyframes=keyframes, size=stat.st_size, mtime=stat.st_mtime,
+                         version=cls.VERSION)
+            except OSError as e:
+                print(f"Could not save seek index {indexPath}: {e}")
+        return index
+
+    def __len__(self):
+        return len(self.pts)
+
+    def keyframe_times(self, start_time=None):
+        """Keyframe times in seconds from the first frame of the video, or, given the container's start_time (from
+        probe_video_stream), from that: the time base of ffmpeg's -ss, which is what clips have to be cut in"""
+        if start_time is None:
+            return self.times[self.keyframes]
+        return self.times[self.keyframes] + self.first_pts - start_time
+
+    def keyframe_before(self, frame_index):
+        """Index of the last keyframe at or before frame_index (0-based)"""
+        i = np.searchsorted(self.keyframes, frame_index, side='right') - 1
+        return int(self.keyframes[max(i, 0)])
+
+    def frame_at(self, time_sec):
+        """Index of the frame shown at time_sec (seconds from the first frame)"""
+        i = np.searchsorted(self.times, time_sec + self.frame_duration / 2, side='right') - 1
+        return int(min(max(i, 0), len(self.times) - 1))
+
+
+def seek_frame(cap, target_frame, seek_index=None):
+    """Read frame target_frame (1-based, i.e. the capture position after reading it) from the capture.
+    With a seek index, only seek if the target is behind the current position or past the next keyframe, and always
+    to a keyframe, by its timestamp; then decode forward until the frame whose timestamp is the target's. Without one,
+    fall back on the capture's own seeking"""
+    targetIndex = max(target_frame - 1, 0)
+    if seek_index is None or targetIndex >= len(seek_index):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, targetIndex)
+        return cap.read()
+
+    # where the capture is, from the timestamp of the last frame it read (nothing read yet: before the first frame)
+    nextIndex = 0
+    if cap.get(cv2.CAP_PROP_POS_FRAMES) > 0:
+        nextIndex = seek_index.frame_at(cap.get(cv2.CAP_PROP_POS_MSEC) / 1000) + 1
+    keyframe = seek_index.keyframe_before(targetIndex)
+    if not keyframe <= nextIndex <= targetIndex:
+        cap.set(cv2.CAP_PROP_POS_MSEC, seek_index.times[keyframe] * 1000)
+        nextIndex = keyframe
+
+    # grab (decode without converting) until the target's timestamp, then read it. A capture that doesn't report
+    # timestamps (always 0) gets the frames counted instead
+    targetTime = seek_index.times[targetIndex] - seek_index.frame_duration / 2
+    nGrabbed = 0
+    while True:
+        if not cap.grab():
+            return False, None
+        nGrabbed += 1
+        frameTime = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        if frameTime >= targetTime or (frameTime <= 0 and nGrabbed > targetIndex - nextIndex):
+            return cap.retrieve()
+
+
+def probe_video_codec(video_path):
+    """Codec name of the first video stream (e.g. h264, hevc)"""
+    return subprocess.run(
+        [
+            "ffprobe", "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=codec_name",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            video_path
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    ).stdout.strip()
+
+
+def probe_video_stream(video_path):
+    """Codec, profile, level, pixel format and time base of the first video stream, plus 'start_time': the container's
+    start time, which is where ffmpeg's -ss counts from. Whatever ffprobe doesn't report is left out"""
+    result = subprocess.run([
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "stream=codec_name,profile,level,pix_fmt,time_base:format=start_time", "-of", "json",
+        video_path
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+    info = json.loads(result.stdout)
+    stream = (info.get('streams') or [{}])[0]
+    try:
+        stream['start_time'] = float(info.get('format', {}).get('start_time', 0))
+    except ValueError:
+        stream['start_time'] = 0.0
+    return stream
+
+
+def has_audio_stream(video_path):
+    """Whether the video has an audio stream"""
+    result = subprocess.run([
+        "ffprobe", "-v", "error", "-select_streams", "a",
+        "-show_entries", "stream=index", "-of", "csv=print_section=0", video_path
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return bool(result.stdout.strip())
+
+
+def video_codec_args(codec, framerate, threads=None):
+    """Encoder arguments matching the source video (hevc stays hevc, anything else becomes h264)"""
+    if codec == "hevc":
+        args = ["-c:v", "libx265"]
+    else:
+        args = ["-c:v", "libx264"]  # fallback
+    if framerate:
+        args += ["-r", str(framerate)]
+    if threads:
+        args += ["-threads", str(threads)]
+    return args
+
+
+def clip_worker_count(n_clips):
+    """Number of clips to encode at once: CLIP_WORKERS if set, otherwise half the cores (each encoder is itself
+    multithreaded, but not enough to keep a big machine busy on short clips)"""
+    nWorkers = CLIP_WORKERS or max(1, (os.cpu_count() or 1) // 2)
+    return max(1, min(nWorkers, n_clips))
+
+
+def encoder_thread_count(n_workers):
+    """Threads per encoder so that the parallel encoders share the cores rather than each trying to use them all"""
+    return max(1, (os.cpu_count() or 1) // n_workers)
+
+
+def crop_filter(crop):
+    """ffmpeg crop filter for (x, y, width, height), or None for no crop"""
+    if crop is None or any(v is None for v in crop):
+        return None
+    x, y, w, h = crop
+    return f"crop={w}:{h}:{x}:{y}"
+
+
+def build_clip_args(video_path, output_path, start, end, crop=None, codec=None, framerate=None, threads=None):
+    """ffmpeg arguments to export one trial clip (start/end as timestamps, e.g. 0:01:02.5000).
+    -ss goes before -i (input seeking), so ffmpeg jumps straight to the keyframe before the start instead of decoding
+    the video from the beginning; when re-encoding, frames between that keyframe and the start are still decoded and
+    dropped, so the clip starts on the same frame as with output seeking"""
+    startSec = get_seconds_from_time(start)
+    endSec = get_seconds_from_time(end)
+    args = ["-y", "-ss", f"{startSec:.4f}", "-i", video_path, "-t", f"{endSec - startSec:.4f}"]
+    cropStr = crop_filter(crop)
+    if cropStr:
+        args += ["-vf", cropStr]
+    args += ["-map", "0:v", "-map", "0:a?"]  # To remove any extra streams
+    args += video_codec_args(codec, framerate, threads)
+    args += ["-c:a", "copy"]
+    args += [output_path]
+    return args
+
+
+def needs_reencode(crop, width, height):
+    """Whether a clip with this crop box has to be re-encoded: False for no crop, or a crop covering the whole frame"""
+    if crop_filter(crop) is None:
+        return False
+    x, y, w, h = crop
+    return not (x == 0 and y == 0 and w >= width and h >= height)
+
+
+def build_copy_clip_args(video_path, output_path, start_sec, end_sec, audio=True):
+    """ffmpeg arguments to stream copy (no decoding or encoding) from start_sec to end_sec, with the audio unless audio
+    is False. With -c copy, ffmpeg can only cut on a keyframe, so the clip starts at the keyframe at or before
+    start_sec"""
+    args = ["-y", "-ss", f"{start_sec:.4f}", "-i", video_path, "-t", f"{end_sec - start_sec:.4f}"]
+    args += ["-map", "0:v", "-map", "0:a?"] if audio else ["-map", "0:v", "-an"]
+    args += ["-c", "copy", "-avoid_negative_ts", "make_zero", output_path]
+    return args
+
+
+def smart_cut_encoder_args(stream, framerate=None, threads=None):
+    """Encoder arguments for the re-encoded ends of a smart cut, matching the source stream (from probe_video_stream):
+    same codec, profile, level and pixel format, so the pieces can be joined without re-encoding the middle. None if
+    the source can't be matched (not h264/hevc, or a profile the encoder doesn't make)"""
+    encoder, profiles = SMART_CUT_ENCODERS.get(stream.get('codec_name'), (None, {}))
+    profile = profiles.get(stream.get('profile'))
+    if encoder is None or profile is None or not stream.get('pix_fmt'):
+        return None
+    args = ["-c:v", encoder, "-profile:v", profile, "-pix_fmt", stream['pix_fmt']]
+    if encoder == 'libx264' and stream.get('level', 0) > 0:
+        args += ["-level:v", f"{stream['level'] / 10:g}"]  # ffprobe reports h264 level 4.1 as 41
+    if framerate:
+        args += ["-r", str(framerate)]
+    if threads:
+        args += ["-threads", str(threads)]
+    return args
+
+
+def build_smart_cut_steps(video_path, output_path, start, end, keyframe_times, stream, framerate=None,
+                          threads=None):
+    """ffmpeg runs for a frame-accurate clip that only re-encodes what it has to: the frames from the trial start to
+    the first keyframe inside the trial (head) and from the last keyframe inside the trial to the end (tail). The
+    whole GOPs in between are stream copied, then the three pieces are joined with the concat demuxer and the audio is
+    copied over from the source.
+    The head and tail are encoded to match the source (stream, from probe_video_stream; see smart_cut_encoder_args,
+    which must not be None for it), and every piece goes through MPEG-TS, which carries the parameter sets in-band
+    with each keyframe and has the same 90 kHz time base for all of them, so the decoder picks up each piece's
+    settings where it starts. The joined clip gets the source's time base back. keyframe_times must be in ffmpeg's -ss
+    time base (SeekIndex.keyframe_times with the container's start_time).
+    Returns (steps, temp): steps is a list of (ffmpeg arguments, seconds of output) to run in order, temp is a folder
+    of intermediate files to delete afterwards (None if no intermediate files are needed)"""
+    startSec = get_seconds_from_time(start)
+    endSec = get_seconds_from_time(end)
+    inside = keyframe_times[(keyframe_times >= startSec) & (keyframe_times <= endSec)]
+    if len(inside) < 2:
+        # no whole GOP inside the trial, so nothing to copy: just re-encode it
+        return [(build_clip_args(video_path, output_path, start, end, codec=stream.get('codec_name'),
+                                 framerate=framerate, threads=threads), endSec - startSec)], None
+    firstKey, lastKey = float(inside[0]), float(inside[-1])
+    encoderArgs = smart_cut_encoder_args(stream, framerate, threads)
+
+    temp = os.path.splitext(output_path)[0] + "_parts"
+    pieces = []
+    steps = []
+    if firstKey > startSec:
+        headPath = os.path.join(temp, "head.ts")
+        args = ["-y", "-ss", f"{startSec:.4f}", "-i", video_path, "-t", f"{firstKey - startSec:.4f}",
+                "-map", "0:v", "-an"] + encoderArgs + [headPath]
+        steps.append((args, firstKey - startSec))
+        pieces.append(headPath)
+    middlePath = os.path.join(temp, "middle.ts")
+    steps.append((build_copy_clip_args(video_path, middlePath, firstKey, lastKey, audio=False), lastKey - firstKey))
+    pieces.append(middlePath)
+    if endSec > lastKey:
+        tailPath = os.path.join(temp, "tail.ts")
+        args = ["-y", "-ss", f"{lastKey:.4f}", "-i", video_path, "-t", f"{endSec - lastKey:.4f}",
+                "-map", "0:v", "-an"] + encoderArgs + [tailPath]
+        steps.append((args, endSec - lastKey))
+        pieces.append(tailPath)
+
+    listPath = os.path.join(temp, "parts.txt")
+    os.makedirs(temp, exist_ok=True)
+    with open(listPath, "w") as f:
+        for piece in pieces:
+            f.write("file '" + os.path.abspath(piece).replace("'", "'\\''") + "'\n")
+    args = ["-y", "-f", "concat", "-safe", "0", "-i", listPath,
+            "-ss", f"{startSec:.4f}", "-t", f"{endSec - startSec:.4f}", "-i", video_path,
+            "-map", "0:v", "-map", "1:a?", "-c", "copy"]
+    timeBase = stream.get('time_base', '')
+    if os.path.splitext(output_path)[1].lower() in ('.mp4', '.mov', '.m4v') and timeBase.startswith('1/'):
+        args += ["-video_track_timescale", timeBase[2:]]
+    args += [output_path]
+    steps.append((args, endSec - startSec))
+    return steps, temp
+
+
+def build_multi_clip_args(video_path, clips, crop=None, codec=None, framerate=None, audio=True):
+    """ffmpeg arguments to export all trial clips in a single pass: the source is decoded once (from the start of the
+    first trial to the end of the last) and split to every output with trim filters.
+    clips is a list of (output path, start, end) with timestamps as in build_clip_args"""
+    clipTimes = [(get_seconds_from_time(start), get_seconds_from_time(end)) for _, start, end in clips]
+    fullStart = min(start for start, _ in clipTimes)
+    fullEnd = max(end for _, end in clipTimes)
+    nClips = len(clips)
+
+    cropStr = crop_filter(crop)
+    videoChain = f"[0:v]{cropStr + ',' if cropStr else ''}split={nClips}" + "".join(f"[v{i}]" for i in range(nClips))
+    filterParts = [videoChain]
+    if audio:
+        filterParts.append(f"[0:a]asplit={nClips}" + "".join(f"[a{i}]" for i in range(nClips)))
+    for i, (start, end) in enumerate(clipTimes):
+        # times relative to fullStart, because of the input seek
+        filterParts.append(f"[v{i}]trim=start={start - fullStart:.4f}:end={end - fullStart:.4f},"
+                           f"setpts=PTS-STARTPTS[v{i}out]")
+        if audio:
+            filterParts.append(f"[a{i}]atrim=start={start - fullStart:.4f}:end={end - fullStart:.4f},"
+                               f"asetpts=PTS-STARTPTS[a{i}out]")
+
+    args = ["-y", "-ss", f"{fullStart:.4f}", "-i", video_path, "-t", f"{fullEnd - fullStart:.4f}",
+            "-filter_complex", "; ".join(filterParts)]
+    for i, (outputPath, _, _) in enumerate(clips):
+        args += ["-map", f"[v{i}out]"]
+        if audio:
+            args += ["-map", f"[a{i}out]"]
+        args += video_codec_args(codec, framerate)
+        args += [outputPath]
+    return args
+
+
+class FrameCache(object):
+    """Least recently used cache of decoded frames, by frame number, capped at max_bytes. Frames are stored
+    downscaled to max_width, since they're only displayed. Thread safe, so FrameReadAhead can fill it in the
+    background"""
+
+    def __init__(self, max_bytes=FRAME_CACHE_BYTES, max_width=FRAME_CACHE_MAX_WIDTH):
+        self.max_bytes = max_bytes
+        self.max_width = max_width
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, frame_number):
+        with self.lock:
+            return frame_number in self.frames
+
+    def shrink(self, frame):
+        h, w = frame.shape[:2]
+        if w <= self.max_width:
+            return frame.copy()
+        return cv2.resize(frame, (self.max_width, round(h * self.max_width / w)), interpolation=cv2.INTER_AREA)
+
+    def get(self, frame_number):
+        """The cached frame, or None"""
+        with self.lock:
+            frame = self.frames.get(frame_number)
+            if frame is not None:
+                self.frames.move_to_end(frame_number)
+            return frame
+
+    def put(self, frame_number, frame):
+        small = self.shrink(frame)
+        with self.lock:
+            old = self.frames.pop(frame_number, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.frames[frame_number] = small
+            self.nbytes += small.nbytes
+            while self.nbytes > self.max_bytes and len(self.frames) > 1:
+                _, evicted = self.frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.nbytes = 0
+
+
+class FrameReadAhead(QThread):
+    """Decodes the frames around the scrub position into a FrameCache in the background, with its own capture so it
+    never moves the GUI's. request() sets a new position; frames from READ_BEHIND_FRAMES before it to READ_AHEAD_FRAMES
+    after it are decoded in one forward pass from the keyframe before the first missing frame, and a new request
+    interrupts the pass"""
+
+    def __init__(self, video_path, frame_cache, seek_index=None, frame_count=None, ahead=READ_AHEAD_FRAMES,
+                 behind=READ_BEHIND_FRAMES, parent=None):
+        super().__init__(parent)
+        self.video_path = video_path
+        self.frame_cache = frame_cache
+        self.seek_index = seek_index
+        self.frame_count = frame_count
+        self.ahead = ahead
+        self.behind = behind
+        self.condition = threading.Condition()
+        self.center = None  # requested position
+        self.run_flag = True
+
+    def request(self, frame_number):
+        with self.condition:
+            self.center = frame_number
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.run_flag = False
+            self.condition.notify()
+        self.wait()
+
+    def moved(self, center):
+        return not self.run_flag or self.center != center
+
+    def run(self):
+        cap = cv2.VideoCapture(self.video_path)
+        doneCenter = None
+        try:
+            while True:
+                with self.condition:
+                    while self.run_flag and self.center == doneCenter:
+                        self.condition.wait()
+                    if not self.run_flag:
+                        break
+                    center = self.center
+
+                last = center + self.ahead
+                if self.frame_count:
+                    last = min(last, self.frame_count)
+                missing = [n for n in range(max(center - self.behind, 1), last + 1) if n not in self.frame_cache]
+                if missing:
+                    ok, frame = seek_frame(cap, missing[0], self.seek_index)
+                    frameNumber = missing[0]
+                    while ok and frameNumber <= missing[-1] and not self.moved(center):
+                        if frameNumber not in self.frame_cache:
+                            self.frame_cache.put(frameNumber, frame)
+                        ok, frame = cap.read()
+                        frameNumber += 1
+                doneCenter = center
+        finally:
+            cap.release()
+
+
+class ThumbnailIndex(object):
+    """Low resolution thumbnails about every THUMBNAIL_INTERVAL seconds through a video, to show while the slider is
+    dragged. The images are a memory-mapped array saved next to the video (<video>.thumbs.npy), with a json sidecar
+    (<video>.thumbs.json) holding the thumbnail times and the size and modification time of the video it was made
+    from. Thumbnails are taken from keyframes, which ffmpeg can decode without decoding anything in between, so
+    building the index of a multi-hour video takes seconds rather than a full decode.
+    Usable while it's being built: get only looks at the first `done` thumbnails"""
+
+    def __init__(self, images, times, done=None):
+        self.images = images
+        self.times = times
+        self.done = len(times) if done is None else done
+
+    @staticmethod
+    def paths(video_path, folder=None):
+        base = video_path if folder is None else os.path.join(folder, os.path.basename(video_path))
+        return base + ".thumbs.npy", base + ".thumbs.json"
+
+    @classmethod
+    def load(cls, video_path, folder=None):
+        """The finished index for this video, or None if it hasn't been built (or the video has changed)"""
+        imagePath, infoPath = cls.paths(video_path, folder)
+        try:
+            with open(infoPath) as f:
+                info = json.load(f)
+            stat = os.stat(video_path)
+            if (info['size'], info['mtime'], info['done']) != (stat.st_size, stat.st_mtime, len(info['times'])):
+                return None
+            return cls(np.load(imagePath, mmap_mode='r'), np.array(info['times']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def choose_keyframes(keyframe_times, interval=THUMBNAIL_INTERVAL):
+        """Indices of the keyframes to keep: the first, then each one at least interval after the last one kept"""
+        keep = []
+        lastTime = None
+        for i, t in enumerate(keyframe_times):
+            if lastTime is None or t - lastTime >= interval:
+                keep.append(i)
+                lastTime = t
+        return keep
+
+    def get(self, seconds):
+        """The thumbnail at or before this time, or None if there isn't one (yet)"""
+        i = np.searchsorted(self.times[:self.done], seconds, side='right') - 1
+        return self.images[i] if i >= 0 else None
+
+
+class ThumbnailBuilder(QThread):
+    """Builds (or loads) the ThumbnailIndex of a video in the background. index is available as soon as building
+    starts, and fills in as thumbnails are decoded; progress is emitted with the number done so far"""
+    progress = Signal(int)
+
+    def __init__(self, video_path, seek_index, width, height, fallback_folder=None, parent=None):
+        super().__init__(parent)
+        self.video_path = video_path
+        self.seek_index = seek_index
+        self.thumb_width = THUMBNAIL_WIDTH
+        self.thumb_height = max(2, round(height * THUMBNAIL_WIDTH / width / 2) * 2)  # even, for the scaler
+        self.fallback_folder = fallback_folder  # used if the video's folder isn't writable
+        self.index = ThumbnailIndex.load(video_path) or ThumbnailIndex.load(video_path, fallback_folder)
+        self.cancelled = False
+        self.process = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.process is not None:
+            self.process.kill()
+
+    def create_index(self, times):
+        """Empty index on disk, next to the video if possible. Returns (index, info path)"""
+        shape = (len(times), self.thumb_height, self.thumb_width, 3)
+        for folder in (None, self.fallback_folder):
+            imagePath, infoPath = ThumbnailIndex.paths(self.video_path, folder)
+            try:
+                if folder is not None:
+                    os.makedirs(folder, exist_ok=True)
+                images = np.lib.format.open_memmap(imagePath, mode='w+', dtype=np.uint8, shape=shape)
+                return ThumbnailIndex(images, np.array(times), done=0), infoPath
+            except OSError as e:
+                print(f"Could not create thumbnail index {imagePath}: {e}")
+        return ThumbnailIndex(np.zeros(shape, dtype=np.uint8), np.array(times), done=0), None
+
+    def run(self):
+        if self.index is not None or self.seek_index is None:
+            return
+        keyframeTimes = self.seek_index.keyframe_times()
+        keep = ThumbnailIndex.choose_keyframes(keyframeTimes)
+        if not keep:
+            return
+        index, infoPath = self.create_index([float(keyframeTimes[i]) for i in keep])
+        self.index = index
+
+        cmd = [
+            "ffmpeg", "-v", "error",
+            "-skip_frame", "nokey", "-i", self.video_path,  # only decode keyframes
+            "-an", "-vf", f"scale={self.thumb_width}:{self.thumb_height}", "-vsync", "0",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-"
+        ]
+        frameBytes = self.thumb_width * self.thumb_height * 3
+        keepSet = set(keep)
+        try:
+            self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            return
+        try:
+            keyframe = 0
+            while index.done < len(keep) and not self.cancelled:
+                raw = self.process.stdout.read(frameBytes)
+                if len(raw) < frameBytes:
+                    break
+                if keyframe in keepSet:
+                    index.images[index.done] = np.frombuffer(raw, dtype=np.uint8).reshape(index.images.shape[1:])
+                    index.done += 1
+                    if index.done % 50 == 0:
+                        self.progress.emit(index.done)
+                keyframe += 1
+        finally:
+            self.process.stdout.close()
+            self.process.kill()
+            self.process.wait()
+
+        self.progress.emit(index.done)
+        if infoPath is None or self.cancelled:
+            return
+        # the sidecar is only written once the index is complete, so an interrupted build is redone next time
+        if isinstance(index.images, np.memmap):
+            index.images.flush()
+        stat = os.stat(self.video_path)
+        try:
+            with open(infoPath, 'w') as f:
+                json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'interval': THUMBNAIL_INTERVAL,
+                           'done': index.done, 'times': index.times[:index.done].tolist()}, f)
+        except OSError as e:
+            print(f"Could not save thumbnail index {infoPath}: {e}")
+
+
 class VideoThread(QThread):
     # How to display opencv video in pyqt apps: https://gist.github.com/docPhil99/ca4da12c9d6f29b9cea137b617c7b8b1
-    change_pixmap_signal = Signal(np.ndarray, int)
+    # Frames go into a one-frame buffer that always holds the newest frame, and frame_ready is only emitted once the
+    # GUI has taken the previous frame. If painting is slower than playback, frames are dropped instead of queueing up
+    frame_ready = Signal()
 
-    def __init__(self, cap):
+    def __init__(self, cap, playback_fps=None, preview_max_fps=PREVIEW_MAX_FPS, preview_every=1):
         super().__init__()
         self.run_flag = False
         self.cap = cap
+        self.playback_fps = playback_fps  # decode at this rate (None for as fast as possible)
+        self.preview_max_fps = preview_max_fps  # most frames per second offered to the GUI
+        self.preview_every = preview_every  # only offer every Nth frame to the GUI
+        self.previewBuffer = queue.Queue(maxsize=1)
+        self.previewPending = False
+        self.lastPreview = 0
 
     def run(self):
         self.run_flag = True
+        timeNext = time.perf_counter()
         while self.run_flag:
             ret, cv_img = self.cap.read()
-            if ret:
-                self.change_pixmap_signal.emit(cv_img, int(self.cap.get(cv2.CAP_PROP_POS_FRAMES)))
+            if not ret:
+                break  # end of video
+            frameNumber = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+            now = time.perf_counter()
+            if frameNumber % self.preview_every == 0 and now - self.lastPreview >= 1 / self.preview_max_fps:
+                self.offer_preview(cv_img, frameNumber)
+                self.lastPreview = now
+
+            if self.playback_fps:
+                # wait until this frame is due, but don't try to catch up if we've fallen behind
+                timeNext += 1 / self.playback_fps
+                delay = timeNext - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    timeNext = time.perf_counter()
+
+    def offer_preview(self, cv_img, frame_number):
+        """Replace whatever is in the preview buffer with this frame, and tell the GUI if it isn't already waiting"""
+        try:
+            self.previewBuffer.get_nowait()
+        except queue.Empty:
+            pass
+        self.previewBuffer.put_nowait((cv_img, frame_number))
+        if not self.previewPending:
+            self.previewPending = True
+            self.frame_ready.emit()
+
+    def take_preview(self):
+        """Newest (frame, frame number) from the buffer, or None if it has already been taken. Called from the GUI"""
+        self.previewPending = False
+        try:
+            return self.previewBuffer.get_nowait()
+        except queue.Empty:
+            return None
 
     def stop(self):
         """Sets run flag to False and waits for thread to finish"""
@@ -160,11 +981,294 @@ class VideoThread(QThread):
         self.cap.release()
 
 
+class FFmpegCheckThread(QThread):
+    """Runs check_ffmpeg_installed in the background, so the window doesn't wait on it to open"""
+    checked = Signal(bool, str)  # installed, message
+
+    def run(self):
+        installed, message = check_ffmpeg_installed()
+        self.checked.emit(installed, message)
+
+
+class VideoLoader(QThread):
+    """Works out everything about a newly opened video that needs ffprobe/ffmpeg, in stages so the GUI can use each
+    part as soon as it's ready: metadata_ready with the codec and seek index, then audio_ready with the waveform.
+    Results come from the media cache when the video has been opened before, and are added to it when not, along with
+    meta (stream info the GUI already read, e.g. fps and frame count). All cache writes for the video happen here, off
+    the GUI thread, since the first one has to fingerprint the file. cancel() stops the loader at the next stage (or
+    audio chunk) without emitting anything more"""
+    metadata_ready = Signal(str, str, object)  # video path, codec, seek index (or None)
+    audio_ready = Signal(str, object)  # video path, WaveformPyramid (or None for no audio)
+
+    def __init__(self, video_path, media_cache, meta=None, parent=None):
+        super().__init__(parent)
+        self.video_path = video_path
+        self.media_cache = media_cache
+        self.meta = meta or {}
+        self.cancelled = False
+        self.codec = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        cached = self.media_cache.get(self.video_path) or {}
+        try:
+            self.codec = cached.get('codec') or probe_video_codec(self.video_path)
+        except FileNotFoundError:
+            self.codec = None  # no ffprobe
+        meta = dict(self.meta)
+        if 'codec' not in cached and self.codec:
+            meta['codec'] = self.codec
+        if any(cached.get(key) != value for key, value in meta.items()):
+            self.media_cache.put(self.video_path, meta=meta)
+
+        # keyframe index for seeking (built on first load, then read from the cache)
+        seekIndex = SeekIndex.load(self.video_path, self.media_cache)
+        if self.cancelled:
+            return
+        self.metadata_ready.emit(self.video_path, self.codec or "", seekIndex)
+
+        try:
+            envelope = self.load_audio_envelope(cached)
+        except FileNotFoundError:
+            envelope = None
+        if self.cancelled:
+            return
+        waveform = None
+        if envelope is not None:
+            mins, maxs, fs = envelope
+            print(f'Audio sample rate (Hz): {fs}')
+            waveform = WaveformPyramid(mins, maxs, AUDIO_BIN_SAMPLES / fs)
+        self.audio_ready.emit(self.video_path, waveform)
+
+    def load_audio_envelope(self, cached):
+        """Audio envelope (mins, maxs, fs) from the cache, or streamed from the video and cached. None for no audio"""
+        if cached.get('audio_bin_samples') == AUDIO_BIN_SAMPLES:
+            if not cached.get('audio_fs'):
+                return None  # known to have no audio
+            mins = self.media_cache.get_array(self.video_path, 'audio_min')
+            maxs = self.media_cache.get_array(self.video_path, 'audio_max')
+            if mins is not None and maxs is not None:
+                return mins, maxs, cached['audio_fs']
+
+        envelope = audio_envelope(self.video_path, cancelled=lambda: self.cancelled)
+        if self.cancelled:
+            return None
+        if envelope is None:
+            self.media_cache.put(self.video_path, meta={'audio_bin_samples': AUDIO_BIN_SAMPLES, 'audio_fs': None})
+        else:
+            mins, maxs, fs = envelope
+            self.media_cache.put(self.video_path, meta={'audio_bin_samples': AUDIO_BIN_SAMPLES, 'audio_fs': fs},
+                                 arrays={'audio_min': mins, 'audio_max': maxs})
+        return envelope
+
+
+class ClipScheduler(QObject):
+    """Runs ffmpeg clip exports, up to max_workers at a time, queueing the rest.
+    Each job is a dict with 'name' (for display), 'steps' (list of (ffmpeg arguments, seconds of output) to run one
+    after another), 'duration' (seconds of output over all steps) and optionally 'temp' (folder to delete when the job
+    is done). Jobs that fail are put back at the end of the queue, up to max_retries times, before being reported as
+    failed.
+    Progress comes from ffmpeg's -progress output: per job, the output time reached, encode speed and frames/s are kept
+    in stats, and every progress update and finished job is appended to log_path (json lines) if given, along with
+    log_info (e.g. the video and encoder settings)"""
+    job_started = Signal(int)  # job index
+    job_progress = Signal(int, float)  # job index, fraction done
+    job_finished = Signal(int, bool)  # job index, success
+    all_finished = Signal(int)  # number of failed jobs
+
+    def __init__(self, jobs, max_workers=1, max_retries=CLIP_RETRIES, log_path=None, log_info=None, parent=None):
+        super().__init__(parent)
+        self.jobs = jobs
+        self.log_path = log_path
+        self.log_info = log_info or {}
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.pending = list(range(len(jobs)))
+        self.running = {}  # job index: QProcess
+        self.attempts = [0] * len(jobs)
+        self.output = [[] for _ in jobs]  # last lines of ffmpeg output per job, for reporting errors
+        self.progress = [0.0] * len(jobs)
+        self.step = [0] * len(jobs)  # index of the running step of each job
+        self.stats = [self.new_stats() for _ in jobs]
+        self.timeStart = None
+        self.failed = []
+        self.nDone = 0  # jobs finished, successfully or not
+        self.cancelled = False
+        self.finished = False
+
+    @staticmethod
+    def new_stats():
+        return {'out_time': 0.0, 'speed': None, 'fps': None, 'frame': 0, 'started': time.perf_counter(),
+                'seconds': 0.0}
+
+    def start(self):
+        self.timeStart = time.perf_counter()
+        self.fill()
+
+    def overall_progress(self):
+        """Fraction of the export done, weighted by the duration of each clip"""
+        total = sum(job['duration'] for job in self.jobs)
+        if not total:
+            return self.nDone / len(self.jobs) if self.jobs else 1.0
+        return sum(job['duration'] * progress for job, progress in zip(self.jobs, self.progress)) / total
+
+    def eta(self):
+        """Estimated seconds until the whole export is done (None until there's some progress to go on)"""
+        progress = self.overall_progress()
+        if self.timeStart is None or progress <= 0:
+            return None
+        elapsed = time.perf_counter() - self.timeStart
+        return elapsed * (1 - progress) / progress
+
+    def log(self, event, job_index, **fields):
+        """Append one json record to the log"""
+        if not self.log_path:
+            return
+        stats = self.stats[job_index]
+        record = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'event': event, 'clip': self.jobs[job_index]['name'],
+                  'mode': self.jobs[job_index].get('mode'), 'attempt': self.attempts[job_index],
+                  'step': self.step[job_index], 'steps': len(self.jobs[job_index]['steps']),
+                  'duration': round(self.jobs[job_index]['duration'], 4),
+                  'progress': round(self.progress[job_index], 4), 'out_time': round(stats['out_time'], 4),
+                  'speed': stats['speed'], 'fps': stats['fps'], 'frame': stats['frame'],
+                  'seconds': round(time.perf_counter() - stats['started'], 3)}
+        record.update(self.log_info)
+        record.update(fields)
+        try:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"Could not write clip log {self.log_path}: {e}")
+            self.log_path = None
+
+    def is_running(self):
+        return not self.finished
+
+    def cancel(self):
+        """Kill the running processes and drop the queue"""
+        self.cancelled = True
+        for job_index in self.pending:
+            self.remove_temp(job_index)
+        self.pending = []
+        for process in list(self.running.values()):
+            process.kill()
+        self.fill()
+
+    def remove_temp(self, job_index):
+        temp = self.jobs[job_index].get('temp')
+        if temp:
+            shutil.rmtree(temp, ignore_errors=True)
+
+    def fill(self):
+        """Start queued jobs until max_workers are running; report when everything is done"""
+        while self.pending and len(self.running) < self.max_workers:
+            self.launch(self.pending.pop(0))
+        if not self.running and not self.pending and not self.finished:
+            self.finished = True
+            self.all_finished.emit(len(self.failed))
+
+    def launch(self, job_index):
+        self.attempts[job_index] += 1
+        self.step[job_index] = 0
+        self.progress[job_index] = 0.0
+        self.stats[job_index] = self.new_stats()
+        self.job_started.emit(job_index)
+        self.launch_step(job_index)
+
+    # noinspection PyUnresolvedReferences
+    def launch_step(self, job_index):
+        args, _ = self.jobs[job_index]['steps'][self.step[job_index]]
+        process = QProcess(self)
+        process.setProcessChannelMode(QProcess.ProcessChannelMode.MergedChannels)
+        process.setProgram('ffmpeg')
+        process.setArguments(["-progress", "pipe:1", "-nostats"] + args)
+        process.readyReadStandardOutput.connect(lambda: self.read_output(job_index, process))
+        process.finished.connect(lambda exit_code, exit_status: self.process_finished(job_index, process, exit_code,
+                                                                                     exit_status))
+        process.errorOccurred.connect(lambda error: self.process_error(job_index, process, error))
+        self.output[job_index] = []
+        self.running[job_index] = process
+        process.start()
+
+    def read_output(self, job_index, process):
+        """Keep the last few lines of output; progress lines (key=value) are passed to parse_progress"""
+        while process.canReadLine():
+            line = process.readLine().data().decode("utf-8", errors="replace").strip()
+            if "=" in line and " " not in line:
+                self.parse_progress(job_index, line)
+            elif line:
+                self.output[job_index] = (self.output[job_index] + [line])[-10:]
+
+    def parse_progress(self, job_index, line):
+        """Handle one line of ffmpeg -progress output. ffmpeg writes a block of key=value lines every half second or so,
+        ending with progress=continue (or progress=end)"""
+        key, value = line.split("=", 1)
+        job = self.jobs[job_index]
+        stats = self.stats[job_index]
+        stepsDone = sum(duration for _, duration in job['steps'][:self.step[job_index]])
+        try:
+            if key == "out_time_us" and value != "N/A":
+                stats['out_time'] = stepsDone + max(int(value), 0) / 1e6
+            elif key == "speed" and value.endswith("x"):
+                stats['speed'] = float(value[:-1])
+            elif key == "fps":
+                stats['fps'] = float(value)
+            elif key == "frame":
+                stats['frame'] = int(value)
+        except ValueError:
+            pass  # N/A or something unexpected, keep the last value
+
+        if key == "progress":
+            if job['duration']:
+                self.progress[job_index] = min(1.0, stats['out_time'] / job['duration'])
+            self.log('progress', job_index)
+            self.job_progress.emit(job_index, self.progress[job_index])
+
+    def process_error(self, job_index, process, error):
+        # a process that can't start never emits finished
+        if error == QProcess.ProcessError.FailedToStart:
+            self.process_finished(job_index, process, -1, QProcess.ExitStatus.CrashExit)
+
+    def process_finished(self, job_index, process, exit_code, exit_status):
+        if self.running.get(job_index) is not process:
+            return  # already handled
+        del self.running[job_index]
+        process.deleteLater()
+        success = exit_status == QProcess.ExitStatus.NormalExit and exit_code == 0
+
+        if success and self.step[job_index] + 1 < len(self.jobs[job_index]['steps']):
+            if not self.cancelled:
+                self.step[job_index] += 1
+                self.launch_step(job_index)
+                return
+            success = False  # cancelled part way through the job
+
+        if not success and not self.cancelled and self.attempts[job_index] <= self.max_retries:
+            self.log('retry', job_index, output=self.output[job_index])
+            print(f"Clip {self.jobs[job_index]['name']} failed, retrying. ffmpeg output:")
+            print("\n".join(self.output[job_index]))
+            self.pending.append(job_index)
+        else:
+            if not success:
+                self.failed.append(job_index)
+                if not self.cancelled:
+                    print(f"Clip {self.jobs[job_index]['name']} failed. ffmpeg output:")
+                    print("\n".join(self.output[job_index]))
+            self.remove_temp(job_index)
+            self.progress[job_index] = 1.0  # done with it, one way or another
+            self.log('finished', job_index, success=success, cancelled=self.cancelled)
+            self.nDone += 1
+            self.job_finished.emit(job_index, success)
+        self.fill()
+
+
 class ProgressDialog(QDialog):
 
     cancel_requested = Signal()
 
-    def __init__(self, nClips):
+    def __init__(self, maximum=100):
         super().__init__()
         self.setWindowTitle("Splitting Progress")
         layout = QVBoxLayout(self)
@@ -178,12 +1282,12 @@ class ProgressDialog(QDialog):
 
         self.clipOverallBar = QProgressBar()
         self.clipOverallBar.setMinimum(0)
-        self.clipOverallBar.setMaximum(nClips)
+        self.clipOverallBar.setMaximum(maximum)  # percent, weighted by clip duration
         self.clipOverallBar.setValue(0)  # Initial value
         layout.addWidget(self.clipOverallBar)
 
         self.clipProgressText = QLabel()
-        self.clipProgressText.setFixedHeight(24)
+        self.clipProgressText.setMinimumHeight(24)  # one line per clip being encoded
         self.clipProgressText.setAlignment(Qt.AlignmentFlag.AlignCenter)
         layout.addWidget(self.clipProgressText)
 
@@ -422,7 +1526,7 @@ class UiMainWindow(object):
         self.audioFrame.setFixedHeight(100)
         self.audioFrame.hideAxis('bottom')
         self.audioFrame.hideAxis('left')
-        self.audioFrame.setMouseEnabled(x=False, y=False)
+        self.audioFrame.setMouseEnabled(x=True, y=False)  # zoom and pan in time; the waveform is redrawn to match
         self.controlGridLayout.addWidget(self.audioFrame, 3, 0, 1, 1)
 
         self.boundingGridFrame = QFrame(self.centralwidget)
@@ -609,93 +1713,6 @@ class UiMainWindow(object):
     # retranslateUi
 
 
-# class FFmpegClipExporter(QThread):
-#     """With assistance from ChatGPT. Using filter_complex in ffmpeg to split multiple, cropped clips from a single
-#     video without reinitializing ffmpeg each time"""
-#     progress = Signal(str)  # To send status updates to UI
-#     finished = Signal(bool)  # True if success, False if error
-#
-#     def __init__(self, input_path, clip_times, crop, output_paths, parent=None):
-#         super().__init__(parent)
-#         self.input_path = input_path
-#         self.clip_times = clip_times  # list of (start, end) in seconds
-#         self.crop = crop              # dict: {'w':640, 'h':480, 'x':100, 'y':50}
-#         self.output_paths = output_paths  # list of output filenames
-#         self.process = None
-#
-#         # get framerate because otherwise we can have frameate drift (e.g. 30.2 fps)
-#         cmd = [
-#             "ffprobe",
-#             "-v", "error",
-#             "-select_streams", "v:0",  # first video stream
-#             "-show_entries", "stream=r_frame_rate",
-#             "-of", "json",
-#             self.input_path
-#         ]
-#         result = subprocess.run(cmd, capture_output=True, text=True)
-#
-#         info = json.loads(result.stdout)
-#         rate_str = info['streams'][0]['r_frame_rate']
-#         num, den = map(int, rate_str.split('/'))
-#         self.framerate = num / den
-#
-#     # noinspection PyUnresolvedReferences
-#     def run(self):
-#         self.process = QProcess()
-#         self.process.setProcessChannelMode(QProcess.MergedChannels)
-#         self.process.readyReadStandardError.connect(self.handle_stderr)
-#         self.process.finished.connect(self.handle_finished)
-#
-#         args = self.build_ffmpeg_args()
-#         self.process.start("ffmpeg", args)
-#         self.exec()  # Enters a nested event loop, keeps thread alive
-#
-#     def handle_stderr(self):
-#         data = self.process.readAllStandardError().data().decode()
-#         for line in data.splitlines():
-#             if "frame=" in line or "time=" in line:
-#                 self.progress.emit(line.strip())
-#
-#     # noinspection PyUnresolvedReferences
-#     def handle_finished(self):
-#         success = (self.process.exitStatus() == QProcess.NormalExit and self.process.exitCode() == 0)
-#         self.finished.emit(success)
-#         self.quit()  # Exit thread event loop
-#
-#     def build_ffmpeg_args(self):
-#         crop_str = f"crop={self.crop['w']}:{self.crop['h']}:{self.crop['x']}:{self.crop['y']}"
-#         num_clips = len(self.clip_times)
-#
-#         # Build filter_complex string
-#         filter_parts = [
-#             f"[0:v]{crop_str},split={num_clips}" + ''.join(f"[v{i}]" for i in range(num_clips)),
-#             f"[0:a]asplit={num_clips}" + ''.join(f"[a{i}]" for i in range(num_clips)),
-#         ]
-#
-#         for i, (start, end) in enumerate(self.clip_times):
-#             filter_parts += [
-#                 f"[v{i}]trim=start={start}:end={end},setpts=PTS-STARTPTS[v{i}out]",
-#                 f"[a{i}]atrim=start={start}:end={end},asetpts=PTS-STARTPTS[a{i}out]"
-#             ]
-#
-#         filter_complex = "; ".join(filter_parts)
-#
-#         args = [
-#             "-y",  # Overwrite output
-#             "-i", self.input_path,
-#             "-filter_complex", filter_complex,
-#         ]
-#
-#         for i, out in enumerate(self.output_paths):
-#             args += ["-map", f"[v{i}out]", "-map", f"[a{i}out]", out]
-#
-#         args += [
-#             "-r", self.framerate
-#         ]
-#
-#         return args
-#
-
 class MainWindow(QMainWindow, UiMainWindow):
 
     def __init__(self):
@@ -705,9 +1722,7 @@ class MainWindow(QMainWindow, UiMainWindow):
 
         print(f"Trial Splitter by Andrew Rouse (08/2025). Version {__version__}")
 
-        self.process = QProcess(self)  # for running ffmpeg without blocking the ui input
-        self.process.setProcessChannelMode(QProcess.ProcessChannelMode.MergedChannels)
-        self.process.setProgram('ffmpeg')
+        self.clipScheduler = None  # runs the ffmpeg clip exports without blocking the ui input
 
         self.loadVideoButton.clicked.connect(lambda: self.load_video())
         self.boundingLeftSpinBox.editingFinished.connect(self.update_bounding_box)
@@ -729,6 +1744,7 @@ class MainWindow(QMainWindow, UiMainWindow):
         self.setEndButton.clicked.connect(lambda: self.set_trial_end())
         self.loadParamButton.clicked.connect(lambda: self.load_settings())
         self.saveTraceButton.clicked.connect(lambda: self.split_video())
+        self.audioFrame.getViewBox().sigXRangeChanged.connect(self.update_waveform_view)
 
         # table setup
         self.trialMarkerTable.setColumnCount(3)
@@ -792,8 +1808,6 @@ class MainWindow(QMainWindow, UiMainWindow):
         self.trialdf = None
         self.folderPath = None
         # self.outputTemp = None
-        self.clipDur = None
-        self.currRow = None
         self.fullStart = None
         self.fullEnd = None
 
@@ -808,7 +1822,25 @@ class MainWindow(QMainWindow, UiMainWindow):
         # pg.setConfigOption('background', 'w')
         # pg.setConfigOption('foreground', 'k')
 
-        self.ffmpegInstalled, message = check_ffmpeg_installed()
+        # check for ffmpeg in the background; ffmpegInstalled stays None until it's known
+        self.ffmpegInstalled = None
+        self.ffmpegCheck = FFmpegCheckThread(self)
+        self.ffmpegCheck.checked.connect(self.ffmpeg_checked)
+        self.ffmpegCheck.start()
+
+        # get video codec
+        self.videoCodec = None
+        self.seekIndex = None  # keyframe index for accurate seeking
+        self.mediaCache = MediaCache()  # codec, audio envelope and keyframes of videos opened before
+        self.videoLoader = None  # background loading of the codec, seek index and audio of the current video
+        self.frameCache = FrameCache()  # decoded frames around the scrub position, for stepping back and forth
+        self.readAhead = None  # fills frameCache in the background
+        self.thumbnailBuilder = None  # builds (or loads) the thumbnails shown while dragging the slider
+
+        # self.center_on_screen()
+
+    def ffmpeg_checked(self, installed, message):
+        self.ffmpegInstalled = installed
         self.update_status(message)
         if not self.ffmpegInstalled:
             msg_box = QMessageBox()
@@ -822,11 +1854,6 @@ class MainWindow(QMainWindow, UiMainWindow):
             msg_box.setStandardButtons(QMessageBox.StandardButton.Ok)
             msg_box.exec()  # Displays the message box and waits for user interaction
 
-        # get video codec
-        self.videoCodec = None
-
-        # self.center_on_screen()
-
     def eventFilter(self, widget, event):
         """Resize the current frame with the window.
         Activates on every event, but filtered so it only affects resize events of the video frame"""
@@ -844,6 +1871,11 @@ class MainWindow(QMainWindow, UiMainWindow):
 
     def closeEvent(self, event):
         """I think this triggers when the window is closed to gracefully close the playback thread"""
+        loader = self.stop_video_loader()
+        if loader is not None:
+            loader.wait(5000)  # a cancelled loader stops at its next stage or audio chunk
+        self.stop_read_ahead()
+        self.stop_thumbnail_builder()
         # if thread hasn't initialized yet, then the stop and close methods don't exist yet so we need to check
         if hasattr(self.thread, 'stop'):
             self.thread.stop()
@@ -864,11 +1896,22 @@ class MainWindow(QMainWindow, UiMainWindow):
         self.move(frame_geo.topLeft())
 
     def load_video(self, filepath=None):
-        """Load the selected video, if provided, or prompt user to select a video"""
+        """Load the selected video, if provided, or prompt user to select a video.
+        The first frame is shown straight away; the slider and trial controls are enabled once the VideoLoader has the
+        codec and seek index (video_metadata_ready), and the waveform is drawn once it has the audio
+        (video_audio_ready)"""
         if filepath is None:
             fileName = QFileDialog.getOpenFileName(self, 'Open Video')
             if fileName[0]:
                 filepath = fileName[0]
+        if not filepath:
+            return False
+
+        # stop loading the previous video, if it's still going
+        self.stop_video_loader()
+        self.stop_read_ahead()
+        self.stop_thumbnail_builder()
+        self.frameCache.clear()
 
         self.videoPath = filepath
         self.pathLabel.setText(self.videoPath)
@@ -896,20 +1939,15 @@ class MainWindow(QMainWindow, UiMainWindow):
                 # create blank trial table
                 self.trialTable = list(range(frame_count))
 
-                # enable buttons
-                self.trackingSlider.setEnabled(True)
+                # the crop box only needs the first frame; everything that seeks waits for the seek index
+                self.block_ui(False)
+                self.loadVideoButton.setEnabled(True)
+                self.loadParamButton.setEnabled(True)
                 self.boundingLeftSpinBox.setEnabled(True)
                 self.boundingRightSpinBox.setEnabled(True)
                 self.boundingTopSpinBox.setEnabled(True)
                 self.boundingBottomSpinBox.setEnabled(True)
                 self.boundingBoxButton.setEnabled(True)
-                self.timeStartTextEdit.setEnabled(True)
-                self.saveTraceButton.setEnabled(True)
-                self.addTrialButton.setEnabled(True)
-                self.remTrialButton.setEnabled(True)
-                self.setStartButton.setEnabled(True)
-                self.setEndButton.setEnabled(True)
-                self.playVideoButton.setEnabled(True)
 
                 # display first frame
                 self.frameCurrent = frame
@@ -928,41 +1966,83 @@ class MainWindow(QMainWindow, UiMainWindow):
                 self.boundingTopSpinBox.setMaximum(self.vidHeight)
                 self.boundingBottomSpinBox.setMaximum(self.vidHeight)
 
-                # display audio
-                # fs = get_audio_fs(self.videoPath)
-
-                self.videoCodec = subprocess.run(
-                    [
-                        "ffprobe", "-v", "error",
-                        "-select_streams", "v:0",
-                        "-show_entries", "stream=codec_name",
-                        "-of", "default=noprint_wrappers=1:nokey=1",
-                        self.videoPath
-                    ],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                ).stdout.strip()
-
-                # ffmpeg
-                waveform, fs = extract_audio(self.videoPath)
-                print(f'Audio sample rate (Hz): {fs}')
-                waveform = waveform.mean(axis=1)  # convert from stereo to mono
-                dsFactor = 10
-                self.audioWaveform = waveform[::dsFactor]  # downsample for plotting efficacy
-
-                nSamp = len(self.audioWaveform)
-                time = np.linspace(0, nSamp / (fs / dsFactor), num=nSamp, endpoint=False)
-                self.audioWavePlot = self.audioFrame.plot(time, self.audioWaveform, pen=pg.mkPen('w', width=1))
-
+                # clear the last video's waveform and tracker line until the new audio is ready
+                self.audioFrame.clear()
+                self.audioWaveform = None
+                self.audioWavePlot = None
                 self.audioTrackerLine = pg.InfiniteLine(0, pen=pg.mkPen('y', width=1))
                 self.audioFrame.addItem(self.audioTrackerLine)
 
+                # codec, seek index and audio in the background
+                self.videoCodec = None
+                self.seekIndex = None
+                self.update_status("Reading video info...")
+                streamInfo = {'fps': self.videoFrameRate, 'frame_count': frame_count, 'width': self.vidWidth,
+                              'height': self.vidHeight}
+                self.videoLoader = VideoLoader(self.videoPath, self.mediaCache, meta=streamInfo, parent=self)
+                self.videoLoader.metadata_ready.connect(self.video_metadata_ready)
+                self.videoLoader.audio_ready.connect(self.video_audio_ready)
+                self.videoLoader.start()
+
                 # EventFilter resizes the frame as the window resizes
                 self.videoFrame.installEventFilter(self)
 
                 return True
 
+    def stop_video_loader(self):
+        """Cancel the background loading of the current video; it's deleted once its thread finishes.
+        Returns the cancelled loader (or None)"""
+        loader = self.videoLoader
+        if loader is None:
+            return None
+        self.videoLoader = None
+        loader.metadata_ready.disconnect(self.video_metadata_ready)
+        loader.audio_ready.disconnect(self.video_audio_ready)
+        loader.cancel()
+        if loader.isRunning():
+            loader.finished.connect(loader.deleteLater)
+        else:
+            loader.deleteLater()
+        return loader
+
+    def stop_thumbnail_builder(self):
+        if self.thumbnailBuilder is not None:
+            self.thumbnailBuilder.cancel()
+            self.thumbnailBuilder.wait()
+            self.thumbnailBuilder.deleteLater()
+            self.thumbnailBuilder = None
+
+    def stop_read_ahead(self):
+        if self.readAhead is not None:
+            self.readAhead.stop()
+            self.readAhead.deleteLater()
+            self.readAhead = None
+
+    def video_metadata_ready(self, video_path, codec, seek_index):
+        """The loader has the codec and seek index: seeking is accurate now, so enable the slider and trial controls"""
+        if video_path != self.videoPath:
+            return
+        self.videoCodec = codec or None
+        self.seekIndex = seek_index
+        self.readAhead = FrameReadAhead(self.videoPath, self.frameCache, seek_index=seek_index,
+                                        frame_count=self.trackingSlider.maximum(), parent=self)
+        self.readAhead.start()
+        self.thumbnailBuilder = ThumbnailBuilder(self.videoPath, seek_index, self.vidWidth, self.vidHeight,
+                                                 fallback_folder=self.mediaCache.entry_dir(self.videoPath), parent=self)
+        self.thumbnailBuilder.start()
+        self.block_ui(True)
+        self.update_status("Reading audio...")
+
+    def video_audio_ready(self, video_path, waveform):
+        """The loader has the audio envelope: draw the waveform"""
+        if video_path != self.videoPath:
+            return
+        self.audioWaveform = waveform
+        if waveform is not None:
+            self.audioWavePlot = self.audioFrame.plot(pen=pg.mkPen('w', width=1))
+            self.show_whole_waveform()
+        self.update_status("Video loaded" if waveform is not None else "Video loaded (no audio)")
+
     # noinspection PyUnresolvedReferences
     def load_settings(self):
         """Load a previously saved settings file"""
@@ -1003,6 +2083,11 @@ class MainWindow(QMainWindow, UiMainWindow):
     def set_box(self):
         """Set the bounding/crop box by selecting on the frame itself"""
         # self.bbox = (1261, 586, 60, 72)
+        if self.frameCurrent.shape[1] != self.vidWidth:
+            # showing a downscaled frame from the frame cache; the box has to be drawn on the full size frame
+            ret, frame = seek_frame(self.cap, self.frameCurrentNumber, self.seekIndex)
+            if ret:
+                self.frameCurrent = frame
         frameCopy = self.frameCurrent  # make a copy of the frame and add the rectangle to it rather than the original
 
         # set up instruction text
@@ -1109,8 +2194,8 @@ class MainWindow(QMainWindow, UiMainWindow):
                 self.trialMarkerTable.item(row, 0).setData(Qt.DisplayRole, row + 1)
 
     def video_play(self):
-        """Start playing the video. This won't play at realtime speed because this is a hacky way of loading and
-        displaying the video, plus all the other processes that happen"""
+        """Start playing the video. Frames are decoded at the video's frame rate, and the display skips frames if it
+        can't keep up"""
         # update the play button
         self.playVideoButton.setText("Pause")
         self.playVideoButton.clicked.disconnect(self.video_play)
@@ -1119,10 +2204,14 @@ class MainWindow(QMainWindow, UiMainWindow):
         self.timeStartTextEdit.setEnabled(False)
         self.trackingSlider.setEnabled(False)
 
+        # frames shown from the frame cache don't move the capture, so make sure playback starts from the current frame
+        if int(self.cap.get(cv2.CAP_PROP_POS_FRAMES)) != self.frameCurrentNumber:
+            seek_frame(self.cap, self.frameCurrentNumber, self.seekIndex)
+
         # create the video capture thread
-        self.thread = VideoThread(self.cap)
+        self.thread = VideoThread(self.cap, playback_fps=self.videoFrameRate)
         # connect its signal to the update_image slot
-        self.thread.change_pixmap_signal.connect(self.update_tracker)
+        self.thread.frame_ready.connect(self.update_tracker)
         # start the thread
         self.thread.start()
 
@@ -1134,7 +2223,7 @@ class MainWindow(QMainWindow, UiMainWindow):
         self.thread.stop()
         self.timeStartTextEdit.setEnabled(True)
         self.trackingSlider.setEnabled(True)
-        # self.thread.change_pixmap_signal.disconnect(self.update_tracker)
+        # self.thread.frame_ready.disconnect(self.update_tracker)
 
     # def load_frame(self, targetFrame):
     #     # set the tracking slider to the specified frame, including loading the new image
@@ -1149,7 +2238,8 @@ class MainWindow(QMainWindow, UiMainWindow):
 
     def drag_on(self):
         """User started dragging the slider. Changing the slider triggers adjust_trackingslider, so user_dragging is a
-        flag that keeps frames from loading while you drag - otherwise dragging would be very slow"""
+        flag that keeps frames from loading while you drag - otherwise dragging would be very slow. Thumbnails are
+        shown instead (see user_move_slider)"""
         self.user_dragging = True
 
     def drag_off(self):
@@ -1172,15 +2262,20 @@ class MainWindow(QMainWindow, UiMainWindow):
         if not self.user_dragging:
             targetFrame = self.trackingSlider.value()
             self.frameCurrentNumber = targetFrame
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, targetFrame - 1)
-            ret, cv_img = self.cap.read()
-            if ret:
-                self.update_image(cv_img, self.frameCurrentNumber)
+            self.show_frame(targetFrame)
 
     def user_move_slider(self, targetFrame):
-        """user is dragging the slider - update the timestamp based on slider position without loading a new frame"""
+        """user is dragging the slider - update the timestamp based on slider position without loading a new frame,
+        and show the nearest thumbnail if there is one"""
         self.update_timestamp(targetFrame)
         self.update_audio_tracker(targetFrame)
+        index = self.thumbnailBuilder.index if self.thumbnailBuilder is not None else None
+        if index is not None:
+            thumbnail = index.get((targetFrame - 1) / self.videoFrameRate)
+            if thumbnail is not None:
+                frame = self.convert_cv_qt(self.draw_crop_box(thumbnail))
+                self.videoFrame.setPixmap(frame)
+                self.videoFrame.pixmap = QPixmap(frame)
 
     def user_set_time(self):
         """User set the timestamp - set the slider, load the new frame"""
@@ -1198,14 +2293,26 @@ class MainWindow(QMainWindow, UiMainWindow):
 
         # now load the frame at the slider position
         self.frameCurrentNumber = targetFrame
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, targetFrame - 1)
-        ret, cv_img = self.cap.read()
-        if ret:
-            self.update_image(cv_img, self.frameCurrentNumber)
-
-    def update_tracker(self, frame, frame_number):
-        """Triggered by playing the video - updates the video frame """
-        if frame_number <= int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)):
+        self.show_frame(targetFrame)
+
+    def show_frame(self, targetFrame):
+        """Display a frame, from the frame cache if it's there, otherwise decoded (and cached). Then have the
+        read-ahead thread decode the frames around it, so stepping to the next or previous frame is instant"""
+        cv_img = self.frameCache.get(targetFrame)
+        if cv_img is None:
+            ret, cv_img = seek_frame(self.cap, targetFrame, self.seekIndex)
+            if not ret:
+                return
+            self.frameCache.put(targetFrame, cv_img)
+        self.update_image(cv_img, targetFrame)
+        if self.readAhead is not None:
+            self.readAhead.request(targetFrame)
+
+    def update_tracker(self):
+        """Triggered by playing the video - updates the video frame with the newest frame from the thread"""
+        preview = self.thread.take_preview()
+        if preview is not None:
+            frame, frame_number = preview
             # Display result
             self.update_image(frame, frame_number)
 
@@ -1216,6 +2323,32 @@ class MainWindow(QMainWindow, UiMainWindow):
             # self.audioTrackerLine.setData([newTS, newTS], [-10, 10])
             self.audioTrackerLine.setPos(newTS)
 
+            # when zoomed in, keep the tracking line in view
+            viewStart, viewEnd = self.audioFrame.getViewBox().viewRange()[0]
+            if not viewStart <= newTS <= viewEnd:
+                halfWidth = (viewEnd - viewStart) / 2
+                self.audioFrame.setXRange(newTS - halfWidth, newTS + halfWidth, padding=0)
+
+    def show_whole_waveform(self):
+        """Fit the audio plot to the whole waveform, which is also as far as it can be zoomed out"""
+        duration = self.audioWaveform.duration()
+        yMin, yMax = self.audioWaveform.amplitude_range()
+        viewBox = self.audioFrame.getViewBox()
+        viewBox.enableAutoRange(enable=False)
+        viewBox.setLimits(xMin=0, xMax=duration, minXRange=min(duration, 0.01))
+        self.audioFrame.setYRange(yMin, yMax, padding=0.05)
+        self.audioFrame.setXRange(0, duration, padding=0)
+        self.update_waveform_view()
+
+    def update_waveform_view(self):
+        """Redraw the audio waveform from the pyramid level matching the current zoom"""
+        if self.audioWaveform is None or self.audioWavePlot is None:
+            return
+        viewStart, viewEnd = self.audioFrame.getViewBox().viewRange()[0]
+        maxBins = max(self.audioFrame.width(), 100)  # about one bin per pixel
+        time, wave = self.audioWaveform.query(viewStart, viewEnd, maxBins)
+        self.audioWavePlot.setData(time, wave)
+
     def update_timestamp(self, targetFrame):
         """Update value of timeStartTextEdit based on frame number, without triggering the signal"""
         # targetFrame = self.trackingSlider.value()
@@ -1226,11 +2359,8 @@ class MainWindow(QMainWindow, UiMainWindow):
 
     @Slot(np.ndarray)
     def update_image(self, cv_img, frame_number):
-        """Updates the image_label with a new opencv image"""
-        if all(x > 0 for x in self.bbox):
-            # self.bboxPainter.drawRect(self.cropX, self.cropY, self.cropWidth, self.cropHeight)
-            cv2.rectangle(cv_img, (self.cropX, self.cropY), (self.cropX + self.cropWidth, self.cropY + self.cropHeight),
-                          (255, 0, 0), 3)
+        """Updates the image_label with a new opencv image (full size, or downscaled from the frame cache)"""
+        cv_img = self.draw_crop_box(cv_img)
 
         self.frameCurrent = cv_img
         frame = self.convert_cv_qt(cv_img)
@@ -1238,6 +2368,19 @@ class MainWindow(QMainWindow, UiMainWindow):
         self.videoFrame.pixmap = QPixmap(frame)
         self.update_frame_number(frame_number)
 
+    def draw_crop_box(self, cv_img):
+        """Copy of the image with the crop box drawn on, scaled to the image size (frames in the frame cache and
+        thumbnails are smaller than the video). The image itself is left clean"""
+        if not all(x > 0 for x in self.bbox):
+            return cv_img
+        # self.bboxPainter.drawRect(self.cropX, self.cropY, self.cropWidth, self.cropHeight)
+        cv_img = np.array(cv_img)
+        scale = cv_img.shape[1] / self.vidWidth if self.vidWidth else 1
+        cv2.rectangle(cv_img, (round(self.cropX * scale), round(self.cropY * scale)),
+                      (round((self.cropX + self.cropWidth) * scale), round((self.cropY + self.cropHeight) * scale)),
+                      (255, 0, 0), max(1, round(3 * scale)))
+        return cv_img
+
     def convert_cv_qt(self, cv_img):
         """Convert from an opencv image to QPixmap"""
         rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
@@ -1332,7 +2475,7 @@ class MainWindow(QMainWindow, UiMainWindow):
                     msg_box.exec()  # Displays the message box and waits for user interaction
                     return
                 self.block_ui(False)
-                
+
                 # start clipping
                 if self.progressBar:
                     self.progressBar.show()
@@ -1472,117 +2615,145 @@ class MainWindow(QMainWindow, UiMainWindow):
     #     # print(output)
     #     pass
 
-    def clip_output_parse(self):
-        """Parse the clipping process outout to get progress"""
-        while self.process.canReadLine():
-            line = self.process.readLine().data().decode("utf-8").strip()
-            if line.startswith("out_time="):
-                self.progressDialog.update_clip_text("Encoding clip...")
-                # timeStr = line.split("=")[1]
-                # if timeStr != "N/A":
-                #     t = get_seconds_from_time(timeStr)
-                #     percent = int((t / self.clipDur) * 100)
-                #
-                #     # self.progressDialog.update_clip_progress(percent)
+    def clip_jobs(self):
+        """ffmpeg jobs for the clip scheduler: one per trial, or a single job for all trials with CLIP_EXPORT_MODE
+        'single'. Without a crop, trials are stream copied instead (see CLIP_COPY_MODE)"""
+        crop = (self.cropX, self.cropY, self.cropWidth, self.cropHeight)
+        clips = []
+        for row in range(self.trialCount):
+            trialN = self.trialdf.loc[row, 'Trial']
+            currFileName = self.videoName + "_t" + trialN + self.videoExt
+            clips.append((trialN, os.path.join(self.folderPath, currFileName),
+                          self.trialdf.loc[row, 'Start'], self.trialdf.loc[row, 'End']))
+
+        nWorkers = clip_worker_count(len(clips))
+        copyMode = CLIP_COPY_MODE if not needs_reencode(crop, self.vidWidth, self.vidHeight) else None
+        if copyMode:
+            try:
+                stream = probe_video_stream(self.videoPath)
+            except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
+                print(f"Could not read the video stream info: {e}")
+                stream = {}
+            if copyMode == 'smart' and (self.seekIndex is None or smart_cut_encoder_args(stream) is None):
+                # smart cut needs to know where the keyframes are, and an encoder that can match the source
+                print(f"Can't smart cut {stream.get('codec_name')} ({stream.get('profile')}), "
+                      f"stream copying from the keyframes instead")
+                copyMode = 'keyframe'
+            jobs = []
+            keyframeTimes = None
+            if self.seekIndex is not None:
+                keyframeTimes = self.seekIndex.keyframe_times(start_time=stream.get('start_time', 0.0))
+            for trialN, outputPath, start, end in clips:
+                startSec = get_seconds_from_time(start)
+                endSec = get_seconds_from_time(end)
+                if copyMode == 'smart':
+                    steps, temp = build_smart_cut_steps(self.videoPath, outputPath, start, end, keyframeTimes,
+                                                        stream, framerate=self.videoFrameRate,
+                                                        threads=encoder_thread_count(nWorkers))
+                else:
+                    if keyframeTimes is not None:
+                        # cut where ffmpeg will actually start the copy, so the clip still runs to the trial end
+                        startSec = float(keyframeTimes[max(np.searchsorted(keyframeTimes, startSec, side='right') - 1,
+                                                           0)])
+                    steps = [(build_copy_clip_args(self.videoPath, outputPath, startSec, endSec), endSec - startSec)]
+                    temp = None
+                jobs.append({'name': f"trial {trialN}", 'steps': steps, 'duration': sum(d for _, d in steps),
+                             'temp': temp, 'mode': copyMode})
+            return jobs
+
+        if CLIP_EXPORT_MODE == 'single':
+            fullStart = min(get_seconds_from_time(start) for _, _, start, _ in clips)
+            fullEnd = max(get_seconds_from_time(end) for _, _, _, end in clips)
+            args = build_multi_clip_args(self.videoPath, [clip[1:] for clip in clips], crop=crop,
+                                         codec=self.videoCodec, framerate=self.videoFrameRate,
+                                         audio=has_audio_stream(self.videoPath))
+            return [{'name': f"all {self.trialCount} trials", 'steps': [(args, fullEnd - fullStart)],
+                     'duration': fullEnd - fullStart, 'mode': 'single'}]
+
+        jobs = []
+        for trialN, outputPath, start, end in clips:
+            args = build_clip_args(self.videoPath, outputPath, start, end, crop=crop, codec=self.videoCodec,
+                                   framerate=self.videoFrameRate, threads=encoder_thread_count(nWorkers))
+            duration = get_seconds_from_time(end) - get_seconds_from_time(start)
+            jobs.append({'name': f"trial {trialN}", 'steps': [(args, duration)], 'duration': duration, 'mode': 'seek'})
+        return jobs
 
     def start_clipping(self):
-        """Create progress bar window and start the clipping process"""
-        self.process.readyReadStandardOutput.connect(self.clip_output_parse)
-        self.process.finished.connect(self.clipping_finished)
-        self.currRow = 0
-        self.progressDialog = ProgressDialog(self.trialCount)
+        """Create progress bar window and start the clipping processes"""
+        jobs = self.clip_jobs()
+        self.progressDialog = ProgressDialog()
         self.progressDialog.cancel_requested.connect(self.stop_process)
         self.progressDialog.show()
-        self.start_clip_video()
 
-    def stop_process(self):
-        """Interrupt the QProcess if cancel button clicked on dialog"""
-        if self.process and self.process.state() != QProcess.ProcessState.NotRunning:
-            self.process.kill()
-            self.block_ui(True)
-
-    def start_clip_video(self):
-        """Start clipping the next video"""
-        trialN = self.trialdf.loc[self.currRow, 'Trial']
-        start = self.trialdf.loc[self.currRow, 'Start']
-        end = self.trialdf.loc[self.currRow, 'End']
-
-        # update the progress dialog with clip info
-        self.progressDialog.update_overall_text(
-            f'Clipping trial {trialN} of {self.trialCount} (Clip {self.currRow})')
-        self.progressDialog.update_overall_progress(self.currRow)
-        self.progressDialog.update_clip_text("Decoding clip... (This may take awhile)")
-        # self.progressDialog.update_clip_progress(0)
-
-        # self.currRow = trialN
-        currFileName = self.videoName + "_t" + trialN + self.videoExt
-        output_path = os.path.join(self.folderPath, currFileName)
-
-        # Step 2: Build FFmpeg command
-        ffmpeg_cmd = [
-            "-y", "-i", self.videoPath,
-            "-ss", start,
-            "-to", end,
-            "-vf", f"crop={self.cropWidth}:{self.cropHeight}:{self.cropX}:{self.cropY}",
-            "-map", "0:v",  # To remove any extra streams
-            "-map", "0:a?"
-        ]
+        nWorkers = clip_worker_count(len(jobs))
+        logPath = os.path.join(self.folderPath, CLIP_LOG_NAME) if CLIP_LOG_NAME else None
+        logInfo = {'video': self.videoPath, 'codec': self.videoCodec, 'framerate': self.videoFrameRate,
+                   'crop': [self.cropX, self.cropY, self.cropWidth, self.cropHeight], 'workers': nWorkers,
+                   'cpus': os.cpu_count()}
+        self.clipScheduler = ClipScheduler(jobs, max_workers=nWorkers, log_path=logPath, log_info=logInfo, parent=self)
+        self.clipScheduler.job_started.connect(self.clip_status_changed)
+        self.clipScheduler.job_progress.connect(self.clip_status_changed)
+        self.clipScheduler.job_finished.connect(self.clip_status_changed)
+        self.clipScheduler.all_finished.connect(self.clipping_finished)
+        self.clipScheduler.start()
 
-        # Video codec and settings
-        if self.videoCodec == "hevc":
-            ffmpeg_cmd += ["-c:v", "libx265"]
+    def stop_process(self):
+        """Interrupt the running ffmpeg processes if cancel button clicked on dialog"""
+        if self.clipScheduler and self.clipScheduler.is_running():
+            self.clipScheduler.cancel()
+
+    def clip_status_changed(self):
+        """A clip started, progressed or finished - update the progress dialog"""
+        scheduler = self.clipScheduler
+        progress = scheduler.overall_progress()
+        eta = scheduler.eta()
+        overallText = f'Clipped {scheduler.nDone} of {len(scheduler.jobs)} ({progress:.0%})'
+        if scheduler.failed:
+            overallText += f', {len(scheduler.failed)} failed'
+        if eta is not None:
+            overallText += f' - about {get_time_from_seconds(eta).split(".")[0]} left'
+        self.progressDialog.update_overall_progress(round(100 * progress))
+        self.progressDialog.update_overall_text(overallText)
+
+        clipLines = []
+        for i in scheduler.running:
+            stats = scheduler.stats[i]
+            line = f"{scheduler.jobs[i]['name']}: {scheduler.progress[i]:.0%}"
+            if stats['speed'] is not None:
+                line += f", {stats['speed']:.2f}x"
+            if stats['fps'] is not None:
+                line += f", {stats['fps']:.0f} frames/s"
+            clipLines.append(line)
+        if clipLines:
+            self.progressDialog.update_clip_text("\n".join(clipLines))
+
+    def clipping_finished(self, n_failed):
+        """All clipping processes finished (or were cancelled). Reenable the interface"""
+        scheduler = self.clipScheduler
+        if scheduler.cancelled:
+            msg = f"Export cancelled after {scheduler.nDone - n_failed} of {len(scheduler.jobs)} clips"
+            self.progressDialog.update_overall_text("Export cancelled")
+        elif n_failed:
+            failedNames = ", ".join(scheduler.jobs[i]['name'] for i in scheduler.failed)
+            msg = f"Export finished, but {n_failed} clip(s) failed: {failedNames}"
+            self.progressDialog.update_overall_text(f"{n_failed} clip(s) failed!")
         else:
-            ffmpeg_cmd += ["-c:v", "libx264"]  # fallback
-
-        if self.videoFrameRate:
-            ffmpeg_cmd += ["-r", str(self.videoFrameRate)]
-
-        # # set keyframe freq
-        # ffmpeg_cmd += ["-g", "15"]
-
-        # Audio copy
-        ffmpeg_cmd += ["-c:a", "copy"]
-
-        ffmpeg_cmd += ["-progress", "pipe:1",
-                       "-nostats"]
-
-        ffmpeg_cmd += [output_path]
-
-        # # get number of frames for progress bar
-        startSec = get_seconds_from_time(start)
-        endSec = get_seconds_from_time(end)
-        self.clipDur = endSec - startSec
-
-        # self.update_status(f'Step 2: Clipping trial {trialN} of {self.trialCount} (Clip {self.currRow})')
-        # if self.progressBar:
-        #     progress = 100 * (int(trialN) / self.trialCount)
-        #     self.progressBar.setValue(progress)
-        # self.process.setProgram('ffmpeg')
-        self.process.setArguments(ffmpeg_cmd)
-        self.process.start()
-
-    def clipping_finished(self):
-        """Current clipping process finished. Either move on to next trial or reenable the interface"""
-        if self.currRow >= self.trialCount - 1:
-
             msg = "Export complete!"
-            self.update_status(msg)
-
-            self.progressDialog.update_overall_progress(self.trialCount)
             self.progressDialog.update_overall_text("All clips exported!")
-            self.progressDialog.cancelButton.setText("Done")
-            self.block_ui(True)
-
-            # # remove the temporary clipped file
-            # if os.path.exists(self.outputTemp):
-            #     os.remove(self.outputTemp)
-            #     print('Temp file removed successfully')
-            # else:
-            #     print('Temp file does not exist')
-
-        else:
-            self.currRow += 1
-            self.start_clip_video()
+        self.update_status(msg)
+
+        self.progressDialog.update_overall_progress(100)
+        self.progressDialog.update_clip_text(f"Took {get_time_from_seconds(time.perf_counter() - scheduler.timeStart)}"
+                                             if scheduler.timeStart else "")
+        self.progressDialog.cancelButton.setText("Done")
+        self.block_ui(True)
+
+        # # remove the temporary clipped file
+        # if os.path.exists(self.outputTemp):
+        #     os.remove(self.outputTemp)
+        #     print('Temp file removed successfully')
+        # else:
+        #     print('Temp file does not exist')
 
     def block_ui(self, editable=True):
         self.trackingSlider.setEnabled(editable)
@@ -0,0 +1,210 @@
+"""On-disk cache of what TrialTrim works out about a video: the audio waveform envelope, the keyframe index and basic
+stream info (codec, frame rate, frame count, audio sample rate).
+
+Each video gets a folder in the cache, named from a fingerprint of the file: its path, size, modification time and a
+hash of a few samples of its content. Arrays are saved as .npy files and loaded memory-mapped, so reopening a long
+video doesn't read the whole envelope into memory; everything else goes in a small meta.json next to them. If the
+video changes, its fingerprint no longer matches and the old entry is simply never used again (and eventually
+evicted).
+
+The cache is capped in size; when it grows past the cap the least recently used entries are deleted.
+
+Usage (to clear the cache, or the entries for particular videos):
+> python media_cache.py --clear [video ...]
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # total size of the cache before old entries are evicted
+HASH_SAMPLE_BYTES = 1 << 20  # bytes read from the start, middle and end of a video for its content hash
+
+
+def default_cache_dir():
+    """Per-user cache folder (%LOCALAPPDATA%\\TrialTrim\\cache on Windows, ~/.cache/TrialTrim elsewhere)"""
+    base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "TrialTrim", "cache")
+
+
+def content_hash(file_path, sample_bytes=HASH_SAMPLE_BYTES):
+    """Hash of the file size and samples from its start, middle and end. Reading the whole of a multi-GB video would
+    take longer than what the cache saves, and these samples change whenever a video is re-encoded or replaced"""
+    size = os.path.getsize(file_path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(file_path, 'rb') as f:
+        for offset in sorted({0, max(size // 2 - sample_bytes // 2, 0), max(size - sample_bytes, 0)}):
+            f.seek(offset)
+            digest.update(f.read(sample_bytes))
+    return digest.hexdigest()
+
+
+def file_fingerprint(file_path):
+    """Path, size, modification time and content hash of a file"""
+    stat = os.stat(file_path)
+    return {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'hash': content_hash(file_path)}
+
+
+class MediaCache(object):
+    """Cache entries are folders holding meta.json ({'fingerprint': ..., 'meta': {...}}) and one .npy per array.
+    The modification time of meta.json doubles as the entry's last use, for eviction. put is safe to call from several
+    threads (e.g. the GUI and a VideoLoader)"""
+
+    def __init__(self, cache_dir=None, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.fingerprints = {}  # path: (size, mtime, fingerprint), so each file is only hashed once per session
+        self.lock = threading.Lock()  # one put at a time, so merging into meta.json doesn't lose another put's keys
+
+    def fingerprint(self, video_path):
+        stat = os.stat(video_path)
+        known = self.fingerprints.get(os.path.abspath(video_path))
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime):
+            return known[2]
+        fingerprint = file_fingerprint(video_path)
+        self.fingerprints[fingerprint['path']] = (stat.st_size, stat.st_mtime, fingerprint)
+        return fingerprint
+
+    def key(self, video_path):
+        fingerprint = self.fingerprint(video_path)
+        keyStr = json.dumps([fingerprint[k] for k in ('path', 'size', 'mtime', 'hash')])
+        return hashlib.blake2b(keyStr.encode(), digest_size=16).hexdigest()
+
+    def entry_dir(self, video_path):
+        return os.path.join(self.cache_dir, self.key(video_path))
+
+    def get(self, video_path):
+        """Cached metadata for the video (dict), or None if it isn't cached. Marks the entry as recently used"""
+        metaPath = os.path.join(self.entry_dir(video_path), "meta.json")
+        try:
+            with open(metaPath) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('fingerprint') != self.fingerprint(video_path):
+            return None
+        try:
+            os.utime(metaPath)
+        except OSError:
+            pass
+        return entry.get('meta', {})
+
+    def get_array(self, video_path, name):
+        """A cached array, memory-mapped read-only, or None if it isn't cached"""
+        arrayPath = os.path.join(self.entry_dir(video_path), name + ".npy")
+        if not os.path.exists(arrayPath):
+            return None
+        try:
+            return np.load(arrayPath, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            print(f"Could not read cached {name} for {video_path}: {e}")
+            return None
+
+    def put(self, video_path, meta=None, arrays=None):
+        """Add metadata (merged into anything already cached) and arrays to the video's entry, then evict old entries
+        if the cache is over its size limit. Failures are printed, not raised: the cache is only ever an optimisation"""
+        entryDir = self.entry_dir(video_path)
+        with self.lock:
+            try:
+                os.makedirs(entryDir, exist_ok=True)
+                for name, array in (arrays or {}).items():
+                    self.write_file(entryDir, name + ".npy", lambda f: np.save(f, np.asarray(array)))
+
+                allMeta = self.get(video_path) or {}
+                allMeta.update(meta or {})
+                entry = {'fingerprint': self.fingerprint(video_path), 'meta': allMeta}
+                self.write_file(entryDir, "meta.json", lambda f: f.write(json.dumps(entry).encode()))
+            except OSError as e:
+                print(f"Could not write to the cache at {entryDir}: {e}")
+                return
+            self.evict(keep=entryDir)
+
+    @staticmethod
+    def write_file(entry_dir, name, write):
+        """Write a file in an entry via a uniquely named temporary file and a rename, so a reader never sees a
+        half-written file and two writers (threads or TrialTrim windows) never share a temporary file"""
+        fd, tempPath = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=entry_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tempPath, os.path.join(entry_dir, name))
+        except Exception:
+            try:
+                os.remove(tempPath)
+            except OSError:
+                pass
+            raise
+
+    def invalidate(self, video_path=None):
+        """Delete the cached entry for a video, or the whole cache if no video is given"""
+        if video_path is None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self.fingerprints = {}
+        else:
+            shutil.rmtree(self.entry_dir(video_path), ignore_errors=True)
+
+    def entries(self):
+        """(last used, size in bytes, folder) of every entry in the cache"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        result = []
+        for name in os.listdir(self.cache_dir):
+            entryDir = os.path.join(self.cache_dir, name)
+            metaPath = os.path.join(entryDir, "meta.json")
+            if not os.path.isdir(entryDir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entryDir, f)) for f in os.listdir(entryDir))
+            lastUsed = os.path.getmtime(metaPath) if os.path.exists(metaPath) else 0
+            result.append((lastUsed, size, entryDir))
+        return result
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until the cache fits in max_bytes (never the entry in keep)"""
+        try:
+            entries = sorted(self.entries())
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for lastUsed, size, entryDir in entries:
+            if total <= self.max_bytes:
+                break
+            if entryDir == keep:
+                continue
+            shutil.rmtree(entryDir, ignore_errors=True)
+            total -= size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the TrialTrim video cache")
+    parser.add_argument('videos', nargs='*', help="videos to clear from the cache (default: all)")
+    parser.add_argument('--clear', action='store_true', help="delete the cached entries")
+    parser.add_argument('--cache-dir', default=None, help=f"cache folder (default: {default_cache_dir()})")
+    args = parser.parse_args(argv)
+
+    cache = MediaCache(args.cache_dir)
+    if args.clear:
+        if args.videos:
+            for video in args.videos:
+                cache.invalidate(video)
+        else:
+            cache.invalidate()
+        print("Cache cleared")
+    entries = cache.entries()
+    print(f"{cache.cache_dir}: {len(entries)} entries, "
+          f"{sum(size for _, size, _ in entries) / 1024 ** 2:.1f} MB of {cache.max_bytes / 1024 ** 2:.0f} MB")
+    for lastUsed, size, entryDir in sorted(entries, reverse=True):
+        print(f"  {time.strftime('%Y-%m-%d %H:%M', time.localtime(lastUsed))}  {size / 1024 ** 2:8.1f} MB  "
+              f"{os.path.basename(entryDir)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
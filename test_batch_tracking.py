@@ -0,0 +1,109 @@
+"""Tests for batch_tracking.py: reading and checking the manifest, and skipping what earlier runs finished.
+
+Run with:
+> python -m pytest test_batch_tracking.py
+"""
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+pd = pytest.importorskip("pandas")
+
+from batch_tracking import (append_progress, read_manifest, read_progress, run_batch, run_job, PROGRESS_COLUMNS)
+from tracking import npz_parts_path, resolve_profile, DEFAULT_PROFILE
+
+
+def write_manifest(tmp_path, rows):
+    path = str(tmp_path / "manifest.csv")
+    pd.DataFrame(rows).to_csv(path, index=False)
+    return path
+
+
+def row(video, **extra):
+    return dict({'Video': video, 'bboxX': 1, 'bboxY': 2, 'bboxWidth': 3, 'bboxHeight': 4}, **extra)
+
+
+def test_read_manifest_fills_in_the_optional_columns(tmp_path):
+    video = str(tmp_path / "session.mp4")
+    jobs = read_manifest(write_manifest(tmp_path, [row(video)]))
+
+    assert len(jobs) == 1
+    job = jobs[0]
+    assert job['video'] == video
+    assert job['bbox'] == (1, 2, 3, 4)
+    assert job['tracker'] == DEFAULT_PROFILE
+    assert job['profile'] == resolve_profile(DEFAULT_PROFILE)
+    assert job['start_frame'] == 1
+    assert job['output'] == str(tmp_path / "session_trace.csv")
+
+
+def test_read_manifest_puts_outputs_in_the_output_dir(tmp_path):
+    jobs = read_manifest(write_manifest(tmp_path, [row(str(tmp_path / "session.mp4"))]), output_dir="traces")
+    assert jobs[0]['output'] == os.path.join("traces", "session_trace.csv")
+
+
+def test_read_manifest_rejects_missing_columns(tmp_path):
+    path = write_manifest(tmp_path, [{'Video': "session.mp4", 'bboxX': 1}])
+    with pytest.raises(ValueError, match="bboxHeight"):
+        read_manifest(path)
+
+
+def test_read_manifest_rejects_unknown_trackers(tmp_path):
+    path = write_manifest(tmp_path, [row("session.mp4", Tracker="no-such-profile")])
+    with pytest.raises(ValueError):
+        read_manifest(path)
+
+
+def test_read_manifest_rejects_rows_sharing_an_output(tmp_path):
+    # the same video twice with the default output would overwrite one trace with the other
+    path = write_manifest(tmp_path, [row("session.mp4"), row("session.mp4", Tracker="fast")])
+    with pytest.raises(ValueError, match="share an output"):
+        read_manifest(path)
+
+
+def test_read_manifest_allows_a_video_twice_with_different_outputs(tmp_path):
+    path = write_manifest(tmp_path, [row("session.mp4", Output="a.csv"), row("session.mp4", Output="b.csv")])
+    assert [job['output'] for job in read_manifest(path)] == ["a.csv", "b.csv"]
+
+
+def test_read_progress_only_counts_finished_outputs_that_exist(tmp_path):
+    progressPath = str(tmp_path / "manifest_progress.csv")
+    done = str(tmp_path / "done.csv")
+    deleted = str(tmp_path / "deleted.csv")
+    failed = str(tmp_path / "failed.csv")
+    open(done, 'w').close()
+    open(failed, 'w').close()
+    append_progress(progressPath, {'Video': "v.mp4", 'Output': done, 'Status': 'done'})
+    append_progress(progressPath, {'Video': "v.mp4", 'Output': deleted, 'Status': 'done'})
+    append_progress(progressPath, {'Video': "v.mp4", 'Output': failed, 'Status': 'error'})
+
+    assert read_progress(progressPath) == {done}
+    assert read_progress(str(tmp_path / "no_progress.csv")) == set()
+
+
+def test_run_batch_skips_rows_already_done(tmp_path):
+    outputs = [str(tmp_path / "a.csv"), str(tmp_path / "b.csv")]
+    manifestPath = write_manifest(tmp_path, [row("session.mp4", Output=output) for output in outputs])
+    for output in outputs:
+        open(output, 'w').close()
+        append_progress(str(tmp_path / "manifest_progress.csv"),
+                        dict(dict.fromkeys(PROGRESS_COLUMNS, ''), Video="session.mp4", Output=output, Status='done'))
+
+    summarydf = run_batch(manifestPath)  # nothing left to track, so no video is opened
+    assert sorted(summarydf['Output']) == outputs
+    assert (summarydf['Status'] == 'done').all()
+    assert os.path.exists(str(tmp_path / "manifest_summary.csv"))
+
+
+def test_run_job_reports_an_unreadable_video_without_leaving_output(tmp_path):
+    output = str(tmp_path / "missing_trace.npz")
+    job = {'video': str(tmp_path / "missing.mp4"), 'bbox': (1, 2, 3, 4), 'tracker': DEFAULT_PROFILE,
+           'profile': resolve_profile(DEFAULT_PROFILE), 'start_frame': 1, 'output': output}
+
+    record = run_job(job)
+    assert record['Status'] == 'error'
+    assert record['Output'] == output
+    assert not os.path.exists(output)
+    assert not os.path.exists(npz_parts_path(output))
@@ -0,0 +1,121 @@
+"""Tests for the non-GUI helpers in main_trim.py: the seek index, the waveform pyramid and the clip arguments.
+
+Run with:
+> python -m pytest test_main_trim.py
+"""
+import subprocess
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+pytest.importorskip("pyqtgraph")
+pytest.importorskip("PySide6")
+
+import main_trim
+from main_trim import (build_copy_clip_args, build_seek_index, envelope_plot_data, fill_missing_times,
+                       smart_cut_encoder_args, SeekIndex, WaveformPyramid)
+
+
+def fake_ffprobe(monkeypatch, stdout):
+    """Make build_seek_index read stdout as if ffprobe had printed it"""
+    def run(args, **kwargs):
+        return subprocess.CompletedProcess(args, 0, stdout=stdout, stderr="")
+    monkeypatch.setattr(main_trim.subprocess, 'run', run)
+
+
+def test_fill_missing_times():
+    pts = np.array([0.0, np.nan, 0.2, np.nan, np.nan, 0.5])
+    np.testing.assert_allclose(fill_missing_times(pts), [0.0, 0.1, 0.2, 0.3, 0.4, 0.5])
+    np.testing.assert_array_equal(fill_missing_times(np.array([1.0, 2.0])), [1.0, 2.0])
+
+
+def test_build_seek_index_sorts_packets_into_presentation_order(monkeypatch):
+    # decode order of an I P B B stream: the P frame is shown after the two B frames
+    fake_ffprobe(monkeypatch, "1.00,K_\n1.12,__\n1.04,__\n1.08,__\n1.16,K_\n")
+    pts, keyframes = build_seek_index("video.mp4")
+    np.testing.assert_allclose(pts, [1.00, 1.04, 1.08, 1.12, 1.16])
+    np.testing.assert_array_equal(keyframes, [0, 4])
+
+
+def test_build_seek_index_keeps_packets_without_timestamps(monkeypatch):
+    fake_ffprobe(monkeypatch, "0.00,K_\nN/A,__\n0.08,__\n0.12,K_\n")
+    pts, keyframes = build_seek_index("video.mp4")
+    assert len(pts) == 4  # the N/A packet still has its place, so later frames aren't shifted
+    assert np.isnan(pts[1])
+    np.testing.assert_array_equal(keyframes, [0, 3])
+
+
+def test_build_seek_index_needs_timestamps(monkeypatch):
+    fake_ffprobe(monkeypatch, "N/A,K_\nN/A,__\n")
+    with pytest.raises(ValueError):
+        build_seek_index("video.mp4")
+
+
+def test_seek_index_lookups():
+    pts = np.array([10.0, 10.04, 10.08, np.nan, 10.16, 10.2])
+    index = SeekIndex(pts, np.array([0, 4]))
+    assert len(index) == 6
+    np.testing.assert_allclose(index.times, [0.0, 0.04, 0.08, 0.12, 0.16, 0.2])
+    assert index.frame_duration == pytest.approx(0.04)
+    assert index.keyframe_before(3) == 0
+    assert index.keyframe_before(4) == 4
+    assert index.keyframe_before(5) == 4
+    assert index.frame_at(0.0) == 0
+    assert index.frame_at(0.121) == 3
+    assert index.frame_at(0.139) == 3
+    assert index.frame_at(5.0) == 5
+
+
+def test_keyframe_times_in_ffmpeg_time_base():
+    # the video stream starts 10 s into the container's timeline, and the container at 9.5 s
+    index = SeekIndex(np.array([10.0, 10.5, 11.0, 11.5]), np.array([0, 2]))
+    np.testing.assert_allclose(index.keyframe_times(), [0.0, 1.0])
+    np.testing.assert_allclose(index.keyframe_times(start_time=9.5), [0.5, 1.5])
+
+
+def test_waveform_pyramid_levels_keep_peaks():
+    mins = np.array([0, -1, 0, 0, 0, -5, 0, 0, 0], dtype=np.float32)
+    maxs = np.array([1, 0, 0, 7, 0, 0, 0, 0, 2], dtype=np.float32)
+    pyramid = WaveformPyramid(mins, maxs, bin_duration=0.5, factor=4)
+
+    assert [len(level[0]) for level in pyramid.levels] == [9, 3, 1]
+    np.testing.assert_array_equal(pyramid.levels[1][0], [-1, -5, 0])
+    np.testing.assert_array_equal(pyramid.levels[1][1], [7, 0, 2])
+    assert pyramid.amplitude_range() == (-5.0, 7.0)
+    assert pyramid.duration() == 4.5
+
+
+def test_waveform_pyramid_query_uses_the_level_that_fits():
+    pyramid = WaveformPyramid(np.zeros(1024), np.ones(1024), bin_duration=1.0, factor=4)
+    assert pyramid.level_for(0, 1024, 1024) == 0
+    assert pyramid.level_for(0, 1024, 256) == 1
+    x, y = pyramid.query(0, 1024, 256)
+    assert len(x) <= 2 * (256 + 2)
+    x, y = pyramid.query(100, 110, 100)  # zoomed in: full resolution, only the bins in view
+    assert len(x) == 2 * 12 and x[0] == 99 and x[-1] == 110
+
+
+def test_envelope_plot_data():
+    x, y = envelope_plot_data(np.array([-1, -2]), np.array([1, 2]), 0.5, offset=2)
+    np.testing.assert_array_equal(x, [1.0, 1.0, 1.5, 1.5])
+    np.testing.assert_array_equal(y, [-1, 1, -2, 2])
+
+
+def test_smart_cut_only_for_sources_the_encoder_can_match():
+    args = smart_cut_encoder_args({'codec_name': 'h264', 'profile': 'High', 'level': 41, 'pix_fmt': 'yuv420p'},
+                                  framerate=30, threads=2)
+    assert args == ["-c:v", "libx264", "-profile:v", "high", "-pix_fmt", "yuv420p", "-level:v", "4.1",
+                    "-r", "30", "-threads", "2"]
+    args = smart_cut_encoder_args({'codec_name': 'hevc', 'profile': 'Main 10', 'pix_fmt': 'yuv420p10le'})
+    assert args == ["-c:v", "libx265", "-profile:v", "main10", "-pix_fmt", "yuv420p10le"]
+    assert smart_cut_encoder_args({'codec_name': 'mpeg4', 'profile': 'Simple Profile', 'pix_fmt': 'yuv420p'}) is None
+    assert smart_cut_encoder_args({'codec_name': 'h264', 'profile': 'High 4:4:4 Intra', 'pix_fmt': 'yuv444p'}) is None
+
+
+def test_copy_clip_args_audio_flag():
+    withAudio = build_copy_clip_args("in.mp4", "out.mp4", 1.0, 3.5)
+    assert withAudio[withAudio.index("-t") + 1] == "2.5000"
+    assert "0:a?" in withAudio
+    withoutAudio = build_copy_clip_args("in.mp4", "out.mp4", 1.0, 3.5, audio=False)
+    assert "-an" in withoutAudio and "0:a?" not in withoutAudio
@@ -0,0 +1,117 @@
+"""Tests for media_cache.py: storing and finding entries, invalidation when a video changes, eviction, and puts from
+several threads at once.
+
+Run with:
+> python -m pytest test_media_cache.py
+"""
+import os
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from media_cache import MediaCache
+
+
+def make_video(tmp_path, name, size=1000):
+    """Stand-in for a video: the cache only looks at the file's path, size, modification time and bytes"""
+    path = str(tmp_path / name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MediaCache(str(tmp_path / "cache"))
+
+
+def test_put_and_get(tmp_path, cache):
+    video = make_video(tmp_path, "a.mp4")
+    assert cache.get(video) is None
+
+    cache.put(video, meta={'codec': 'h264'}, arrays={'pts': np.arange(5.0)})
+    cache.put(video, meta={'fps': 30.0})  # merged into what's there
+    assert cache.get(video) == {'codec': 'h264', 'fps': 30.0}
+    pts = cache.get_array(video, 'pts')
+    np.testing.assert_array_equal(pts, np.arange(5.0))
+    assert isinstance(pts, np.memmap)
+    assert cache.get_array(video, 'keyframes') is None
+
+
+def test_no_temporary_files_are_left(tmp_path, cache):
+    video = make_video(tmp_path, "a.mp4")
+    cache.put(video, meta={'codec': 'h264'}, arrays={'pts': np.arange(5.0)})
+    assert sorted(os.listdir(cache.entry_dir(video))) == ['meta.json', 'pts.npy']
+
+
+def test_a_changed_video_misses(tmp_path, cache):
+    video = make_video(tmp_path, "a.mp4")
+    cache.put(video, meta={'codec': 'h264'})
+    make_video(tmp_path, "a.mp4", size=2000)  # replaced (new size, time and content)
+    assert cache.get(video) is None
+
+
+def test_invalidate(tmp_path, cache):
+    videoA = make_video(tmp_path, "a.mp4")
+    videoB = make_video(tmp_path, "b.mp4")
+    cache.put(videoA, meta={'codec': 'h264'})
+    cache.put(videoB, meta={'codec': 'hevc'})
+
+    cache.invalidate(videoA)
+    assert cache.get(videoA) is None
+    assert cache.get(videoB) == {'codec': 'hevc'}
+    cache.invalidate()
+    assert cache.get(videoB) is None
+    assert cache.entries() == []
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    arrayBytes = 100 * 1024
+    cache = MediaCache(str(tmp_path / "cache"), max_bytes=int(2.5 * arrayBytes))
+    videos = [make_video(tmp_path, f"{name}.mp4") for name in "abc"]
+    for i, video in enumerate(videos[:2]):
+        cache.put(video, arrays={'audio': np.zeros(arrayBytes, dtype=np.uint8)})
+        metaPath = os.path.join(cache.entry_dir(video), "meta.json")
+        os.utime(metaPath, (1000 + i, 1000 + i))  # a was used before b
+
+    # a third entry doesn't fit: the oldest goes, the newest and the one just written stay
+    cache.put(videos[2], arrays={'audio': np.zeros(arrayBytes, dtype=np.uint8)})
+    assert not os.path.exists(cache.entry_dir(videos[0]))
+    assert os.path.exists(cache.entry_dir(videos[1]))
+    assert os.path.exists(cache.entry_dir(videos[2]))
+    assert sum(size for _, size, _ in cache.entries()) <= cache.max_bytes
+
+
+def test_get_marks_an_entry_as_used(tmp_path):
+    arrayBytes = 100 * 1024
+    cache = MediaCache(str(tmp_path / "cache"), max_bytes=int(2.5 * arrayBytes))
+    videos = [make_video(tmp_path, f"{name}.mp4") for name in "abc"]
+    for i, video in enumerate(videos[:2]):
+        cache.put(video, arrays={'audio': np.zeros(arrayBytes, dtype=np.uint8)})
+        os.utime(os.path.join(cache.entry_dir(video), "meta.json"), (1000 + i, 1000 + i))
+    cache.get(videos[0])  # a is now the most recently used
+
+    cache.put(videos[2], arrays={'audio': np.zeros(arrayBytes, dtype=np.uint8)})
+    assert os.path.exists(cache.entry_dir(videos[0]))
+    assert not os.path.exists(cache.entry_dir(videos[1]))
+
+
+def test_puts_from_several_threads_keep_every_key(tmp_path, cache):
+    video = make_video(tmp_path, "a.mp4")
+    cache.fingerprint(video)  # hash once up front, as the loader would have
+
+    def put(i):
+        cache.put(video, meta={f'key{i}': i}, arrays={f'array{i}': np.full(10, i)})
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache.get(video) == {f'key{i}': i for i in range(8)}
+    for i in range(8):
+        np.testing.assert_array_equal(cache.get_array(video, f'array{i}'), np.full(10, i))
+    assert not [name for name in os.listdir(cache.entry_dir(video)) if name.endswith('.tmp')]
@@ -0,0 +1,277 @@
+"""Tests for the GUI-free parts of tracking.py: the trace store, trace writers and read_trace (including recovery
+after a crash), checkpoints, and track_video/track_video_chunked on a small synthetic video.
+
+Run with:
+> python -m pytest test_tracking.py
+"""
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("pandas")
+
+from tracking import (backup_trace, checkpoint_path, load_checkpoint, npz_parts_path, open_trace_writer, read_trace,
+                      save_checkpoint, save_trace, track_video, track_video_chunked, Checkpointer, NpzTraceWriter,
+                      TraceStore, TraceWriter, PARQUET_AVAILABLE)
+
+FRAME_COUNT = 60
+FRAME_SIZE = (160, 120)  # width, height
+BOX_SIZE = 20
+
+
+def filled_trace(frame_count=35, vid_height=100):
+    """TraceStore with a box recorded on every frame, moving one pixel per frame, and a failure on frame 7"""
+    trace = TraceStore(frame_count)
+    for frame in range(1, frame_count + 1):
+        trace.record(frame, (frame, 2 * frame, 10, 12), vid_height, confidence=frame / 100)
+    trace.record_failure(7)
+    return trace
+
+
+def stream_trace(writer, trace, close=True):
+    """Feed a trace to a writer the way the pipeline does: one write_until per recorded frame"""
+    writer.start_segment(1)
+    for frame in range(1, len(trace)):
+        writer.write_until(trace, frame)
+    writer.write_until(trace, len(trace) - 1, force=True)
+    if close:
+        writer.close()
+
+
+def assert_same_rows(actual, expected):
+    """Compare trace rows field by field (a structured array comparison never matches the NaN confidences)"""
+    assert len(actual) == len(expected)
+    for name in expected.dtype.names:
+        np.testing.assert_array_equal(actual[name], expected[name])
+
+
+def assert_same_trace(actual, expected):
+    assert_same_rows(actual.data, expected.data)
+
+
+def test_trace_store_record_and_failure():
+    trace = TraceStore(10)
+    assert len(trace) == 11  # row 0 is blank, frames are 1-based
+    trace.record(3, (10, 20, 30, 40), vid_height=100)
+    assert trace.row(3) == (10, 40, 80, 40, 40, 25)  # y flipped, xMid/yMid in the GUI's order
+    assert trace['valid'][3] and trace['ok'][3]
+    trace.record_failure(3)
+    assert not trace['valid'][3] and not trace['ok'][3]
+    assert not trace['valid'][4]
+
+
+def test_npz_writer_round_trip(tmp_path):
+    trace = filled_trace()
+    path = str(tmp_path / "trace.npz")
+    writer = NpzTraceWriter(path, {'fps': 30.0}, chunk_rows=10)
+    stream_trace(writer, trace)
+
+    assert writer.nChunks == 4  # 35 frames in chunks of 10
+    assert os.path.isfile(path)
+    assert not os.path.exists(npz_parts_path(path))  # packed into the npz on close
+    readTrace, metadata = read_trace(path)
+    assert metadata == {'fps': 30.0}
+    assert_same_trace(readTrace, trace)
+
+
+@pytest.mark.skipif(not PARQUET_AVAILABLE, reason="needs pyarrow")
+def test_parquet_writer_round_trip(tmp_path):
+    trace = filled_trace()
+    path = str(tmp_path / "trace.parquet")
+    stream_trace(open_trace_writer(path, {'fps': 25.0}, chunk_rows=10), trace)
+
+    readTrace, metadata = read_trace(path)
+    assert metadata == {'fps': 25.0}
+    assert_same_trace(readTrace, trace)
+
+
+def test_csv_round_trip(tmp_path):
+    trace = filled_trace()
+    path = str(tmp_path / "trace.csv")
+    save_trace(trace, path)
+
+    readTrace, metadata = read_trace(path)
+    assert metadata == {}
+    for col in ['x1', 'x2', 'y1', 'y2', 'xMid', 'yMid']:
+        np.testing.assert_array_equal(readTrace[col], trace[col])
+
+
+def test_read_trace_recovers_leftover_parts(tmp_path):
+    """A run that crashed before close() leaves its chunks in <trace>.npz.parts, which read_trace still reads"""
+    trace = filled_trace()
+    path = str(tmp_path / "trace.npz")
+    writer = NpzTraceWriter(path, {'fps': 30.0}, chunk_rows=10)
+    writer.start_segment(1)
+    for frame in range(1, 26):
+        writer.write_until(trace, frame)
+    TraceWriter.open_paths.discard(os.path.abspath(path))  # as if the process had died
+
+    assert not os.path.exists(path)
+    readTrace, metadata = read_trace(path)
+    assert metadata == {'fps': 30.0}
+    # the two finished chunks (frames 1-20) are there, the unfinished one isn't
+    np.testing.assert_array_equal(readTrace['x1'][:21], trace['x1'][:21])
+    assert not readTrace['valid'][21:].any()
+
+
+def test_read_trace_skips_truncated_last_chunk(tmp_path):
+    trace = filled_trace()
+    path = str(tmp_path / "trace.npz")
+    writer = NpzTraceWriter(path, chunk_rows=10)
+    stream_trace(writer, trace, close=False)
+    TraceWriter.open_paths.discard(os.path.abspath(path))
+    lastChunk = os.path.join(npz_parts_path(path), f'chunk_{writer.nChunks - 1:06d}.npy')
+    with open(lastChunk, 'r+b') as f:
+        f.truncate(os.path.getsize(lastChunk) // 2)
+
+    readTrace, _ = read_trace(path)
+    np.testing.assert_array_equal(readTrace['x1'][:31], trace['x1'][:31])
+    assert not readTrace['valid'][31:].any()
+
+
+def test_second_writer_on_an_open_path_is_refused(tmp_path):
+    trace = filled_trace()
+    path = str(tmp_path / "trace.npz")
+    writer = NpzTraceWriter(path, chunk_rows=10)
+    writer.start_segment(1)
+    writer.write_until(trace, 10)
+
+    with pytest.raises(FileExistsError):
+        save_trace(trace, path)
+    # the first writer's chunks are untouched, and it can carry on
+    writer.write_until(trace, len(trace) - 1, force=True)
+    writer.close()
+    assert_same_trace(read_trace(path)[0], trace)
+    # once it's closed the path is free again
+    save_trace(trace, path)
+
+
+def test_backup_trace_numbers_old_traces(tmp_path):
+    path = str(tmp_path / "video_trace.npz")
+    assert backup_trace(path) is None
+
+    save_trace(filled_trace(), path)
+    assert backup_trace(path) == str(tmp_path / "video_trace.1.npz")
+    save_trace(filled_trace(), path)
+    assert backup_trace(path) == str(tmp_path / "video_trace.2.npz")
+    assert not os.path.exists(path)
+
+    # an unfinished autosave (only its parts folder) is moved too
+    os.makedirs(npz_parts_path(path))
+    assert backup_trace(path) == str(tmp_path / "video_trace.3.npz")
+    assert os.path.isdir(npz_parts_path(str(tmp_path / "video_trace.3.npz")))
+
+
+def test_checkpoint_round_trip(tmp_path):
+    trace = filled_trace()
+    path = checkpoint_path(str(tmp_path / "trace.npz"))
+    assert path == str(tmp_path / "trace.checkpoint.npz")
+    template = np.arange(4 * 5 * 3, dtype=np.uint8).reshape(4, 5, 3)
+    save_checkpoint(path, trace, 20, (1, 2, 3, 4), ok=False, template=template, metadata={'tracker': 'MIL'})
+
+    checkpoint = load_checkpoint(path)
+    assert checkpoint['frame'] == 20
+    assert checkpoint['bbox'] == (1, 2, 3, 4)
+    assert checkpoint['ok'] is False
+    assert checkpoint['metadata'] == {'tracker': 'MIL'}
+    np.testing.assert_array_equal(checkpoint['template'], template)
+    assert_same_rows(checkpoint['trace'], trace.data[:21])
+
+
+def test_checkpointer_keeps_the_last_good_box(tmp_path):
+    trace = filled_trace()
+    path = str(tmp_path / "trace.checkpoint.npz")
+    checkpointer = Checkpointer(path, interval=3600)
+    checkpointer.update(trace, 5, (5, 6, 7, 8), True)
+    checkpointer.update(trace, 6, None, False)
+    assert not os.path.exists(path)  # not due yet
+    checkpointer.save(trace)
+
+    checkpoint = load_checkpoint(path)
+    assert checkpoint['frame'] == 6
+    assert checkpoint['bbox'] == (5, 6, 7, 8)
+    assert checkpoint['ok'] is False
+    assert checkpoint['template'] is None
+
+
+def test_track_video_needs_a_bbox_or_template(tmp_path):
+    with pytest.raises(ValueError):
+        track_video(str(tmp_path / "missing.avi"), None)
+    with pytest.raises(ValueError):
+        track_video_chunked(str(tmp_path / "missing.avi"), None)
+
+
+def box_at(frame_number):
+    """Where the synthetic video's square is on a frame (1-based)"""
+    return 20 + frame_number, 30 + frame_number // 2, BOX_SIZE, BOX_SIZE
+
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    """Short video of a bright textured square drifting over a static noisy background"""
+    path = str(tmp_path_factory.mktemp("video") / "square.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, FRAME_SIZE)
+    if not writer.isOpened():
+        pytest.skip("OpenCV can't write MJPG video here")
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 60, (FRAME_SIZE[1], FRAME_SIZE[0], 3), dtype=np.uint8)
+    square = rng.integers(180, 256, (BOX_SIZE, BOX_SIZE, 3), dtype=np.uint8)
+    for frame_number in range(1, FRAME_COUNT + 1):
+        frame = background.copy()
+        x, y, w, h = box_at(frame_number)
+        frame[y:y + h, x:x + w] = square
+        writer.write(frame)
+    writer.release()
+    if int(cv2.VideoCapture(path).get(cv2.CAP_PROP_FRAME_COUNT)) != FRAME_COUNT:
+        pytest.skip("OpenCV can't read back the test video's frame count")
+    return path
+
+
+def test_track_video_follows_the_square(video):
+    trace, stats = track_video(video, box_at(1), tracker_type='MIL')
+    assert stats['init_frame'] == 1
+    assert stats['last_frame'] == FRAME_COUNT
+    assert trace['valid'][1:].sum() >= FRAME_COUNT - 5
+    assert abs(int(trace['x1'][FRAME_COUNT]) - box_at(FRAME_COUNT)[0]) <= 5
+
+
+def test_track_video_resumes_from_a_checkpoint(video, tmp_path):
+    trace, _ = track_video(video, box_at(1), tracker_type='MIL', end_frame=30)
+    path = str(tmp_path / "square.checkpoint.npz")
+    x1, x2, y1, y2 = trace.row(30)[:4]
+    save_checkpoint(path, trace, 30, (x1, FRAME_SIZE[1] - y1, x2 - x1, y1 - y2))  # back from trace to (x, y, w, h)
+
+    resumed, stats = track_video(video, None, tracker_type='MIL', resume=load_checkpoint(path))
+    assert stats['init_frame'] == 30
+    assert_same_rows(resumed.data[:30], trace.data[:30])  # restored from the checkpoint
+    assert resumed['valid'][31:].sum() >= FRAME_COUNT - 30 - 5  # and carried on to the end
+
+
+def test_track_video_chunked_counts_every_frame(video):
+    trace, stats = track_video_chunked(video, box_at(1), tracker_type='MIL', chunks=3)
+    assert stats['chunks'] == 3
+    assert stats['frames'] == FRAME_COUNT
+    assert len(stats['seams']) == 2
+    for seam in stats['seams']:
+        assert seam['start_frame'] == seam['frame']  # the square is visible on every frame
+
+
+def test_track_video_leaves_frames_untracked_if_the_template_is_never_found(video):
+    rng = np.random.default_rng(1)
+    template = rng.integers(0, 256, (BOX_SIZE, BOX_SIZE, 3), dtype=np.uint8)  # not in the video
+    trace, stats = track_video(video, None, tracker_type='MIL', template=template, min_score=0.9)
+    assert stats['init_frame'] is None
+    assert stats['frames'] == 0
+    assert not trace['valid'].any()
+
+
+def test_npz_metadata_is_json(tmp_path):
+    """The metadata inside an npz trace is plain json, so other tools can read it without this module"""
+    import zipfile
+    path = str(tmp_path / "trace.npz")
+    save_trace(filled_trace(), path, {'tracker': 'MIL', 'bbox': [1, 2, 3, 4]})
+    with zipfile.ZipFile(path) as zf:
+        assert json.loads(zf.read('metadata.json')) == {'tracker': 'MIL', 'bbox': [1, 2, 3, 4]}
@@ -0,0 +1,1461 @@
+"""GUI-free tracking engine for the bobbing analysis.
+
+Runs the same OpenCV trackers as main.py, but without any Qt, so no pixmap conversion, no drawing on the frames and
+no graph updates. Frames are decoded and tracked as fast as the machine allows, which makes it suitable for long
+batches on a machine with no display.
+
+Usage:
+> python tracking.py session.mp4 --bbox 1261 586 60 72 --tracker MIL -o session_trace.csv
+--tracker takes a tracker type or the name of a profile (TRACKER_PROFILES, plus any in tracker_profiles.json), e.g.
+--tracker fast; list them with --list-profiles.
+Long videos can be split into chunks that are tracked in parallel with --chunks N. Traces are saved as csv, or as
+.npz/.parquet (typed columns plus metadata), which are written in chunks as tracking goes; read them with read_trace.
+While tracking, a checkpoint (<output>.checkpoint.npz) is saved every CHECKPOINT_INTERVAL seconds; if the run is
+interrupted, run the same command again with --resume to carry on from it.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2  # via opencv-python AND opencv-contrib-python (for other trackers)
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa  # optional, for parquet traces
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+PARQUET_AVAILABLE = pa is not None
+
+TRACKER_TYPES = ['BOOSTING', 'MIL', 'KCF', 'TLD', 'MEDIANFLOW', 'GOTURN', 'MOSSE', 'CSRT', 'VIT', 'RPN']
+TRACE_COLUMNS = ['x1', 'x2', 'y1', 'y2', 'xMid', 'yMid']
+TRACE_CHUNK_ROWS = 1000  # frames per chunk when streaming a trace to disk
+STREAM_FORMATS = ('.npz', '.parquet')  # trace formats that can be written while tracking
+TRACKER_OPTION_NAMES = ['search_pad', 'scale', 'grayscale']  # input options of create_tracker (see RoiTracker)
+TRACKER_PARAMS_CLASSES = {  # OpenCV params objects of the trackers that have them
+    'MIL': 'TrackerMIL_Params',
+    'KCF': 'TrackerKCF_Params',
+    'GOTURN': 'TrackerGOTURN_Params',
+    'CSRT': 'TrackerCSRT_Params',
+    'VIT': 'TrackerVit_Params',
+    'RPN': 'TrackerDaSiamRPN_Params',
+}
+# Named speed/accuracy trade-offs: a tracker type plus its OpenCV parameters ('params', see tracker_params) and input
+# options ('options', see create_tracker). More can be added, or these replaced, in tracker_profiles.json
+TRACKER_PROFILES = {
+    'fastest': {
+        'tracker': 'MOSSE',
+        'options': {'grayscale': True},
+        'description': "MOSSE on grayscale frames. Fastest by far, for clear footage where the animal doesn't change "
+                       "much in appearance",
+    },
+    'fast': {
+        'tracker': 'KCF',
+        'description': "KCF with its default parameters. Many times faster than MIL on easy footage",
+    },
+    'balanced': {
+        'tracker': 'MIL',
+        'description': "MIL with its default parameters (what the GUI has always used)",
+    },
+    'balanced-wide': {
+        'tracker': 'MIL',
+        'params': {'samplerSearchWinSize': 40, 'samplerTrackInRadius': 6},
+        'description': "MIL searching a wider area around the last position, for faster movement (but slower)",
+    },
+    'accurate-fast': {
+        'tracker': 'CSRT',
+        # CSRT's default template_size (200) is kept: shrinking it makes CSRT lose small, fast-moving targets
+        'params': {'use_segmentation': False, 'use_color_names': False, 'number_of_scales': 17},
+        'description': "CSRT without segmentation or colour names and with fewer scales: cheaper than the defaults, "
+                       "for much the same accuracy",
+    },
+    'accurate': {
+        'tracker': 'CSRT',
+        'description': "CSRT with its default parameters. Most accurate of the classic trackers, but slow",
+    },
+    'hybrid': {
+        'tracker': 'HYBRID',
+        'params': {'fast': 'fastest', 'accurate': 'accurate', 'verify_every': 10, 'min_score': 0.5},
+        'description': "MOSSE on every frame, checked against the original selection every 10 frames (and whenever "
+                       "it loses confidence or jumps); CSRT takes over from the template match when it drifts",
+    },
+}
+HYBRID_TRACKER = 'HYBRID'  # tracker type of HybridTracker profiles, whose params are HybridTracker's arguments
+HYBRID_PARAMS = ['fast', 'accurate', 'verify_every', 'verify_pad', 'min_score', 'drift_iou', 'jump_limit',
+                 'recover_frames']
+DEFAULT_PROFILE = 'balanced'
+PROFILES_FILE = "tracker_profiles.json"  # user profiles, next to the program
+CHECKPOINT_INTERVAL = 60.0  # seconds between checkpoints while tracking
+MIN_MATCH_SCORE = 0.5  # lowest template match score (1 is a perfect match) that counts as finding the object
+
+
+def create_opencv_tracker(tracker_type, params=None):
+    """Create a new OpenCV tracker from its name, with params (a dict of parameter values, see tracker_params) for the
+    trackers that take them"""
+    args = (tracker_params(tracker_type, params),) if params else ()
+    if tracker_type == 'BOOSTING':
+        return cv2.legacy.TrackerBoosting.create()
+    if tracker_type == 'MIL':
+        return cv2.TrackerMIL.create(*args)
+    if tracker_type == 'KCF':
+        return cv2.TrackerKCF.create(*args)
+    if tracker_type == 'TLD':
+        return cv2.legacy.TrackerTLD.create()
+    if tracker_type == 'MEDIANFLOW':
+        return cv2.legacy.TrackerMedianFlow.create()
+    if tracker_type == 'GOTURN':
+        return cv2.TrackerGOTURN.create(*args)
+    if tracker_type == 'MOSSE':
+        return cv2.legacy.TrackerMOSSE.create()
+    if tracker_type == "CSRT":
+        return cv2.TrackerCSRT.create(*args)
+    if tracker_type == "VIT":
+        return cv2.TrackerVit.create(*args)
+    if tracker_type == "RPN":
+        return cv2.TrackerDaSiamRPN.create(*args)
+    raise ValueError(f"Unknown tracker type: {tracker_type}")
+
+
+def tracker_params(tracker_type, params):
+    """OpenCV params object for a tracker (e.g. cv2.TrackerKCF_Params), with the values in the params dict set on it.
+    Names are the OpenCV attribute names (e.g. {'detect_thresh': 0.6} for KCF, {'samplerSearchWinSize': 40} for MIL)"""
+    className = TRACKER_PARAMS_CLASSES.get(tracker_type)
+    if className is None:
+        raise ValueError(f"{tracker_type} doesn't take any parameters")
+    paramsObj = getattr(cv2, className)()
+    for name, value in params.items():
+        if not hasattr(paramsObj, name):
+            raise ValueError(f"Unknown {tracker_type} parameter: {name}")
+        setattr(paramsObj, name, value)
+    return paramsObj
+
+
+def create_tracker(tracker_type, search_pad=None, scale=1.0, grayscale=False, params=None):
+    """Create a new tracker from its name (and params, see tracker_params). Setting any of the input options (see
+    RoiTracker) wraps the tracker so it works on a smaller image, without changing the coordinates it reports"""
+    if search_pad is None and scale == 1.0 and not grayscale:
+        return create_opencv_tracker(tracker_type, params)
+    return RoiTracker(tracker_type, search_pad=search_pad, scale=scale, grayscale=grayscale, params=params)
+
+
+def resolve_profile(profile, profiles=None):
+    """Profile dict (see TRACKER_PROFILES) from a profile name, a tracker type (e.g. 'KCF', for its default
+    parameters) or a profile dict, which is checked. The fast and accurate trackers of a hybrid profile are looked up
+    too, so the profile it returns works without profiles (e.g. in a worker process)"""
+    if isinstance(profile, dict):
+        validate_profile(profile)
+    else:
+        profiles = TRACKER_PROFILES if profiles is None else profiles
+        if profile in profiles:
+            profile = profiles[profile]
+        elif str(profile).upper() in TRACKER_TYPES + [HYBRID_TRACKER]:
+            profile = {'tracker': str(profile).upper()}
+        else:
+            raise ValueError(f"Unknown tracker or profile: {profile} (profiles: {', '.join(profiles)}; trackers: "
+                             f"{', '.join(TRACKER_TYPES)})")
+    if profile['tracker'] == HYBRID_TRACKER:
+        params = dict(profile.get('params', {}))
+        for key, default in (('fast', HybridTracker.FAST), ('accurate', HybridTracker.ACCURATE)):
+            params[key] = resolve_profile(params.get(key, default), profiles)
+            if params[key]['tracker'] == HYBRID_TRACKER:
+                raise ValueError(f"The {key} tracker of a hybrid profile can't be another hybrid")
+        profile = dict(profile, params=params)
+    return profile
+
+
+def validate_profile(profile, name=None):
+    """Raise ValueError if the profile has an unknown tracker, option or parameter"""
+    label = f"Profile {name}" if name else "Profile"
+    if profile.get('tracker') not in TRACKER_TYPES + [HYBRID_TRACKER]:
+        raise ValueError(f"{label} has an unknown tracker: {profile.get('tracker')}")
+    unknownOptions = set(profile.get('options', {})) - set(TRACKER_OPTION_NAMES)
+    if unknownOptions:
+        raise ValueError(f"{label} has unknown option(s): {', '.join(sorted(unknownOptions))}")
+    if profile['tracker'] == HYBRID_TRACKER:
+        unknownParams = set(profile.get('params', {})) - set(HYBRID_PARAMS)
+        if unknownParams:
+            raise ValueError(f"{label} has unknown hybrid parameter(s): {', '.join(sorted(unknownParams))}")
+    elif profile.get('params'):
+        try:
+            tracker_params(profile['tracker'], profile['params'])
+        except (ValueError, TypeError, AttributeError, cv2.error) as e:
+            raise ValueError(f"{label}: {e}")
+
+
+def load_tracker_profiles(file_path=None):
+    """The built-in TRACKER_PROFILES plus any from a json file of {name: profile} (in the same form), which can add
+    profiles or replace built-in ones. By default that's tracker_profiles.json next to the program, if there is one"""
+    profiles = dict(TRACKER_PROFILES)
+    if file_path is None:
+        file_path = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), PROFILES_FILE)
+        if not os.path.exists(file_path):
+            return profiles
+    with open(file_path) as f:
+        userProfiles = json.load(f)
+    for name, profile in userProfiles.items():
+        validate_profile(profile, name)
+        profiles[name] = profile
+    return profiles
+
+
+def create_profile_tracker(profile, profiles=None, defaults=None, **options):
+    """Create the tracker for a profile (anything resolve_profile takes). Input options come from defaults, then the
+    profile's own options, then options. For a hybrid profile, they're the defaults for both of its trackers"""
+    profile = resolve_profile(profile, profiles)
+    trackerOptions = dict(defaults or {})
+    trackerOptions.update(profile.get('options', {}))
+    trackerOptions.update(options)
+    if profile['tracker'] == HYBRID_TRACKER:
+        return HybridTracker(tracker_options=trackerOptions, **profile.get('params', {}))
+    return create_tracker(profile['tracker'], params=profile.get('params'), **trackerOptions)
+
+
+class RoiTracker(object):
+    """Tracker wrapper that only shows the tracker part of each frame, to cut the per-frame cost on large videos.
+
+    search_pad: track inside a window around the box, padded by this many box widths/heights on each side (None to
+        use the whole frame). The window stays put while the box is well inside it, and is re-centred (restarting the
+        tracker there) when the box gets within half the padding of an edge.
+    scale: downscale factor for the tracker's input (e.g. 0.5 for half resolution).
+    grayscale: give the tracker single channel images. Not suitable for the DNN trackers (GOTURN, VIT, RPN).
+    params: OpenCV parameters for the tracker (see tracker_params).
+
+    Boxes go in and come out in full resolution pixel coordinates, so it can be used anywhere a tracker is"""
+
+    def __init__(self, tracker_type, search_pad=None, scale=1.0, grayscale=False, params=None):
+        self.tracker_type = tracker_type
+        self.params = params
+        self.search_pad = search_pad
+        self.scale = scale
+        self.grayscale = grayscale
+        self.tracker = None
+        self.window = None  # (x, y, width, height) of the search window, in full resolution pixels
+        self.frameSize = None
+        self.bbox = None
+
+    def init(self, frame, bbox):
+        self.frameSize = (frame.shape[1], frame.shape[0])
+        self.bbox = tuple(bbox)
+        self.place_window(bbox)
+        self.tracker = create_opencv_tracker(self.tracker_type, self.params)
+        return self.tracker.init(self.prepare(frame), self.to_window(bbox))
+
+    def update(self, frame):
+        ok, windowBbox = self.tracker.update(self.prepare(frame))
+        if not ok:
+            return False, tuple(int(v) for v in self.bbox)
+        self.bbox = self.from_window(windowBbox)
+        if self.search_pad is not None and self.near_edge(self.bbox):
+            # move the search window to follow the object, restarting the tracker on it
+            self.init(frame, tuple(int(round(v)) for v in self.bbox))
+        return True, tuple(int(round(v)) for v in self.bbox)
+
+    def getTrackingScore(self):
+        return tracker_confidence(self.tracker)
+
+    def place_window(self, bbox):
+        """Centre the search window on the box (or use the whole frame without search_pad)"""
+        frameWidth, frameHeight = self.frameSize
+        if self.search_pad is None:
+            self.window = (0, 0, frameWidth, frameHeight)
+            return
+        padX = int(bbox[2] * self.search_pad)
+        padY = int(bbox[3] * self.search_pad)
+        x1 = max(0, int(bbox[0]) - padX)
+        y1 = max(0, int(bbox[1]) - padY)
+        x2 = min(frameWidth, int(bbox[0] + bbox[2]) + padX)
+        y2 = min(frameHeight, int(bbox[1] + bbox[3]) + padY)
+        self.window = (x1, y1, x2 - x1, y2 - y1)
+
+    def near_edge(self, bbox):
+        """Whether the box is within half the padding of a window edge (ignoring edges that are the frame edge)"""
+        frameWidth, frameHeight = self.frameSize
+        wx, wy, ww, wh = self.window
+        marginX = bbox[2] * self.search_pad / 2
+        marginY = bbox[3] * self.search_pad / 2
+        return ((wx > 0 and bbox[0] - wx < marginX) or
+                (wy > 0 and bbox[1] - wy < marginY) or
+                (wx + ww < frameWidth and wx + ww - (bbox[0] + bbox[2]) < marginX) or
+                (wy + wh < frameHeight and wy + wh - (bbox[1] + bbox[3]) < marginY))
+
+    def prepare(self, frame):
+        """The part of the frame the tracker sees"""
+        x, y, w, h = self.window
+        image = frame[y:y + h, x:x + w]
+        if self.grayscale and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self.scale != 1.0:
+            image = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return image
+
+    def to_window(self, bbox):
+        """Full resolution box -> tracker input coordinates"""
+        return (int(round((bbox[0] - self.window[0]) * self.scale)),
+                int(round((bbox[1] - self.window[1]) * self.scale)),
+                max(1, int(round(bbox[2] * self.scale))),
+                max(1, int(round(bbox[3] * self.scale))))
+
+    def from_window(self, bbox):
+        """Tracker input coordinates -> full resolution box"""
+        return (bbox[0] / self.scale + self.window[0],
+                bbox[1] / self.scale + self.window[1],
+                bbox[2] / self.scale,
+                bbox[3] / self.scale)
+
+
+class HybridTracker(object):
+    """A cheap tracker on every frame, checked against a template of the object by normalised cross-correlation, with
+    an accurate tracker taking over when it drifts.
+
+    fast: profile (or tracker type) run on every frame, e.g. MOSSE or KCF.
+    accurate: profile started on the template match after a drift, e.g. CSRT or MIL. It runs for recover_frames frames,
+        then hands back to a new fast tracker on the box it ends on, once that box has been checked against the
+        template (until then it carries on).
+    verify_every: check the box against the template every this many frames. It's also checked straight away when
+        the tracker reports a failure (i.e. its own confidence drops below its threshold) or the box jumps by more than
+        jump_limit box sizes in one frame, and on every frame while the object is lost.
+    verify_pad: the template is searched for in a window around the box, padded by this many box sizes on each side
+        (and then over the whole frame if it isn't found there).
+    min_score: lowest match score (1 is a perfect match) that counts as finding the object.
+    drift_iou: the box has drifted if it overlaps the match by less than this.
+    tracker_options: input options for both trackers (see create_profile_tracker).
+
+    The template is cut from the box on the first frame init is called with, unless it has been set before (e.g. to the
+    bboxImage from Set Bounding Box, so restarting after a pause still checks against the original selection).
+    Counts of what it did are kept in stats"""
+    FAST = 'fastest'
+    ACCURATE = 'accurate'
+
+    def __init__(self, fast=FAST, accurate=ACCURATE, verify_every=10, verify_pad=1.0, min_score=MIN_MATCH_SCORE,
+                 drift_iou=0.5, jump_limit=0.5, recover_frames=30, tracker_options=None):
+        self.fastProfile = resolve_profile(fast)
+        self.accurateProfile = resolve_profile(accurate)
+        self.verify_every = verify_every
+        self.verify_pad = verify_pad
+        self.min_score = min_score
+        self.drift_iou = drift_iou
+        self.jump_limit = jump_limit
+        self.recover_frames = recover_frames
+        self.tracker_options = tracker_options or {}
+
+        # create both now, so a tracker this OpenCV build doesn't have fails here rather than on the first drift
+        self.create(self.accurateProfile)
+        self.tracker = self.create(self.fastProfile)
+        self.template = None
+        self.templateGray = None
+        self.bbox = None
+        self.frameNumber = 0
+        self.recovering = 0  # frames left for the accurate tracker
+        self.lost = False
+        self.score = np.nan  # match score of the last verification, if it was on this frame
+        self.stats = {'verified': 0, 'drifts': 0, 'lost': 0, 'accurate_frames': 0}
+
+    def create(self, profile):
+        return create_profile_tracker(profile, defaults=self.tracker_options)
+
+    def init(self, frame, bbox):
+        self.bbox = tuple(int(v) for v in bbox)
+        if self.template is None:
+            self.template = crop_bbox(frame, self.bbox)
+        self.templateGray = to_gray(self.template)
+        self.frameNumber = 0
+        self.recovering = 0
+        self.lost = False
+        return self.restart(frame, self.bbox, self.fastProfile)
+
+    def restart(self, frame, bbox, profile):
+        # OpenCV's legacy trackers (e.g. MOSSE) can't be initialised twice, so always start a new one
+        self.tracker = self.create(profile)
+        return self.tracker.init(frame, tuple(int(v) for v in bbox))
+
+    def update(self, frame):
+        self.frameNumber += 1
+        self.score = np.nan
+        ok, bbox = self.tracker.update(frame)
+        bbox = tuple(int(round(v)) for v in bbox)
+        if self.recovering:
+            self.stats['accurate_frames'] += 1
+            self.recovering -= 1
+            if not self.recovering:
+                return self.hand_back(frame, bbox, ok)
+
+        jumped = ok and (abs(bbox[0] - self.bbox[0]) > self.jump_limit * self.bbox[2] or
+                         abs(bbox[1] - self.bbox[1]) > self.jump_limit * self.bbox[3])
+        if not ok or jumped or self.lost or self.frameNumber % self.verify_every == 0:
+            ok, bbox = self.verify(frame, bbox if ok else self.bbox, ok)
+        if not ok:
+            return False, self.bbox
+        self.bbox = bbox
+        return True, bbox
+
+    def hand_back(self, frame, bbox, tracked):
+        """End of a recovery: hand back to a new fast tracker, but only on a box the template confirms"""
+        ok, bbox = self.verify(frame, bbox if tracked else self.bbox, tracked)
+        if not ok:
+            self.recovering = 1  # still lost: keep the accurate tracker and try again on the next frame
+            return False, self.bbox
+        if not self.recovering:  # (a drift restarts the accurate tracker instead)
+            self.restart(frame, bbox, self.fastProfile)
+        self.bbox = bbox
+        return True, bbox
+
+    def verify(self, frame, bbox, tracked):
+        """Check the box against the template, restarting the accurate tracker on the match if the box has drifted (or
+        the tracker had failed). Returns (ok, bbox) for this frame"""
+        self.stats['verified'] += 1
+        gray = to_gray(frame)
+        match, score = self.locate(gray, bbox, self.verify_pad)
+        if score < self.min_score:
+            match, score = self.locate(gray, bbox, None)
+        self.score = score
+        if score < self.min_score:
+            self.stats['lost'] += 1
+            self.lost = True
+            return False, bbox
+        self.lost = False
+        if tracked and bbox_iou(bbox, match) >= self.drift_iou:
+            return True, bbox
+        self.stats['drifts'] += 1
+        self.restart(frame, match, self.accurateProfile)
+        self.recovering = self.recover_frames
+        return True, match
+
+    def locate(self, gray, bbox, pad):
+        """Best template match in a window around bbox, padded by pad box sizes (None for the whole frame)"""
+        templateHeight, templateWidth = self.templateGray.shape[:2]
+        frameHeight, frameWidth = gray.shape[:2]
+        x0, y0, x1, y1 = 0, 0, frameWidth, frameHeight
+        if pad is not None:
+            x, y, w, h = bbox
+            x0 = max(0, int(x - pad * w))
+            y0 = max(0, int(y - pad * h))
+            x1 = min(frameWidth, int(x + w + pad * w))
+            y1 = min(frameHeight, int(y + h + pad * h))
+        if x1 - x0 < templateWidth or y1 - y0 < templateHeight:
+            return (bbox, -1.0) if pad is None else self.locate(gray, bbox, None)
+        match, score = match_template(gray[y0:y1, x0:x1], self.templateGray)
+        return (match[0] + x0, match[1] + y0, match[2], match[3]), score
+
+    def getTrackingScore(self):
+        """Template match score on frames that were verified, otherwise the current tracker's own score"""
+        return self.score if not np.isnan(self.score) else tracker_confidence(self.tracker)
+
+
+def to_gray(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+def bbox_iou(bbox_a, bbox_b):
+    """Intersection over union of two (x, y, width, height) boxes"""
+    overlapX = max(0, min(bbox_a[0] + bbox_a[2], bbox_b[0] + bbox_b[2]) - max(bbox_a[0], bbox_b[0]))
+    overlapY = max(0, min(bbox_a[1] + bbox_a[3], bbox_b[1] + bbox_b[3]) - max(bbox_a[1], bbox_b[1]))
+    intersection = overlapX * overlapY
+    union = bbox_a[2] * bbox_a[3] + bbox_b[2] * bbox_b[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def bbox_to_trace(bbox, vid_height):
+    """Convert an (x, y, width, height) box into the trace values (x1, x2, y1, y2, xMid, yMid).
+    y values are flipped so that they increase upwards from the bottom of the frame. xMid/yMid keep the order the
+    GUI has always written them in, so traces from both paths are interchangeable"""
+    vid_height = int(vid_height)
+    return (int(bbox[0]),
+            int(bbox[0] + bbox[2]),
+            vid_height - int(bbox[1]),
+            vid_height - int(bbox[1] + bbox[3]),
+            int(bbox[1] + bbox[3] / 2),
+            int(bbox[0] + bbox[2] / 2))
+
+
+TRACE_DTYPE = np.dtype([
+    ('x1', np.int32), ('x2', np.int32), ('y1', np.int32), ('y2', np.int32), ('xMid', np.int32), ('yMid', np.int32),
+    ('valid', np.bool_),  # row holds a tracked position
+    ('ok', np.bool_),  # tracker reported success on this frame
+    ('confidence', np.float32),  # tracker score, where the tracker provides one (NaN otherwise)
+])
+
+
+class TraceStore(object):
+    """Preallocated trace for a whole video, stored as one structured array with a row per frame number.
+
+    Frame numbers are the capture position after reading a frame (i.e. the first frame is 1), so there is one more
+    row than frames and row 0 stays blank. Columns are returned as views into the array, so plotting and exporting
+    doesn't copy anything"""
+
+    def __init__(self, frame_count=0, data=None):
+        if data is None:
+            data = np.zeros(frame_count + 1, dtype=TRACE_DTYPE)
+            data['confidence'] = np.nan
+        self.data = data
+        self.frames = np.arange(len(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, col):
+        return self.data[col]
+
+    def record(self, frame_number, bbox, vid_height, confidence=np.nan):
+        """Store a successfully tracked box for the given frame"""
+        self.data[frame_number] = bbox_to_trace(bbox, vid_height) + (True, True, confidence)
+
+    def record_failure(self, frame_number, confidence=np.nan):
+        """Mark a frame the tracker lost the object on"""
+        self.data['valid'][frame_number] = False
+        self.data['ok'][frame_number] = False
+        self.data['confidence'][frame_number] = confidence
+
+    def row(self, frame_number):
+        """Trace values (x1, x2, y1, y2, xMid, yMid) for one frame"""
+        return tuple(int(self.data[col][frame_number]) for col in TRACE_COLUMNS)
+
+    def to_dataframe(self, columns=TRACE_COLUMNS):
+        """Trace as a DataFrame indexed by frame number"""
+        return pd.DataFrame({col: self.data[col] for col in columns}, index=self.frames)
+
+
+def tracker_confidence(tracker):
+    """Tracking score of the last update, for the trackers that report one (VIT, RPN)"""
+    if hasattr(tracker, 'getTrackingScore'):
+        return float(tracker.getTrackingScore())
+    return np.nan
+
+
+def save_trace(trace, file_path, metadata=None):
+    """Write a whole TraceStore to file_path. .npz and .parquet are written with every column (see TraceWriter) and
+    the metadata; anything else is written as csv with the frame number as the index and the six trace columns"""
+    if os.path.splitext(file_path)[1].lower() in STREAM_FORMATS:
+        writer = open_trace_writer(file_path, metadata)
+        writer.start_segment(1)
+        writer.write_until(trace, len(trace) - 1, force=True)
+        writer.close()
+        return
+    outputData = trace.to_dataframe()
+    outputData.to_csv(file_path)
+    return outputData
+
+
+def trace_metadata(video_path=None, fps=None, tracker_type=None, bbox=None, start_frame=None, vid_height=None,
+                   frame_count=None, **extra):
+    """Metadata saved with a trace, so it can be interpreted (and reproduced) without the notes from the session.
+    tracker_type is the tracker type or profile name; pass the profile itself as profile= to record its settings"""
+    metadata = {
+        'video': os.path.abspath(video_path) if video_path else None,
+        'fps': fps,
+        'tracker': tracker_type,
+        'bbox': [int(v) for v in bbox] if bbox is not None else None,
+        'start_frame': start_frame,
+        'vid_height': vid_height,
+        'frame_count': frame_count,
+        'columns': TRACE_COLUMNS,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    metadata.update(extra)
+    return metadata
+
+
+CHUNK_DTYPE = np.dtype([('frame', np.int32)] + TRACE_DTYPE.descr)
+
+
+class TraceWriter(object):
+    """Streams a TraceStore to disk while it's being filled, a chunk of chunk_rows frames at a time, so a long run
+    that crashes only loses the last chunk. Chunks hold every TRACE_DTYPE column plus the frame number, and are
+    applied in order when read back (read_trace), so frames tracked again later simply overwrite the earlier rows.
+
+    start_segment(frame) sets where the next chunk starts (the frame the tracker was initialised on); after that,
+    write_until(trace, frame) is called with each newly recorded frame, and writes a chunk whenever enough rows have
+    built up. Subclasses implement write_chunk for a particular format.
+
+    Only one writer at a time can have a file open (in this process): opening another on the same path raises
+    FileExistsError, rather than clearing out the chunks the first one is still writing"""
+    open_paths = set()  # files being written by an open TraceWriter
+
+    def __init__(self, file_path, metadata=None, chunk_rows=TRACE_CHUNK_ROWS):
+        if os.path.abspath(file_path) in TraceWriter.open_paths:
+            raise FileExistsError(f"{file_path} is already being written by another trace writer")
+        TraceWriter.open_paths.add(os.path.abspath(file_path))
+        self.file_path = file_path
+        self.metadata = metadata or {}
+        self.chunk_rows = chunk_rows
+        self.nextFrame = None  # first frame not written yet
+        self.nChunks = 0
+
+    def start_segment(self, frame_number):
+        self.nextFrame = frame_number
+
+    def write_until(self, trace, frame_number, force=False):
+        """Write the rows from the end of the last chunk up to frame_number, once there's a full chunk of them (or
+        whatever there is, with force)"""
+        if self.nextFrame is None or frame_number < self.nextFrame:
+            return
+        if not force and frame_number - self.nextFrame + 1 < self.chunk_rows:
+            return
+        rows = trace.data[self.nextFrame:frame_number + 1]
+        chunk = np.empty(len(rows), dtype=CHUNK_DTYPE)
+        chunk['frame'] = np.arange(self.nextFrame, self.nextFrame + len(rows))
+        for name in TRACE_DTYPE.names:
+            chunk[name] = rows[name]
+        self.write_chunk(chunk)
+        self.nChunks += 1
+        self.nextFrame = frame_number + 1
+
+    def write_chunk(self, chunk):
+        raise NotImplementedError
+
+    def close(self):
+        TraceWriter.open_paths.discard(os.path.abspath(self.file_path))
+
+
+def npz_parts_path(file_path):
+    """Folder an NpzTraceWriter keeps its chunks in until it's closed"""
+    return file_path + '.parts'
+
+
+class NpzTraceWriter(TraceWriter):
+    """Trace as an npz (zip) file: metadata.json plus one chunk_NNNNNN.npy structured array per chunk. Appending to a
+    zip rewrites its directory, so a crash mid-append could lose the whole file; instead each chunk is written to its
+    own file in <trace>.npz.parts (write then rename, like the parquet parts), and close() packs them into the npz and
+    removes the folder. read_trace reads the parts folder if it's still there, so a crashed run keeps every chunk that
+    was finished"""
+
+    def __init__(self, file_path, metadata=None, chunk_rows=TRACE_CHUNK_ROWS):
+        super().__init__(file_path, metadata, chunk_rows)
+        self.partsPath = npz_parts_path(file_path)
+        try:
+            if os.path.isdir(self.partsPath):
+                shutil.rmtree(self.partsPath)  # left over from a run that never finished
+            os.makedirs(self.partsPath)
+            self.write_part('metadata.json', lambda f: f.write(json.dumps(self.metadata).encode()))
+        except OSError:
+            super().close()
+            raise
+
+    def write_part(self, name, write):
+        partPath = os.path.join(self.partsPath, name)
+        with open(partPath + '.tmp', 'wb') as f:
+            write(f)
+        os.replace(partPath + '.tmp', partPath)
+
+    def write_chunk(self, chunk):
+        self.write_part(f'chunk_{self.nChunks:06d}.npy', lambda f: np.lib.format.write_array(f, chunk))
+
+    def close(self):
+        try:
+            if os.path.isdir(self.partsPath):
+                self.pack()
+        finally:
+            super().close()
+
+    def pack(self):
+        # pack into a temporary zip and swap it in, so the old file stays intact until the new one is complete
+        with zipfile.ZipFile(self.file_path + '.tmp', 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.write(os.path.join(self.partsPath, 'metadata.json'), 'metadata.json')
+            for i in range(self.nChunks):
+                name = f'chunk_{i:06d}.npy'
+                zf.write(os.path.join(self.partsPath, name), name)
+        os.replace(self.file_path + '.tmp', self.file_path)
+        shutil.rmtree(self.partsPath)
+
+
+class ParquetTraceWriter(TraceWriter):
+    """Trace as a parquet dataset: a folder with one part-NNNNNN.parquet file per chunk, each carrying the metadata in
+    its schema. A parquet file is only readable once it's closed, so a single growing file would lose everything in a
+    crash; separate parts don't (and pandas/pyarrow read the folder as one table)"""
+
+    def __init__(self, file_path, metadata=None, chunk_rows=TRACE_CHUNK_ROWS):
+        if pa is None:
+            raise ImportError("Parquet traces need pyarrow (pip install pyarrow)")
+        super().__init__(file_path, metadata, chunk_rows)
+        try:
+            os.makedirs(file_path, exist_ok=True)
+            for oldPart in glob.glob(os.path.join(file_path, 'part-*.parquet')):
+                os.remove(oldPart)
+        except OSError:
+            super().close()
+            raise
+        self.schema = pa.schema([(name, pa.from_numpy_dtype(CHUNK_DTYPE[name])) for name in CHUNK_DTYPE.names],
+                                metadata={'trace': json.dumps(self.metadata)})
+
+    def write_chunk(self, chunk):
+        table = pa.Table.from_arrays([pa.array(chunk[name]) for name in CHUNK_DTYPE.names], schema=self.schema)
+        partPath = os.path.join(self.file_path, f'part-{self.nChunks:06d}.parquet')
+        # write then rename, so a crash mid-write never leaves a broken part
+        pq.write_table(table, partPath + '.tmp')
+        os.replace(partPath + '.tmp', partPath)
+
+
+def open_trace_writer(file_path, metadata=None, chunk_rows=TRACE_CHUNK_ROWS):
+    """TraceWriter for the format given by the file extension (.npz or .parquet)"""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.npz':
+        return NpzTraceWriter(file_path, metadata, chunk_rows)
+    if ext == '.parquet':
+        return ParquetTraceWriter(file_path, metadata, chunk_rows)
+    raise ValueError(f"Can't stream a trace to a {ext} file, use one of {', '.join(STREAM_FORMATS)}")
+
+
+def backup_trace(file_path):
+    """Move an existing trace (and an unfinished npz's parts folder) out of the way, to <name>.1<ext>, <name>.2<ext>
+    and so on, whichever is free. Returns the path it was moved to, or None if there was nothing at file_path"""
+    partsPath = npz_parts_path(file_path)
+    if not os.path.exists(file_path) and not os.path.isdir(partsPath):
+        return None
+    root, ext = os.path.splitext(file_path)
+    n = 1
+    while os.path.exists(f'{root}.{n}{ext}') or os.path.exists(npz_parts_path(f'{root}.{n}{ext}')):
+        n += 1
+    backupPath = f'{root}.{n}{ext}'
+    if os.path.exists(file_path):
+        os.replace(file_path, backupPath)
+    if os.path.isdir(partsPath):
+        os.replace(partsPath, npz_parts_path(backupPath))
+    return backupPath
+
+
+def apply_chunk(trace, chunk):
+    for name in TRACE_DTYPE.names:
+        trace.data[name][chunk['frame']] = chunk[name]
+
+
+def load_chunks(names, open_chunk):
+    """Load the named chunks in order, stopping at the first one that can't be read (cut short by a crash)"""
+    chunks = []
+    for name in names:
+        try:
+            with open_chunk(name) as f:
+                chunks.append(np.load(f))
+        except (ValueError, EOFError, OSError, zipfile.BadZipFile) as e:
+            print(f"Skipping unreadable trace chunk {name} (and any after it): {e}")
+            break
+    return chunks
+
+
+def read_trace(file_path):
+    """Read a trace saved by save_trace or a TraceWriter. Returns (TraceStore, metadata); csv files have no metadata,
+    and only the six trace columns (a row counts as valid if any of them is non-zero)"""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.npz':
+        partsPath = npz_parts_path(file_path)
+        if os.path.isdir(partsPath):  # still being written, or the run never finished
+            with open(os.path.join(partsPath, 'metadata.json')) as f:
+                metadata = json.load(f)
+            names = sorted(name for name in os.listdir(partsPath) if name.startswith('chunk_') and
+                           name.endswith('.npy'))
+            chunks = load_chunks(names, lambda name: open(os.path.join(partsPath, name), 'rb'))
+        else:
+            with zipfile.ZipFile(file_path) as zf:
+                metadata = json.loads(zf.read('metadata.json'))
+                names = sorted(name for name in zf.namelist() if name.startswith('chunk_'))
+                chunks = load_chunks(names, zf.open)
+    elif ext == '.parquet':
+        if pq is None:
+            raise ImportError("Parquet traces need pyarrow (pip install pyarrow)")
+        chunks = []
+        metadata = {}
+        for partPath in sorted(glob.glob(os.path.join(file_path, 'part-*.parquet'))):
+            try:
+                table = pq.read_table(partPath)
+            except (ValueError, OSError) as e:
+                print(f"Skipping unreadable trace part {partPath} (and any after it): {e}")
+                break
+            metadata = json.loads(table.schema.metadata[b'trace'])
+            chunk = np.empty(table.num_rows, dtype=CHUNK_DTYPE)
+            for name in CHUNK_DTYPE.names:
+                chunk[name] = table.column(name).to_numpy()
+            chunks.append(chunk)
+    else:
+        tracedf = pd.read_csv(file_path, index_col=0)
+        trace = TraceStore(int(tracedf.index.max()) if len(tracedf) else 0)
+        for col in TRACE_COLUMNS:
+            trace.data[col][tracedf.index] = tracedf[col]
+        trace.data['valid'][tracedf.index] = (tracedf[TRACE_COLUMNS] != 0).any(axis=1)
+        trace.data['ok'] = trace.data['valid']
+        return trace, {}
+
+    lastFrame = max([int(chunk['frame'].max()) for chunk in chunks if len(chunk)], default=0)
+    trace = TraceStore(max(metadata.get('frame_count') or 0, lastFrame))
+    for chunk in chunks:
+        apply_chunk(trace, chunk)
+    return trace, metadata
+
+
+def checkpoint_path(trace_path):
+    """Checkpoint file that goes with a trace file (<trace>.checkpoint.npz)"""
+    return os.path.splitext(trace_path)[0] + ".checkpoint.npz"
+
+
+def save_checkpoint(file_path, trace, frame_number, bbox, ok=True, template=None, metadata=None):
+    """Save everything needed to carry on tracking from frame_number: the trace up to that frame, the last tracked box
+    (and whether the tracker still had the object on that frame), the template cut from the original selection (to
+    re-find the object if it didn't) and the trace metadata. Written to a temporary file that then replaces the old
+    checkpoint, so there's always a complete one on disk"""
+    state = {
+        'frame': int(frame_number),
+        'bbox': [int(v) for v in bbox],
+        'ok': bool(ok),
+        'metadata': metadata or {},
+        'saved': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    tempPath = file_path + ".tmp"
+    with open(tempPath, 'wb') as f:
+        np.savez(f, trace=trace.data[:frame_number + 1], state=np.array(json.dumps(state)),
+                 template=template if template is not None else np.zeros((0, 0, 3), dtype=np.uint8))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tempPath, file_path)
+
+
+def load_checkpoint(file_path):
+    """Read a checkpoint saved by save_checkpoint. Returns a dict with the trace rows up to the checkpoint ('trace', a
+    TRACE_DTYPE array indexed by frame number), 'frame', 'bbox', 'ok', 'template' (None if there isn't one),
+    'metadata' and 'saved'"""
+    with np.load(file_path) as checkpoint:
+        state = json.loads(str(checkpoint['state']))
+        state['trace'] = checkpoint['trace']
+        state['template'] = checkpoint['template'] if checkpoint['template'].size else None
+    state['bbox'] = tuple(state['bbox'])
+    return state
+
+
+def remove_checkpoint(file_path):
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+class Checkpointer(object):
+    """Saves a checkpoint (see save_checkpoint) every interval seconds while a TrackingPipeline runs, and once more when
+    it stops. update is called by the pipeline's write stage with every recorded frame, and only keeps track of the
+    last frame and the last good box until a checkpoint is due"""
+
+    def __init__(self, file_path, template=None, metadata=None, bbox=None, interval=CHECKPOINT_INTERVAL):
+        self.file_path = file_path
+        self.template = template
+        self.metadata = metadata
+        self.interval = interval
+        self.lastBbox = tuple(bbox) if bbox is not None else None
+        self.lastFrame = None
+        self.lastOk = True
+        self.lastSave = time.perf_counter()
+
+    def update(self, trace, frame_number, bbox, ok):
+        if ok:
+            self.lastBbox = bbox
+        self.lastFrame = frame_number
+        self.lastOk = ok
+        if time.perf_counter() - self.lastSave >= self.interval:
+            self.save(trace)
+
+    def save(self, trace):
+        if self.lastFrame is None or self.lastBbox is None:
+            return
+        try:
+            save_checkpoint(self.file_path, trace, self.lastFrame, self.lastBbox, ok=self.lastOk,
+                            template=self.template, metadata=self.metadata)
+        except OSError as e:
+            print(f"Could not save a checkpoint to {self.file_path}: {e}")
+        self.lastSave = time.perf_counter()
+
+    def remove(self):
+        remove_checkpoint(self.file_path)
+
+
+def crop_bbox(frame, bbox):
+    """Copy of the bbox region of a frame"""
+    x, y, w, h = (int(v) for v in bbox)
+    return frame[y:y + h, x:x + w].copy()
+
+
+def match_template(frame, template):
+    """Find the best match for the template image in the frame (normalised cross-correlation).
+    Returns the matched (x, y, width, height) box and its correlation score (1 is a perfect match)"""
+    result = cv2.matchTemplate(frame, template, cv2.TM_CCOEFF_NORMED)
+    _, score, _, loc = cv2.minMaxLoc(result)
+    return (loc[0], loc[1], template.shape[1], template.shape[0]), score
+
+
+def trace_iou(row_a, row_b):
+    """Intersection over union of two boxes given as trace rows (x1, x2, y1, y2, ...), e.g. from TraceStore.row. y is
+    flipped in the trace, but that doesn't change the overlap"""
+    ax1, ax2, ay1, ay2 = row_a[0], row_a[1], min(row_a[2], row_a[3]), max(row_a[2], row_a[3])
+    bx1, bx2, by1, by2 = row_b[0], row_b[1], min(row_b[2], row_b[3]), max(row_b[2], row_b[3])
+    overlapX = max(0, min(ax2, bx2) - max(ax1, bx1))
+    overlapY = max(0, min(ay2, by2) - max(ay1, by1))
+    intersection = overlapX * overlapY
+    union = (ax2 - ax1) * (ay2 - ay1) + (bx2 - bx1) * (by2 - by1) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def read_template(video_path, bbox, frame_number=1):
+    """Cut the bbox region out of the given frame, for re-finding the object later"""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if frame_number > 1:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number - 1)
+        ok, frame = cap.read()
+    finally:
+        cap.release()
+    if not ok:
+        raise IOError(f"Could not read frame {frame_number} of {video_path}")
+    return crop_bbox(frame, bbox)
+
+
+class StageStats(object):
+    """Counters for one stage of a TrackingPipeline"""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.stall = 0.0  # seconds spent waiting on the neighbouring stages
+        self.timeStart = None
+        self.timeEnd = None
+
+    def elapsed(self):
+        if self.timeStart is None:
+            return 0.0
+        return (self.timeEnd or time.perf_counter()) - self.timeStart
+
+    def fps(self):
+        elapsed = self.elapsed()
+        return self.frames / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        return {'frames': self.frames, 'fps': self.fps(), 'seconds': self.elapsed(), 'stall': self.stall}
+
+
+class TrackingPipeline(object):
+    """Decode -> track -> write, each stage in its own thread and connected by bounded queues, so decoding the next
+    frames overlaps with tracking the current one (cv2 releases the GIL while decoding and tracking).
+
+    The capture must be positioned after the frame the tracker was initialised on (last_frame, by default the capture
+    position). Every tracked frame is recorded in trace by the write stage, which also streams it to trace_writer if
+    given (a TraceWriter, from last_frame on) and passes it to checkpointer (a Checkpointer), then calls
+    on_result((frame number, bbox, ok, confidence)). on_frame(frame, result) is called from the track stage with every
+    tracked frame, for previews. Both callbacks run in the pipeline's threads, so should be quick"""
+
+    def __init__(self, cap, tracker, trace, vid_height, end_frame, last_frame=None, queue_size=32, on_result=None,
+                 on_frame=None, progress_callback=None, trace_writer=None, checkpointer=None):
+        self.cap = cap
+        self.tracker = tracker
+        self.trace = trace
+        self.vid_height = vid_height
+        self.end_frame = end_frame
+        self.on_result = on_result
+        self.on_frame = on_frame
+        self.progress_callback = progress_callback
+
+        self.decodeQueue = queue.Queue(maxsize=queue_size)
+        self.resultQueue = queue.Queue(maxsize=queue_size)
+        self.decodeStop = threading.Event()  # stop reading new frames, but finish the ones already read
+        self.abortFlag = threading.Event()  # stop everything now
+        self.threads = []
+
+        self.decodeStats = StageStats('decode')
+        self.trackStats = StageStats('track')
+        self.writeStats = StageStats('write')
+        self.failed = 0
+        self.lastFrame = None  # last tracked frame, for restarting the tracker
+        self.lastFrameNumber = last_frame if last_frame is not None else int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        self.error = None
+
+        self.trace_writer = trace_writer
+        if trace_writer is not None:
+            trace_writer.start_segment(self.lastFrameNumber)
+        self.checkpointer = checkpointer
+
+    def start(self):
+        for target in (self.decode_stage, self.track_stage, self.write_stage):
+            thread = threading.Thread(target=self.run_stage, args=(target,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def wait(self):
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        """Run the whole pipeline to the end frame, blocking until it's finished"""
+        self.start()
+        self.wait()
+
+    def stop(self, drain=True):
+        """Stop reading frames. With drain, frames already read are still tracked and recorded, so the capture position
+        and the trace stay in step"""
+        self.decodeStop.set()
+        if not drain:
+            self.abortFlag.set()
+
+    def run_stage(self, target):
+        try:
+            target()
+        except Exception as e:
+            self.error = e
+            self.decodeStop.set()
+            self.abortFlag.set()
+
+    def put(self, q, item, stats):
+        """Put item on the queue, waiting for space (unless aborted)"""
+        timeStart = time.perf_counter()
+        while not self.abortFlag.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stats.stall += time.perf_counter() - timeStart
+
+    def get(self, q, stats):
+        """Take the next item from the queue, waiting for it (returns None at the end or if aborted)"""
+        timeStart = time.perf_counter()
+        item = None
+        while not self.abortFlag.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        stats.stall += time.perf_counter() - timeStart
+        return item
+
+    def decode_stage(self):
+        stats = self.decodeStats
+        stats.timeStart = time.perf_counter()
+        frameNumber = self.lastFrameNumber
+        while not self.decodeStop.is_set() and frameNumber < self.end_frame:
+            ok, frame = self.cap.read()
+            if not ok:
+                break  # end of video
+            frameNumber += 1
+            stats.frames += 1
+            self.put(self.decodeQueue, (frameNumber, frame), stats)
+        self.put(self.decodeQueue, None, stats)
+        stats.timeEnd = time.perf_counter()
+
+    def track_stage(self):
+        stats = self.trackStats
+        stats.timeStart = time.perf_counter()
+        while True:
+            item = self.get(self.decodeQueue, stats)
+            if item is None:
+                break
+            frameNumber, frame = item
+            ok, bbox = self.tracker.update(frame)
+            result = (frameNumber, tuple(int(v) for v in bbox), ok, tracker_confidence(self.tracker))
+            self.lastFrame = frame
+            stats.frames += 1
+            if self.on_frame is not None:
+                self.on_frame(frame, result)
+            self.put(self.resultQueue, result, stats)
+        self.put(self.resultQueue, None, stats)
+        stats.timeEnd = time.perf_counter()
+
+    def write_stage(self):
+        stats = self.writeStats
+        stats.timeStart = time.perf_counter()
+        while True:
+            result = self.get(self.resultQueue, stats)
+            if result is None:
+                break
+            frameNumber, bbox, ok, confidence = result
+            if ok:
+                self.trace.record(frameNumber, bbox, self.vid_height, confidence)
+            else:
+                self.trace.record_failure(frameNumber, confidence)
+                self.failed += 1
+            self.lastFrameNumber = frameNumber
+            stats.frames += 1
+            if self.on_result is not None:
+                self.on_result(result)
+            if self.trace_writer is not None:
+                self.trace_writer.write_until(self.trace, frameNumber)
+            if self.checkpointer is not None:
+                self.checkpointer.update(self.trace, frameNumber, bbox, ok)
+            if self.progress_callback is not None and frameNumber % 100 == 0:
+                self.progress_callback(frameNumber, self.end_frame)
+        if self.trace_writer is not None:
+            self.trace_writer.write_until(self.trace, self.lastFrameNumber, force=True)
+        if self.checkpointer is not None:
+            self.checkpointer.save(self.trace)
+        stats.timeEnd = time.perf_counter()
+
+    def report(self):
+        """Counters for each stage plus the current queue depths"""
+        return {
+            'decode': self.decodeStats.report(),
+            'track': self.trackStats.report(),
+            'write': self.writeStats.report(),
+            'decode_queue': self.decodeQueue.qsize(),
+            'result_queue': self.resultQueue.qsize(),
+        }
+
+
+def format_report(report):
+    """One line summary of a TrackingPipeline report"""
+    stages = ", ".join(f"{name} {report[name]['fps']:.1f} fps (stalled {report[name]['stall']:.1f} s)"
+                       for name in ('decode', 'track', 'write'))
+    return f"{stages}; queued {report['decode_queue']} decoded, {report['result_queue']} tracked"
+
+
+def track_video(video_path, bbox, tracker_type=DEFAULT_PROFILE, start_frame=1, end_frame=None, progress_callback=None,
+                template=None, tracker_options=None, trace_writer=None, checkpointer=None, resume=None,
+                min_score=MIN_MATCH_SCORE):
+    """Track a single object through a video, without any display.
+
+    bbox is (x, y, width, height) on frame start_frame (1-based, as shown by the GUI). If bbox is None, the object is
+    found on the start frame by matching template instead; if the match scores below min_score (e.g. the object is
+    hidden on that frame), the following frames are searched until it's found, and tracking starts there (the frames
+    before are left untracked; stats['init_frame'] is where it started, or None if it was never found, in which case
+    nothing is tracked). Tracking runs until end_frame (inclusive) or
+    the end of the video. progress_callback, if given, is called as progress_callback(frame_number, frame_count) every
+    100 frames.
+    tracker_type is a tracker type or a profile (name or dict, see resolve_profile), and tracker_options (search_pad,
+    scale, grayscale) override the profile's input options. With a trace_writer (TraceWriter),
+    the trace is also streamed to disk as it's tracked; closing the writer is up to the caller. With a checkpointer
+    (Checkpointer), checkpoints are saved while tracking, with the bbox region of the start frame as the template
+    unless the checkpointer already has one. To carry on from a checkpoint, pass it (from load_checkpoint) as resume:
+    the trace so far is restored and tracking restarts on the checkpoint's frame from its last box, or from a template
+    match if the tracker had lost the object there. bbox and start_frame are then ignored.
+    Returns (trace, stats), where trace is a TraceStore covering the whole video"""
+    if bbox is None and template is None and resume is None:
+        raise ValueError("track_video needs a bbox, or a template to find the object with")
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Could not read video file {video_path}")
+
+    try:
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        vidHeight = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        if end_frame is None or end_frame > frame_count:
+            end_frame = frame_count
+
+        trace = TraceStore(frame_count)
+        if resume is not None:
+            rows = resume['trace'][:len(trace)]
+            trace.data[:len(rows)] = rows
+            start_frame = resume['frame']
+            bbox = resume['bbox']
+            if template is None:
+                template = resume['template']
+
+        if start_frame > 1:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame - 1)
+        ok, frame = cap.read()
+        if not ok:
+            raise IOError(f"Could not read frame {start_frame} of {video_path}")
+        if resume is not None and trace_writer is not None:
+            # the writer starts a new file, so it needs the frames from before the checkpoint too
+            trace_writer.start_segment(1)
+            trace_writer.write_until(trace, start_frame - 1, force=True)
+
+        initScore = None
+        if bbox is None or (resume is not None and not resume['ok'] and template is not None):
+            bbox, initScore = match_template(frame, template)
+            # only start on a box the template confirms
+            while initScore < min_score and start_frame < end_frame:
+                ok, nextFrame = cap.read()
+                if not ok:
+                    break
+                start_frame += 1
+                frame = nextFrame
+                bbox, initScore = match_template(frame, template)
+            if initScore < min_score:
+                # not found anywhere: leave the frames untracked rather than track whatever matched best
+                return trace, {
+                    'frames': 0,
+                    'failed': 0,
+                    'seconds': 0.0,
+                    'fps': 0.0,
+                    'last_frame': start_frame,
+                    'init_frame': None,
+                    'init_bbox': None,
+                    'init_score': initScore,
+                    'pipeline': None,
+                    'tracker': None,
+                }
+
+        initBbox = tuple(int(v) for v in bbox)
+        tracker = create_profile_tracker(tracker_type, **(tracker_options or {}))
+        if isinstance(tracker, HybridTracker) and template is not None:
+            tracker.template = template  # verify against the original selection
+        tracker.init(frame, initBbox)
+        if resume is None or initScore is not None:
+            trace.record(start_frame, initBbox, vidHeight)
+        if checkpointer is not None:
+            if checkpointer.template is None:
+                checkpointer.template = template if template is not None else crop_bbox(frame, initBbox)
+            checkpointer.lastBbox = initBbox
+
+        pipeline = TrackingPipeline(cap, tracker, trace, vidHeight, end_frame, last_frame=start_frame,
+                                    progress_callback=progress_callback, trace_writer=trace_writer,
+                                    checkpointer=checkpointer)
+        try:
+            pipeline.run()
+        except KeyboardInterrupt:
+            # finish the frames already read, so the last checkpoint is as recent as possible
+            pipeline.stop()
+            pipeline.wait()
+            raise
+    finally:
+        cap.release()
+
+    report = pipeline.report()
+    nTracked = report['write']['frames']
+    elapsed = report['write']['seconds']
+    stats = {
+        'frames': nTracked,
+        'failed': pipeline.failed,
+        'seconds': elapsed,
+        'fps': nTracked / elapsed if elapsed > 0 else 0.0,
+        'last_frame': pipeline.lastFrameNumber,
+        'init_frame': start_frame,
+        'init_bbox': initBbox,
+        'init_score': initScore,
+        'pipeline': report,
+        'tracker': getattr(tracker, 'stats', None),  # e.g. HybridTracker's verifications and drifts
+    }
+    return trace, stats
+
+
+def track_chunk(job):
+    """Track one chunk of a video for track_video_chunked. Runs in a worker process, and only returns the rows of the
+    trace that belong to the chunk (plus the overlap frame at its end)"""
+    cv2.setNumThreads(1)
+    trace, stats = track_video(job['video'], job['bbox'], tracker_type=job['tracker'], start_frame=job['start'],
+                               end_frame=job['end'], template=job['template'], tracker_options=job['options'],
+                               min_score=job['min_score'])
+    return job['start'], trace.data[job['start']:job['end'] + 1].copy(), stats
+
+
+def track_video_chunked(video_path, bbox, tracker_type=DEFAULT_PROFILE, chunks=None, start_frame=1, end_frame=None,
+                        template=None, seam_iou=0.5, tracker_options=None, min_score=MIN_MATCH_SCORE):
+    """Track a single long video by splitting it into time chunks that are tracked in parallel processes.
+
+    The first chunk starts from bbox as usual. Every later chunk finds the object on its first frame by template
+    matching against template (by default the bbox region of start_frame, as captured by Set Bounding Box), and each
+    chunk tracks one frame past its end so the hand-off can be checked. A chunk only starts on a match scoring at
+    least min_score, searching the frames after its first one if it has to (see track_video). Seams where the two
+    chunks disagree (IoU below seam_iou) or the next chunk couldn't start on its first frame are reported in
+    stats['seams']. Returns (trace, stats) like track_video, except that stats['frames'] is the number of trace rows
+    written (every tracked frame, including the one each chunk started on)"""
+    if bbox is None and template is None:
+        raise ValueError("track_video_chunked needs a bbox, or a template to find the object with")
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Could not read video file {video_path}")
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if end_frame is None or end_frame > frame_count:
+        end_frame = frame_count
+    if chunks is None:
+        chunks = os.cpu_count() or 1
+    chunks = max(1, min(chunks, end_frame - start_frame + 1))
+    if template is None:
+        template = read_template(video_path, bbox, start_frame)
+
+    # chunk boundaries: chunk i owns frames bounds[i] to bounds[i + 1] - 1
+    chunkLen = (end_frame - start_frame + 1) / chunks
+    bounds = [start_frame + round(i * chunkLen) for i in range(chunks)] + [end_frame + 1]
+    jobs = []
+    for i in range(chunks):
+        jobs.append({
+            'video': video_path,
+            'bbox': bbox if i == 0 else None,
+            'tracker': tracker_type,
+            'options': tracker_options,
+            'template': template,
+            'start': bounds[i],
+            'end': min(bounds[i + 1], end_frame),  # one frame of overlap with the next chunk
+            'min_score': min_score,
+        })
+
+    timeStart = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=chunks) as pool:
+        results = sorted(pool.map(track_chunk, jobs), key=lambda result: result[0])
+    elapsed = time.perf_counter() - timeStart
+
+    # stitch the chunks together, each one only writing the frames it owns
+    trace = TraceStore(frame_count)
+    for i, (chunkStart, chunkData, _) in enumerate(results):
+        nOwned = bounds[i + 1] - bounds[i]
+        trace.data[chunkStart:chunkStart + nOwned] = chunkData[:nOwned]
+
+    # compare where each chunk ended up on the first frame of the next one with where the next one started
+    seams = []
+    for i in range(1, chunks):
+        seamFrame = bounds[i]
+        prevRow = TraceStore(data=results[i - 1][1]).row(seamFrame - bounds[i - 1])
+        iou = trace_iou(prevRow, trace.row(seamFrame))
+        chunkStats = results[i][2]
+        seams.append({
+            'frame': seamFrame,
+            'iou': iou,
+            'match_score': chunkStats['init_score'],
+            'start_frame': chunkStats['init_frame'],  # later than frame if the object wasn't found there (None: never)
+            'mismatch': iou < seam_iou or chunkStats['init_frame'] != seamFrame,
+        })
+
+    # rows each chunk wrote into the frames it owns: from the frame it started on up to where it stopped, or the start
+    # of the next chunk (its last, overlap frame belongs to the next chunk)
+    nTracked = 0
+    for i, (_, _, chunkStats) in enumerate(results):
+        if chunkStats['init_frame'] is not None:
+            lastOwned = min(chunkStats['last_frame'], bounds[i + 1] - 1)
+            nTracked += max(0, lastOwned - chunkStats['init_frame'] + 1)
+    stats = {
+        'frames': nTracked,
+        'failed': sum(result[2]['failed'] for result in results),
+        'seconds': elapsed,
+        'fps': nTracked / elapsed if elapsed > 0 else 0.0,
+        'last_frame': results[-1][2]['last_frame'],
+        'chunks': chunks,
+        'seams': seams,
+    }
+    return trace, stats
+
+
+def video_properties(video_path):
+    """(fps, frame count, height) of a video, for the trace metadata. Raises IOError if the video can't be read (OpenCV
+    itself just reports zeros)"""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            raise IOError(f"Could not read video file {video_path}")
+        frameCount = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frameCount <= 0:
+            raise IOError(f"No frames in video file {video_path}")
+        return cap.get(cv2.CAP_PROP_FPS), frameCount, int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        cap.release()
+
+
+def print_progress(frame_number, frame_count):
+    print(f"\rTracking frame {frame_number} of {frame_count}", end='', flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Track an object through a video without the GUI")
+    parser.add_argument('video', nargs='?', help="path to the video file")
+    parser.add_argument('--bbox', nargs=4, type=int, default=None, metavar=('X', 'Y', 'WIDTH', 'HEIGHT'),
+                        help="initial bounding box on the start frame, in pixels (not needed with --resume)")
+    parser.add_argument('--tracker', default=DEFAULT_PROFILE, help=f"tracker type ({', '.join(TRACKER_TYPES)}) or "
+                                                                   f"profile name (default: {DEFAULT_PROFILE})")
+    parser.add_argument('--profiles', default=None, help=f"json file of extra tracker profiles (default: "
+                                                         f"{PROFILES_FILE} next to this program, if there is one)")
+    parser.add_argument('--list-profiles', action='store_true', help="list the tracker profiles and exit")
+    parser.add_argument('--start-frame', type=int, default=1, help="frame the bounding box was drawn on (default: 1)")
+    parser.add_argument('--end-frame', type=int, default=None, help="last frame to track (default: end of video)")
+    parser.add_argument('-o', '--output', default=None, help="trace file to write: .csv, .npz or .parquet "
+                                                             "(default: <video>_trace.csv). npz and parquet traces "
+                                                             "are written as tracking goes")
+    parser.add_argument('--chunks', type=int, default=None, help="split the video into this many chunks and track "
+                                                                 "them in parallel processes")
+    parser.add_argument('--search-pad', type=float, default=None, help="only track inside a window around the box, "
+                                                                       "padded by this many box sizes on each side")
+    parser.add_argument('--scale', type=float, default=None, help="downscale the tracker input by this factor "
+                                                                  "(e.g. 0.5)")
+    parser.add_argument('--gray', action='store_true', help="track on grayscale frames (not for GOTURN/VIT/RPN)")
+    parser.add_argument('--resume', action='store_true', help="carry on from the checkpoint left by an interrupted "
+                                                              "run with the same output (<output>.checkpoint.npz)")
+    parser.add_argument('-q', '--quiet', action='store_true', help="don't print progress")
+    args = parser.parse_args(argv)
+    # only the options given on the command line, so the rest come from the profile
+    trackerOptions = {name: value for name, value in (('search_pad', args.search_pad), ('scale', args.scale),
+                                                      ('grayscale', args.gray or None)) if value is not None}
+    try:
+        profiles = load_tracker_profiles(args.profiles)
+    except (OSError, ValueError) as e:
+        parser.error(f"Could not read the tracker profiles: {e}")
+    if args.list_profiles:
+        for name, profile in profiles.items():
+            print(f"{name}: {profile['tracker']} - {profile.get('description', '')}")
+        return 0
+    if args.video is None:
+        parser.error("the following arguments are required: video")
+
+    outputPath = args.output
+    if outputPath is None:
+        outputPath = os.path.splitext(args.video)[0] + "_trace.csv"
+    checkpointPath = checkpoint_path(outputPath)
+    resume = None
+    if args.resume:
+        if args.chunks:
+            parser.error("--resume can't be used with --chunks")
+        if os.path.exists(checkpointPath):
+            resume = load_checkpoint(checkpointPath)
+            if resume['metadata'].get('video') != os.path.abspath(args.video):
+                parser.error(f"{checkpointPath} is from tracking {resume['metadata'].get('video')}, not {args.video}")
+            print(f"Resuming from frame {resume['frame']} (checkpoint saved {resume['saved']})")
+        else:
+            print(f"No checkpoint found at {checkpointPath}, starting from the beginning")
+    if resume is None and args.bbox is None:
+        parser.error("--bbox is required (unless resuming from a checkpoint)")
+
+    fps, frameCount, vidHeight = video_properties(args.video)
+    if resume is not None:
+        # keep the original settings, the trace carries on from them
+        metadata = resume['metadata']
+        profile = metadata.get('profile') or resolve_profile(metadata.get('tracker') or args.tracker, profiles)
+        trackerOptions = metadata.get('tracker_options') or {}
+    else:
+        try:
+            profile = resolve_profile(args.tracker, profiles)
+        except ValueError as e:
+            parser.error(str(e))
+        metadata = trace_metadata(args.video, fps=fps, tracker_type=args.tracker, bbox=args.bbox,
+                                  start_frame=args.start_frame, vid_height=vidHeight, frame_count=frameCount,
+                                  profile=profile, tracker_options=trackerOptions)
+    traceWriter = None
+
+    if args.chunks:
+        trace, stats = track_video_chunked(args.video, args.bbox, tracker_type=profile, chunks=args.chunks,
+                                           start_frame=args.start_frame, end_frame=args.end_frame,
+                                           tracker_options=trackerOptions)
+        for seam in stats['seams']:
+            if seam['start_frame'] is None:
+                print(f"Warning: the template wasn't found in the chunk starting on frame {seam['frame']}, so it "
+                      f"wasn't tracked (best template match {seam['match_score']:.2f})")
+            elif seam['start_frame'] != seam['frame']:
+                print(f"Warning: the template wasn't found on frame {seam['frame']}, so the chunk starting there only "
+                      f"started tracking on frame {seam['start_frame']} (template match {seam['match_score']:.2f})")
+            elif seam['mismatch']:
+                print(f"Warning: chunks disagree at frame {seam['frame']} (IoU {seam['iou']:.2f}, "
+                      f"template match {seam['match_score']:.2f})")
+    else:
+        if os.path.splitext(outputPath)[1].lower() in STREAM_FORMATS:
+            traceWriter = open_trace_writer(outputPath, metadata)
+        trace, stats = track_video(args.video, args.bbox, tracker_type=profile, start_frame=args.start_frame,
+                                   end_frame=args.end_frame, progress_callback=None if args.quiet else print_progress,
+                                   tracker_options=trackerOptions, trace_writer=traceWriter,
+                                   checkpointer=Checkpointer(checkpointPath, metadata=metadata), resume=resume)
+        if stats['init_frame'] is None:
+            print(f"Warning: the template wasn't found (best match {stats['init_score']:.2f}), so nothing was tracked")
+        elif not args.quiet:
+            print()
+            print(format_report(stats['pipeline']))
+            if stats['tracker']:
+                print(f"Tracker: {stats['tracker']}")
+    if traceWriter is not None:
+        traceWriter.close()
+    else:
+        save_trace(trace, outputPath, metadata)
+    remove_checkpoint(checkpointPath)
+    print(f"Tracked {stats['frames']} frames in {stats['seconds']:.1f} s ({stats['fps']:.1f} fps), "
+          f"{stats['failed']} tracking failures. Trace saved to {outputPath}")
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # needed for the worker processes when built with pyinstaller
+    sys.exit(main())